@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+
+import codegen
+import jsongen
+import rpcgen
+import sqlitegen
+import argparse
+import itertools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+TAG = 'benchmark'
+
+# field types that sqlitegen and both jsongen's parser and builder can handle
+field_types = [
+    'guint32',
+    'gint64',
+    'gdouble',
+    'const gchar*'
+]
+
+
+def synth_header(path: str, structs: int, fields: int, depth: int, enum_size: int):
+    """
+    writes a header with structs annotated as sqlitegen tables and jsongen parsers/builders.
+    Each table struct has fields normal fields and a chain of depth nested structs that each
+    have fields fields of their own. Enums are used in separate structs that are only
+    annotated for jsongen as sqlitegen doesn't handle them.
+    """
+    lines = ['#include "codegen/glibwrapper.h"', '']
+
+    for s in range(structs):
+        # innermost first so everything is defined before it's used
+        for d in range(depth, 0, -1):
+            lines.append('struct s%d_n%d {' % (s, d))
+            for f in range(fields):
+                lines.append('\t%s n%d_f%d;' % (field_types[f % len(field_types)], d, f))
+            if d < depth:
+                lines.append('\tstruct s%d_n%d n%d;' % (s, d + 1, d + 1))
+            lines.append('};')
+            lines.append('')
+
+        lines.append('struct s%d {' % s)
+        for f in range(fields):
+            lines.append('\t%s f%d;' % (field_types[f % len(field_types)], f))
+        if depth > 0:
+            lines.append('\tstruct s%d_n1 n1;' % s)
+        lines.append('#ifdef __SQLITEGEN')
+        lines.append('\tvoid __sqlitegen_constraints_f0_notnull_primarykey;')
+        lines.append('\tvoid __sqlitegen_flags_f1_searchable;')
+        lines.append('#endif')
+        lines.append('#ifdef __JSONGEN')
+        lines.append('\tvoid __jsongen_member_f0_id;')
+        lines.append('\tvoid __jsongen_flags_f1_optional;')
+        lines.append('#endif')
+        lines.append('};')
+        lines.append('')
+
+        lines.append('enum e%d {' % s)
+        for v in range(enum_size):
+            lines.append('\tE%d_VALUE%d,' % (s, v))
+        lines.append('};')
+        lines.append('')
+        lines.append('struct es%d {' % s)
+        lines.append('\tenum e%d value;' % s)
+        lines.append('};')
+        lines.append('')
+
+    lines.append('#ifdef __SQLITEGEN')
+    for s in range(structs):
+        lines.append('typedef struct s%d __sqlitegen_table_t%d;' % (s, s))
+    lines.append('#endif')
+    lines.append('#ifdef __JSONGEN')
+    for s in range(structs):
+        lines.append('typedef struct s%d __jsongen_parser;' % s)
+        lines.append('typedef struct s%d __jsongen_builder;' % s)
+        lines.append('typedef struct es%d __jsongen_parser;' % s)
+    lines.append('#endif')
+
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def synth_rpc(path: str, endpoints: int):
+    """
+    writes an rpc spec with endpoints that take between 0 and 2 topic parts
+    """
+    topic_parts = [
+        {},
+        {'id': {'length': 8}},
+        {'name': {'min': 1, 'max': 32}, 'index': {'c_type': 'guint32', 'conversion': 'unsigned', 'min': 0,
+                                                   'max': 1000}}
+    ]
+    spec = {
+        'root': 'bench',
+        'context': {'c_type': 'void*'},
+        'request': {'c_type': 'JsonNode*'},
+        'response': {'c_type': 'JsonBuilder*'},
+        'endpoints': {}
+    }
+    for e in range(endpoints):
+        spec['endpoints']['endpoint%d' % e] = {'topic_parts': topic_parts[e % len(topic_parts)]}
+
+    with open(path, 'w') as f:
+        json.dump(spec, f, indent=1)
+
+
+def measure(generator, job: codegen.Job, args, repeat: int):
+    """
+    runs a generator over a job repeat times and then once more with tracemalloc
+    enabled to get the peak memory used.
+    :return: the fastest time, the stats for the fastest run and the peak memory in bytes
+    """
+    best = None
+    best_stats = None
+    for i in range(repeat):
+        codegen.stats.reset()
+        start = time.perf_counter()
+        generator.process(job, args)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+            best_stats = codegen.stats.to_dict()
+
+    tracemalloc.start()
+    try:
+        generator.process(job, args)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return best, best_stats, peak
+
+
+def measure_startup(script: str, arguments: list, repeat: int):
+    """
+    runs a generator as a new process, like meson would, and times it from start to exit
+    :return: the fastest wall time
+    """
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, script] + arguments, check=True, stdout=subprocess.DEVNULL)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def startup(work_dir: str, headers: str, repeat: int, budget: float):
+    """
+    times each generator on a tiny input with a warm ast cache, which is dominated by start up
+    :return: True if every generator was within the budget
+    """
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    header = os.path.join(work_dir, 'startup.h')
+    synth_header(header, 1, 2, 0, 1)
+    spec = os.path.join(work_dir, 'startup.json')
+    synth_rpc(spec, 1)
+    cache = '--cache-dir=%s' % os.path.join(work_dir, 'cache')
+
+    within = True
+    if os.environ.get('PYTHONDONTWRITEBYTECODE'):
+        # the generators inherit it and compile codegen from source on every run, which meson wouldn't
+        print('PYTHONDONTWRITEBYTECODE is set, the times include compiling the generators')
+    print('%-10s %10s %10s' % ('generator', 'time (ms)', 'budget'))
+    for name, input in [('sqlitegen', header), ('jsongen', header), ('rpcgen', spec)]:
+        arguments = ['--input', input, '--output', os.path.join(work_dir, 'startup.out'), '--headers', headers,
+                     cache]
+        # once to fill the cache and the parser tables
+        measure_startup(os.path.join(script_dir, name + '.py'), arguments, 1)
+        elapsed = measure_startup(os.path.join(script_dir, name + '.py'), arguments, repeat)
+        ok = elapsed <= budget
+        within = within and ok
+        print('%-10s %10.2f %10s' % (name, elapsed * 1000, 'ok' if ok else 'over'))
+    return within
+
+
+# the jsongen parsers that are compared by --parsers, the struct for each is annotated with the typedef
+parser_backends = [
+    ('dom', '__jsongen_parser'),
+    ('iterate', '__jsongen_parser_iterate'),
+    ('stream', '__jsongen_parser_stream')
+]
+
+
+def synth_parser_header(path: str, fields: int):
+    """
+    writes a header with a struct with fields fields for each of the parser backends
+    """
+    lines = ['#include "codegen/glibwrapper.h"', '']
+    for name, typedef in parser_backends:
+        lines.append('struct p_%s {' % name)
+        for f in range(fields):
+            lines.append('\t%s f%d;' % (field_types[f % len(field_types)], f))
+        lines.append('};')
+        lines.append('')
+    lines.append('#ifdef __JSONGEN')
+    for name, typedef in parser_backends:
+        lines.append('typedef struct p_%s %s;' % (name, typedef))
+    lines.append('#endif')
+
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def synth_parser_program(path: str, header: str, generated: str, fields: int, iterations: int):
+    """
+    writes a program that times parsing the same object with each of the parser backends,
+    the time for the dom parsers includes building the tree with json-glib as callers need to do that first
+    """
+    members = []
+    for f in range(fields):
+        value = ['%d' % f, '-%d' % (f * 1000), '%d.5' % f, '\\"value %d\\"' % f][f % len(field_types)]
+        members.append('\\"f%d\\": %s' % (f, value))
+
+    lines = ['#include <glib.h>',
+             '#include <json-glib/json-glib.h>',
+             '#include <stdio.h>',
+             '#include <string.h>',
+             '#include "%s"' % header,
+             '#include "%s"' % generated,
+             '',
+             'static const gchar payload[] = "{%s}";' % ', '.join(members),
+             '',
+             'int main(void) {',
+             '\tgchar* buffer = g_malloc(sizeof(payload));',
+             '\tgint64 start;']
+    for name, typedef in parser_backends:
+        function_name = jsongen.parser_function_name('p_' + name,
+                                                     codegen.annotation_parameters_from_field_name(typedef))
+        lines.append('\tstruct p_%s p_%s;' % (name, name))
+        lines.append('\tstart = g_get_monotonic_time();')
+        lines.append('\tfor (int i = 0; i < %d; i++) {' % iterations)
+        if name == 'stream':
+            lines.append('\t\tmemcpy(buffer, payload, sizeof(payload));')
+            lines.append('\t\tif (!%s(&p_%s, buffer, sizeof(payload) - 1))' % (function_name, name))
+            lines.append('\t\t\treturn 1;')
+        else:
+            lines.append('\t\tJsonParser* parser = json_parser_new();')
+            lines.append('\t\tif (!json_parser_load_from_data(parser, payload, sizeof(payload) - 1, NULL) ||')
+            lines.append('\t\t    !%s(&p_%s, json_node_get_object(json_parser_get_root(parser))))' % (
+                function_name, name))
+            lines.append('\t\t\treturn 1;')
+            lines.append('\t\tg_object_unref(parser);')
+        lines.append('\t}')
+        lines.append('\tprintf("%s %%f\\n", (g_get_monotonic_time() - start) * 1000.0 / %d);' % (name, iterations))
+    lines.append('\tg_free(buffer);')
+    lines.append('\treturn 0;')
+    lines.append('}')
+
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def parsers(work_dir: str, generator_args, fields_list: list, iterations: int, compiler: str):
+    """
+    generates, builds and runs a program that times each of the jsongen parser backends,
+    it needs glib and json-glib to be available through pkg-config
+    :return: the results for each backend
+    """
+    flags = subprocess.run(['pkg-config', '--cflags', '--libs', 'glib-2.0', 'json-glib-1.0'], check=True,
+                           stdout=subprocess.PIPE, text=True).stdout.split()
+
+    results = []
+    for fields in fields_list:
+        header = os.path.join(work_dir, 'parsers_%d.h' % fields)
+        synth_parser_header(header, fields)
+        generated = os.path.join(work_dir, 'parsers_%d%s' % (fields, jsongen.OUTPUT_SUFFIX))
+        jsongen.process(codegen.Job(header, generated), generator_args)
+
+        program = os.path.join(work_dir, 'parsers_%d.c' % fields)
+        synth_parser_program(program, header, generated, fields, iterations)
+        binary = os.path.join(work_dir, 'parsers_%d' % fields)
+        subprocess.run([compiler, '-O2', '-I', generator_args.headers, '-o', binary, program] + flags, check=True)
+        output = subprocess.run([binary], check=True, stdout=subprocess.PIPE, text=True).stdout
+        for line in output.splitlines():
+            backend, ns = line.split()
+            results.append({'backend': backend, 'parameters': {'fields': fields}, 'time': float(ns)})
+    return results
+
+
+def int_list(value: str):
+    return list(map(int, value.split(',')))
+
+
+def create_args():
+    parser = argparse.ArgumentParser(description='benchmark the generators with synthetic inputs, '
+                                                 'each size parameter takes a comma separated list to sweep')
+    parser.add_argument('--structs', type=int_list, default=[10, 50])
+    parser.add_argument('--fields', type=int_list, default=[10])
+    parser.add_argument('--depth', type=int_list, default=[0, 2])
+    parser.add_argument('--enum-size', type=int_list, default=[8])
+    parser.add_argument('--endpoints', type=int_list, default=[10, 80])
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of timed runs per generator, the fastest is reported')
+    parser.add_argument('--generators', type=str, default='sqlitegen,jsongen,rpcgen')
+    parser.add_argument('--headers', type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                      'include'))
+    codegen.add_preprocessor_args(parser)
+    parser.add_argument('--json', type=str, help='also write the results as json')
+    parser.add_argument('--startup', action='store_true',
+                        help='measure the start up time of each generator against --startup-budget instead')
+    parser.add_argument('--startup-budget', type=float, default=150,
+                        help='start up budget in milliseconds, exits with an error if a generator is over it')
+    parser.add_argument('--parsers', action='store_true',
+                        help='time parsing with each of the jsongen parser backends for each of --fields instead, '
+                             'needs a compiler and glib and json-glib')
+    parser.add_argument('--parser-iterations', type=int, default=100000)
+    parser.add_argument('--cc', type=str, default=os.environ.get('CC', 'cc'))
+    return parser
+
+
+if __name__ == '__main__':
+    args = create_args().parse_args()
+    selected = args.generators.split(',')
+
+    if args.startup:
+        with tempfile.TemporaryDirectory() as work_dir:
+            sys.exit(0 if startup(work_dir, args.headers, args.repeat, args.startup_budget / 1000) else 1)
+
+    header_generators = {
+        'sqlitegen': sqlitegen,
+        'jsongen': jsongen
+    }
+
+    # the arguments the generators would have been run with, without a cache so every run parses
+    generator_args = codegen.create_args(TAG).parse_args(['--headers', args.headers,
+                                                          '--preprocessor', args.preprocessor])
+    generator_args.cache_dir = None
+
+    if args.parsers:
+        with tempfile.TemporaryDirectory() as work_dir:
+            parser_results = parsers(work_dir, generator_args, args.fields, args.parser_iterations, args.cc)
+        print('%-10s %-20s %15s' % ('backend', 'parameters', 'time (ns)'))
+        for result in parser_results:
+            parameters = ' '.join(map(lambda p: '%s=%d' % p, result['parameters'].items()))
+            print('%-10s %-20s %15.1f' % (result['backend'], parameters, result['time']))
+        if args.json is not None:
+            with open(args.json, 'w') as f:
+                json.dump(parser_results, f, indent=2)
+                f.write('\n')
+        sys.exit(0)
+
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        for structs, fields, depth, enum_size in itertools.product(args.structs, args.fields, args.depth,
+                                                                   args.enum_size):
+            header = os.path.join(work_dir, 'bench_%d_%d_%d_%d.h' % (structs, fields, depth, enum_size))
+            synth_header(header, structs, fields, depth, enum_size)
+            for name in selected:
+                generator = header_generators.get(name)
+                if generator is None:
+                    continue
+                job = codegen.Job(header, os.path.join(work_dir, 'out' + generator.OUTPUT_SUFFIX))
+                elapsed, run_stats, peak = measure(generator, job, generator_args, args.repeat)
+                results.append({'generator': name,
+                                'parameters': {'structs': structs, 'fields': fields, 'depth': depth,
+                                               'enum_size': enum_size},
+                                'time': elapsed, 'peak_memory': peak, 'stats': run_stats})
+
+        if 'rpcgen' in selected:
+            for endpoints in args.endpoints:
+                spec = os.path.join(work_dir, 'bench_%d.json' % endpoints)
+                synth_rpc(spec, endpoints)
+                job = codegen.Job(spec, os.path.join(work_dir, 'out.rpc.h'))
+                elapsed, run_stats, peak = measure(rpcgen, job, generator_args, args.repeat)
+                results.append({'generator': 'rpcgen', 'parameters': {'endpoints': endpoints},
+                                'time': elapsed, 'peak_memory': peak, 'stats': run_stats})
+
+    print('%-10s %-50s %10s %10s' % ('generator', 'parameters', 'time (ms)', 'peak (KiB)'))
+    for result in results:
+        parameters = ' '.join(map(lambda p: '%s=%d' % p, result['parameters'].items()))
+        print('%-10s %-50s %10.2f %10d' % (result['generator'], parameters, result['time'] * 1000,
+                                            result['peak_memory'] / 1024))
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+            f.write('\n')
@@ -1,8 +1,81 @@
-from pycparser import parse_file
-from pycparser.c_ast import Typedef, TypeDecl, Struct, Decl, IdentifierType, PtrDecl
-from pycparser.c_ast import Enum as CEnum
+from __future__ import annotations
+from abc import ABC, abstractmethod
 from enum import Enum
 import argparse
+import io
+import json
+import os
+import re
+import sys
+import time
+import traceback
+from contextlib import contextmanager
+from typing import TYPE_CHECKING
+
+# pycparser, and the parser tables in particular, take a noticeable amount of
+# time to import. They're only imported when needed so that rpcgen and runs
+# where every input comes from the ast cache don't pay for them.
+if TYPE_CHECKING:
+    from pycparser.c_ast import Decl, Struct
+
+
+# 0 is silent, 1 reports what is being processed, 2 and above reports everything walked
+verbosity = 0
+
+
+def info(message: str):
+    if verbosity >= 1:
+        print(message)
+
+
+def debug(message: str):
+    if verbosity >= 2:
+        print(message)
+
+
+class Stats:
+    """
+    wall time spent in each phase of generating an output and counts of
+    what was found and generated along the way. Phases can be nested but
+    the one they are nested in is paused until they finish so the time
+    isn't counted twice.
+    """
+    __slots__ = ['timings', 'counters', '__running']
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.timings = {}
+        self.counters = {}
+        # the phase that's running and when it was started or last resumed
+        self.__running = None
+
+    def add_time(self, name: str, seconds: float):
+        self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+    @contextmanager
+    def phase(self, name: str):
+        outer = self.__running
+        now = time.perf_counter()
+        if outer is not None:
+            self.add_time(outer[0], now - outer[1])
+        self.__running = (name, now)
+        try:
+            yield
+        finally:
+            now = time.perf_counter()
+            self.add_time(name, now - self.__running[1])
+            self.__running = None if outer is None else (outer[0], now)
+
+    def count(self, name: str, n: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def to_dict(self):
+        return {'timings': dict(self.timings), 'counters': dict(self.counters)}
+
+
+stats = Stats()
 
 
 def annotation_type_from_field_name(field_name: str):
@@ -21,11 +94,55 @@ class AnnotatedStruct:
 
 
 class FieldAnnotation:
+    __slots__ = ['annotation_type', 'field_name', 'parameters']
+
     def __init__(self, field_name):
-        self.annotation_type = annotation_type_from_field_name(field_name)
-        all_parameters = annotation_parameters_from_field_name(field_name)
-        self.field_name = all_parameters[0]
-        self.parameters = all_parameters[1:]
+        parts = field_name[2:].split('_')
+        self.annotation_type = parts[1]
+        self.field_name = parts[2]
+        self.parameters = parts[3:]
+
+
+class AnnotationIndex:
+    """
+    the annotations of a struct by the field they are for and their type. It's
+    built once when the struct is walked and shared by everything that uses the
+    struct so it must not be modified. Iterating it gives all of the annotations
+    in the order they were found.
+    orphans are the annotations for fields that the struct doesn't have.
+    """
+    __slots__ = ['__annotations', '__by_field', '__by_field_and_type', 'orphans']
+
+    def __init__(self, fields: list, annotations: list):
+        self.__annotations = tuple(annotations)
+        by_field = {}
+        self.__by_field_and_type = {}
+        for annotation in annotations:
+            by_field.setdefault(annotation.field_name, []).append(annotation)
+            # if there's more than one of a type for a field the last one wins
+            self.__by_field_and_type[(annotation.field_name, annotation.annotation_type)] = annotation
+        self.__by_field = dict(map(lambda item: (item[0], tuple(item[1])), by_field.items()))
+
+        field_names = set(map(lambda f: f.field_name, fields))
+        self.orphans = tuple(filter(lambda a: a.field_name not in field_names, annotations))
+
+    def __iter__(self):
+        return iter(self.__annotations)
+
+    def __len__(self):
+        return len(self.__annotations)
+
+    def for_field(self, field_name: str):
+        """
+        :return: all of the annotations for a field
+        """
+        return self.__by_field.get(field_name, ())
+
+    def get(self, field_name: str, annotation_type: str):
+        """
+        :return: the annotation of a type for a field or None
+        """
+        return self.__by_field_and_type.get((field_name, annotation_type))
 
 
 class FieldType(Enum):
@@ -38,7 +155,11 @@ class FieldType(Enum):
 class Field:
     __slots__ = ['field', 'field_name', 'type', 'c_type', 'struct', 'enum', 'fields_and_annotations']
 
-    def __init__(self, field: Decl, ast, tag, annotation_types):
+    def __init__(self, field: Decl, index, tag, annotation_types):
+        c_ast = pycparser_module('c_ast')
+        TypeDecl, Struct, IdentifierType, PtrDecl = c_ast.TypeDecl, c_ast.Struct, c_ast.IdentifierType, c_ast.PtrDecl
+        CEnum = c_ast.Enum
+
         self.field = field
         self.field_name = field.name
 
@@ -51,12 +172,12 @@ class Field:
             elif decl_type == Struct:
                 self.type = FieldType.STRUCT
                 self.c_type = field.type.type.name
-                self.struct = struct_by_name(ast, self.c_type)
-                self.fields_and_annotations = walk_struct(ast, tag, self.struct, annotation_types)
+                self.struct = struct_by_name(index, self.c_type)
+                self.fields_and_annotations = walk_struct(index, tag, self.struct, annotation_types)
             elif decl_type == CEnum:
                 self.type = FieldType.ENUM
                 self.c_type = field.type.type.name
-                self.enum = enum_by_name(ast, self.c_type)
+                self.enum = enum_by_name(index, self.c_type)
             else:
                 field.show()
                 assert False, ("TypeDecl type %s not handled" % decl_type)
@@ -67,6 +188,55 @@ class Field:
             assert False, ("field type %s not handled" % (type(field.type)))
 
 
+class SymbolIndex:
+    """
+    index of the top level symbols in a translation unit, built in a single pass
+    so that lookups by name don't have to rescan the whole ast. Also holds the
+    results of walk_struct so each struct is only walked once per tag.
+    tags is the list of annotation tags whose barriers were defined when the
+    translation unit was parsed, the annotations of the other tags are ignored
+    when walking a struct for one of them.
+    """
+    __slots__ = ['ast', 'tags', 'structs', 'enums', 'typedefs', '__walked']
+
+    def __init__(self, ast, tags: list = []):
+        self.ast = ast
+        self.tags = tags
+        self.structs = {}
+        self.enums = {}
+        self.typedefs = {}
+        self.__walked = {}
+
+        c_ast = pycparser_module('c_ast')
+        Typedef, Struct, Decl, CEnum = c_ast.Typedef, c_ast.Struct, c_ast.Decl, c_ast.Enum
+
+        for child in ast.ext:
+            child_type = type(child)
+            if child_type is Decl:
+                decl_type = type(child.type)
+                if decl_type is Struct:
+                    # prefer the definition over any forward declarations
+                    if child.type.decls is not None or child.type.name not in self.structs:
+                        self.structs[child.type.name] = child.type
+                elif decl_type is CEnum:
+                    if child.type.values is not None or child.type.name not in self.enums:
+                        self.enums[child.type.name] = child.type
+            elif child_type is Typedef:
+                self.typedefs[child.name] = child
+
+    def is_foreign_annotation(self, tag: str, field_name: str):
+        for t in self.tags:
+            if t != tag and field_name.startswith('__%s' % t):
+                return True
+        return False
+
+    def walked(self, tag: str, struct: Struct):
+        return self.__walked.get((tag, struct))
+
+    def set_walked(self, tag: str, struct: Struct, fields_and_annotations):
+        self.__walked[(tag, struct)] = fields_and_annotations
+
+
 class Argument:
     __slots__ = ['name', 'c_type']
 
@@ -75,64 +245,156 @@ class Argument:
         self.c_type = c_type
 
 
-class CodeBlock:
+class CodeNode(ABC):
+    """
+    a node in the tree a CodeBlock builds before it is serialized
+    """
+    __slots__ = []
+
+    @abstractmethod
+    def serialize(self, indent: int, out: list):
+        pass
+
+
+class CodeRaw(CodeNode):
+    """
+    text that is written as is, without indenting
+    """
+    __slots__ = ['text']
+
+    def __init__(self, text: str):
+        self.text = text
+
+    def serialize(self, indent: int, out: list):
+        out.append(self.text)
+
+
+class CodeLine(CodeNode):
+    __slots__ = ['text']
+
+    def __init__(self, text: str):
+        self.text = text
+
+    def serialize(self, indent: int, out: list):
+        out.append('\t' * indent)
+        out.append(self.text)
+        out.append('\n')
+
+
+class CodeStatement(CodeLine):
+    def serialize(self, indent: int, out: list):
+        out.append('\t' * indent)
+        out.append(self.text)
+        out.append(';\n')
+
+    def goto_target(self):
+        if self.text.startswith('goto '):
+            return self.text[5:].strip()
+        return None
+
+
+class CodeLabel(CodeLine):
+    def serialize(self, indent: int, out: list):
+        out.append('\t' * indent)
+        out.append(self.text)
+        out.append(':\n')
+
+
+class CodeScope(CodeNode):
     class Type(Enum):
         NORMAL = 0
         CONDITION = 1
+        ELSE = 2
+        SWITCH = 3
+        CASE = 4
+
+    __slots__ = ['prefix', 'scope_type', 'terminate', 'children']
+
+    def __init__(self, prefix: str = '', scope_type=Type.NORMAL):
+        self.prefix = prefix
+        self.scope_type = scope_type
+        self.terminate = False
+        self.children = []
+
+    def serialize(self, indent: int, out: list):
+        tabs = '\t' * indent
+        out.append(tabs)
+        out.append(self.prefix)
+        out.append('{\n')
+        for child in self.children:
+            child.serialize(indent + 1, out)
+        out.append(tabs)
+        out.append('};\n' if self.terminate else '}\n')
+
+    def remove_dead_gotos(self):
+        """
+        removes gotos that jump to a label that directly follows them
+        """
+        children = []
+        for i, child in enumerate(self.children):
+            if type(child) is CodeStatement and i + 1 < len(self.children):
+                target = child.goto_target()
+                following = self.children[i + 1]
+                if target is not None and type(following) is CodeLabel and following.text == target:
+                    continue
+            if type(child) is CodeScope:
+                child.remove_dead_gotos()
+            children.append(child)
+        self.children = children
 
-    __slots__ = ['indent', '__original_indent',
-                 '__block_type', '__parent', '__sub_block',
-                 'output_file']
 
-    def __init__(self, output_file, indent: int = 0, block_type=Type.NORMAL, parent=None):
-        self.indent = indent
-        self.__original_indent = indent
+class CodeBlock:
+    """
+    builds a tree of scopes, conditions, statements and labels in memory
+    that is serialized to the output file in a single write by flush()
+    """
+    Type = CodeScope.Type
 
-        self.__block_type = block_type
-        self.__parent = parent
-        self.__sub_block = None
+    __slots__ = ['indent', '__root', '__stack', 'output_file']
 
-        self.output_file = output_file
+    def __init__(self, output_file, indent: int = 0):
+        self.indent = indent
+        self.__root = CodeScope()
+        self.__stack = [self.__root]
 
-    # indent handling
+        self.output_file = output_file
 
-    def __do_indent(self):
-        tabs = '\t' * self.indent
-        self.output_file.write(tabs)
+    # tree handling
 
-    def __inc_indent(self):
-        self.indent += 1
+    def __current(self):
+        return self.__stack[-1]
 
-    def __dec_indent(self):
-        self.indent -= 1
-        assert self.indent >= self.__original_indent
+    def __append(self, node: CodeNode):
+        self.__stack[-1].children.append(node)
 
-    # block chaining
+    def __push(self, scope: CodeScope):
+        self.__append(scope)
+        self.__stack.append(scope)
 
-    def __get_active_block(self):
-        if self.__sub_block is not None:
-            return self.__sub_block.__get_active_block()
-        else:
-            return self
+    def __pop(self, *scope_types):
+        assert len(self.__stack) > 1, 'no open scope to close'
+        scope = self.__stack.pop()
+        assert len(scope_types) == 0 or scope.scope_type in scope_types, (
+                'expected to close a %s but %s is open' % (str(scope_types), scope.scope_type))
+        return scope
 
-    def __start_sub_block(self, block_type=Type.NORMAL):
-        self.__inc_indent()
-        self.__sub_block = CodeBlock(self.output_file, self.indent, block_type=block_type, parent=self)
+    def flush(self):
+        """
+        serializes everything added so far to the output file and starts a new tree
+        """
+        assert len(self.__stack) == 1, ('%d scopes still open' % (len(self.__stack) - 1))
+        with stats.phase('emit'):
+            self.__root.remove_dead_gotos()
+            out = []
+            for child in self.__root.children:
+                child.serialize(self.indent, out)
+            self.output_file.write(''.join(out))
+        self.__root.children = []
 
-    def __close_sub_block(self):
-        assert self.__parent is not None
-        cb = self.__parent
-        cb.__dec_indent()
-        cb.__do_indent()
-        cb.output_file.write('}\n')
-        cb.__sub_block = None
+    # scopes
 
     def start_scope(self, prefix=None):
-        self.__do_indent()
-        if prefix is not None:
-            self.output_file.write(prefix)
-        self.output_file.write('{\n')
-        self.__inc_indent()
+        self.__push(CodeScope(prefix if prefix is not None else ''))
 
     def __flatten_args(self, args: [Argument]):
         flattened_args = 'void'
@@ -144,94 +406,90 @@ class CodeBlock:
         return 'static ' if static else ''
 
     def function_prototype(self, name, rtype: str = 'void', static=False, args: [Argument] = None):
-        self.__do_indent()
-        self.output_file.write('%s%s %s(%s);\n' % (self.__static(static), rtype, name, self.__flatten_args(args)))
+        stats.count('prototypes')
+        self.__append(CodeLine('%s%s %s(%s);' % (self.__static(static), rtype, name, self.__flatten_args(args))))
 
     def start_function(self, name, rtype: str = 'void', static=False, args: [Argument] = None,
                        attributes: [str] = ['unused']):
+        stats.count('functions')
         attributes_string = ' '.join(map(lambda a: '__attribute__((%s))' % a, attributes))
         self.start_scope(
             '%s%s %s %s(%s)' % (self.__static(static), rtype, attributes_string, name, self.__flatten_args(args)))
 
     def end_scope(self, terminate=False):
-        self.__dec_indent()
-        self.__do_indent()
-        if terminate:
-            self.output_file.write('};\n')
-        else:
-            self.output_file.write('}\n')
+        scope = self.__pop(CodeScope.Type.NORMAL)
+        scope.terminate = terminate
 
     def end_function(self):
         self.end_scope()
 
     def add_statement(self, statement: str):
-        cb = self.__get_active_block()
-        cb.__do_indent()
-        cb.output_file.write('%s;\n' % statement)
+        self.__append(CodeStatement(statement))
 
     def add_include(self, path: str):
-        self.__do_indent()
-        self.output_file.write('#include <%s>\n' % path)
+        self.__append(CodeLine('#include <%s>' % path))
 
     def add_items(self, items: list):
         for item in items:
-            self.__do_indent()
-            self.output_file.write('%s,\n' % item)
+            self.__append(CodeLine('%s,' % item))
 
     def add_label(self, name: str):
-        self.__do_indent()
-        self.output_file.write('%s:\n' % name)
+        self.__append(CodeLabel(name))
 
     def add_break(self):
         self.add_statement('break')
 
+    def add_raw(self, text: str):
+        self.__append(CodeRaw(text))
+
     def write(self):
-        self.output_file.write('// empty code block\n\n')
+        self.add_raw('// empty code block\n\n')
+        self.flush()
 
     # comments
     def add_comment(self, comment):
-        self.__do_indent()
-        self.output_file.write('//%s\n' % comment)
+        self.__append(CodeLine('//%s' % comment))
 
     # conditions
     def start_condition(self, condition):
-        cb = self.__get_active_block()
-        assert cb.__sub_block is None
-        cb.__do_indent()
-        cb.output_file.write('if(%s){\n' % condition)
-        cb.__start_sub_block(block_type=CodeBlock.Type.CONDITION)
-
-    @staticmethod
-    def __alternative_condition(codeblock, condition):
-        codeblock.__close_sub_block()
-        # return to the parent and open up a new condition
-        codeblock = codeblock.__parent
-        codeblock.__do_indent()
-        codeblock.output_file.write('else if(%s){\n' % condition)
-        codeblock.__start_sub_block(block_type=CodeBlock.Type.CONDITION)
+        self.__push(CodeScope('if(%s)' % condition, CodeScope.Type.CONDITION))
 
     def alternative_condition(self, condition):
-        self.__alternative_condition(self.__get_active_block(), condition)
+        self.__pop(CodeScope.Type.CONDITION)
+        self.__push(CodeScope('else if(%s)' % condition, CodeScope.Type.CONDITION))
 
     def start_or_alternative(self, condition):
-        cb = self.__get_active_block()
-        if cb.__block_type == CodeBlock.Type.CONDITION:
-            self.__alternative_condition(cb, condition)
+        if self.__current().scope_type == CodeScope.Type.CONDITION:
+            self.alternative_condition(condition)
         else:
-            cb.start_condition(condition)
+            self.start_condition(condition)
 
     def add_else(self):
-        cb = self.__get_active_block()
-        cb.__close_sub_block()
-
-        cb = self.__get_active_block()
-        cb.__do_indent()
-        cb.output_file.write('else {\n')
-        cb.__start_sub_block()
+        self.__pop(CodeScope.Type.CONDITION)
+        self.__push(CodeScope('else ', CodeScope.Type.ELSE))
 
     def end_condition(self):
-        cb = self.__get_active_block()
-        cb.__close_sub_block()
+        self.__pop(CodeScope.Type.CONDITION, CodeScope.Type.ELSE)
+
+    # switches, each case gets its own scope so that it can declare variables
+    def start_switch(self, expression):
+        self.__push(CodeScope('switch(%s)' % expression, CodeScope.Type.SWITCH))
+
+    def start_case(self, value):
+        assert self.__current().scope_type == CodeScope.Type.SWITCH, 'case outside of a switch'
+        self.__push(CodeScope('case %s:' % value, CodeScope.Type.CASE))
+
+    def start_default(self):
+        assert self.__current().scope_type == CodeScope.Type.SWITCH, 'default outside of a switch'
+        self.__push(CodeScope('default:', CodeScope.Type.CASE))
+
+    def end_case(self, add_break=True):
+        if add_break:
+            self.add_break()
+        self.__pop(CodeScope.Type.CASE)
+
+    def end_switch(self):
+        self.__pop(CodeScope.Type.SWITCH)
 
 
 class HeaderBlock(CodeBlock):
@@ -243,22 +501,589 @@ class HeaderBlock(CodeBlock):
         self.input = input
 
     def write(self):
-        self.output_file.write("//generated by %s from %s\n" % (self.tag, self.input))
+        self.add_raw("//generated by %s from %s\n" % (self.tag, self.input))
+        self.flush()
+
+
+def c_char(c: int):
+    if c in b'\\\'':
+        return "'\\%s'" % chr(c)
+    if 0x20 <= c < 0x7f:
+        return "'%s'" % chr(c)
+    return "'\\x%02x'" % c
+
+
+def c_string(value: bytes):
+    escaped = []
+    for c in value:
+        if c in b'\\"':
+            escaped.append('\\%s' % chr(c))
+        elif 0x20 <= c < 0x7f:
+            escaped.append(chr(c))
+        else:
+            # octal so that the characters that follow can't be taken as part of the escape
+            escaped.append('\\%03o' % c)
+    return '"%s"' % ''.join(escaped)
+
+
+def __write_lookup(lookup: CodeBlock, candidates: list, length: int):
+    """
+    writes a switch on the character that best splits up keys of the same length,
+    recursing until there's a single candidate left that is then compared in full.
+    :param candidates: tuples of the name as bytes and the index to return for it
+    """
+    if len(candidates) == 1:
+        name, index = candidates[0]
+        lookup.start_condition('memcmp(key, %s, %d) == 0' % (c_string(name), length))
+        lookup.add_statement('return %d' % index)
+        lookup.end_condition()
+        return
+
+    position = max(range(length), key=lambda p: len(set(map(lambda c: c[0][p], candidates))))
+    groups = {}
+    for candidate in candidates:
+        groups.setdefault(candidate[0][position], []).append(candidate)
+
+    lookup.start_switch('key[%d]' % position)
+    for c, group in groups.items():
+        lookup.start_case(c_char(c))
+        __write_lookup(lookup, group, length)
+        lookup.end_case()
+    lookup.end_switch()
+
+
+def write_lookup(name: str, keys: list, output_file):
+    """
+    writes a function that maps a key to its index in keys with a switch on the length
+    of the key and then on its characters, so finding a key doesn't depend on how many there are.
+    :param keys: the keys as bytes
+    """
+    by_length = {}
+    for index, key in enumerate(keys):
+        by_length.setdefault(len(key), []).append((key, index))
+
+    lookup = CodeBlock(output_file=output_file)
+    lookup.start_function(name, static=True, rtype='int',
+                          args=[Argument('key', 'const gchar*'), Argument('length', 'gsize')])
+    lookup.start_switch('length')
+    for length in sorted(by_length):
+        lookup.start_case(length)
+        __write_lookup(lookup, by_length[length], length)
+        lookup.end_case()
+    lookup.end_switch()
+    lookup.add_statement('return -1')
+    lookup.end_function()
+    lookup.flush()
+
+
+class OutputFile(io.StringIO):
+    """
+    buffers generated code and only replaces the file at path when the
+    content has changed so that unchanged outputs keep their mtime and
+    don't trigger rebuilds of everything that includes them. The file is
+    replaced atomically so an interrupted run never leaves a partial output.
+    """
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            with stats.phase('write'):
+                if write_if_changed(self.path, self.getvalue()):
+                    stats.count('outputs_written')
+        return super().__exit__(exc_type, exc_value, tb)
+
+
+def write_if_changed(path: str, content: str):
+    """
+    :return: True if the file was written
+    """
+    try:
+        with open(path) as f:
+            if f.read() == content:
+                return False
+    except (FileNotFoundError, UnicodeDecodeError):
+        pass
+
+    directory, name = os.path.split(os.path.abspath(path))
+    tmp_path = os.path.join(directory, '.%s.%d.tmp' % (name, os.getpid()))
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return True
+
+
+def __escape_make(path: str):
+    return path.replace('$', '$$').replace('#', '\\#').replace(' ', '\\ ')
+
+
+def write_depfile(path: str, target: str, dependencies: list):
+    lines = ['%s:' % __escape_make(target)]
+    lines += list(map(lambda d: ' %s' % __escape_make(d), dependencies))
+    write_if_changed(path, ' \\\n'.join(lines) + '\n')
 
 
 def __fulltag(tag: str):
     return '__%s' % tag
 
 
-def parsefile(tag: str, input, headers):
-    barrier = '-D__%s' % tag.upper()
-    ast = parse_file(input, use_cpp=True,
-                     cpp_args=[barrier, '-I/usr/share/python3-pycparser/fake_libc_include',
-                               '-I%s' % headers])
+class AstCache:
+    """
+    on disk cache of parsed asts keyed by a hash of the preprocessed source,
+    the pycparser version and the tag barrier. The least recently used entries
+    are evicted once the cache grows past max_size bytes.
+    """
+    __slots__ = ['cache_dir', 'max_size']
+
+    # bump this if the format of the cached entries changes
+    VERSION = 1
+    SUFFIX = '.ast'
+
+    def __init__(self, cache_dir: str, max_size: int = 64 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(barrier: str, text: str):
+        import hashlib
+        h = hashlib.sha256()
+        h.update(('%d\0%s\0%s\0' % (AstCache.VERSION, pycparser_version(), barrier)).encode())
+        h.update(text.encode())
+        return h.hexdigest()
+
+    def __path(self, key: str):
+        return os.path.join(self.cache_dir, key + AstCache.SUFFIX)
+
+    def get(self, key: str):
+        import pickle
+
+        class AstUnpickler(pickle.Unpickler):
+            # unpickling would otherwise import the pycparser package for the modules of the ast
+            def find_class(self, module, name):
+                package, _, submodule = module.partition('.')
+                if package == 'pycparser' and submodule in PYCPARSER_AST_MODULES:
+                    return getattr(pycparser_module(submodule), name)
+                return super().find_class(module, name)
+
+        path = self.__path(key)
+        try:
+            with open(path, 'rb') as f:
+                ast = AstUnpickler(f).load()
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            # a truncated or stale entry, drop it and parse again
+            info('dropping bad cache entry %s: %s' % (path, e))
+            self.__remove(path)
+            return None
+        # mark as recently used for eviction
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # evicted by another process in the meantime
+            pass
+        return ast
+
+    def put(self, key: str, ast):
+        import pickle
+        import tempfile
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(ast, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.__path(key))
+        except BaseException:
+            self.__remove(tmp_path)
+            raise
+        self.evict()
+
+    def evict(self):
+        entries = []
+        total = 0
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if not entry.name.endswith(AstCache.SUFFIX):
+                    continue
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+                total += st.st_size
+
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_size:
+                break
+            self.__remove(path)
+            total -= size
+
+    @staticmethod
+    def __remove(path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def __barrier(tag: str):
+    return '__%s' % tag.upper()
+
+
+def __barrier_condition(expression: str, defined: list):
+    """
+    evaluates an #if that only tests barriers with some of them defined
+    :return: the value or None if it tests anything else
+    """
+    python = re.sub(r'defined\s*(?:\(\s*(\w+)\s*\)|(\w+))',
+                    lambda m: ' %s ' % ((m.group(1) or m.group(2)) in defined), expression)
+    python = python.replace('||', ' or ').replace('&&', ' and ').replace('!', ' not ')
+    tokens = re.findall(r'\w+|\S', python)
+    if len(tokens) == 0 or any(t not in ['True', 'False', 'or', 'and', 'not', '(', ')'] for t in tokens):
+        return None
+    try:
+        return eval(' '.join(tokens), {'__builtins__': {}})
+    except SyntaxError:
+        return None
+
+
+def barriers_are_additive(files: list, tags: list):
+    """
+    checks that the barriers for the tags are only used in #ifdef/#if defined()
+    blocks without an #else in any of the files, i.e. that defining all of them at
+    once only adds the annotations for each generator and doesn't remove or
+    change anything another generator would see. Conditionals that come out the
+    same for every generator, like defined(__A) || defined(__B), can have an #else.
+    :param files: the input and everything it includes, see included_files()
+    :param tags:
+    :return: True if the input can be preprocessed with all of the barriers defined
+    """
+    barriers = list(map(__barrier, tags))
+    # each generator on its own and all of them together
+    configurations = list(map(lambda b: [b], barriers)) + [barriers]
+
+    def uses_barrier(line):
+        for b in barriers:
+            if re.search(r'\b%s\b' % b, line):
+                return True
+        return False
+
+    def varies(expression):
+        if not uses_barrier(expression):
+            return False
+        values = set(map(lambda c: __barrier_condition(expression, c), configurations))
+        return len(values) != 1 or None in values
+
+    for path in files:
+        # each entry is True if the conditional depends on which barriers are defined
+        conditionals = []
+        try:
+            with open(path) as f:
+                lines = f.readlines()
+        except (OSError, UnicodeDecodeError) as e:
+            info('%s: %s, assuming the barriers are exclusive' % (path, e))
+            return False
+        for line in lines:
+            directive = re.match(r'\s*#\s*(\w+)(.*)', line)
+            if directive is None:
+                continue
+            name, rest = directive.groups()
+            if name in ['if', 'ifdef', 'ifndef']:
+                if name == 'ifdef':
+                    rest = 'defined %s' % rest
+                elif name == 'ifndef':
+                    rest = '!defined %s' % rest
+                barrier = varies(rest)
+                if barrier and '!' in rest:
+                    return False
+                conditionals.append(barrier)
+            elif name in ['else', 'elif']:
+                if len(conditionals) > 0 and conditionals[-1]:
+                    return False
+                if name == 'elif' and varies(rest):
+                    return False
+            elif name == 'endif':
+                if len(conditionals) > 0:
+                    conditionals.pop()
+    return True
+
+
+class MemoryAstCache:
+    """
+    keeps the most recently used asts in memory for long lived processes, in
+    front of the on disk cache if there is one
+    """
+    __slots__ = ['max_entries', '__entries']
+
+    def __init__(self, max_entries: int = 256):
+        from collections import OrderedDict
+        self.max_entries = max_entries
+        self.__entries = OrderedDict()
+
+    def get(self, key: str):
+        ast = self.__entries.get(key)
+        if ast is not None:
+            self.__entries.move_to_end(key)
+        return ast
+
+    def put(self, key: str, ast):
+        self.__entries[key] = ast
+        self.__entries.move_to_end(key)
+        while len(self.__entries) > self.max_entries:
+            self.__entries.popitem(last=False)
+
+
+# set by long lived processes to keep parsed asts in memory between runs
+memory_cache = None
+
+# symbol indexes by ast, entries go away along with the ast
+__symbol_indexes = None
+
+
+def symbol_index(ast, tags: list = []):
+    """
+    gets the SymbolIndex for an ast, reusing the one from an earlier call
+    for the same ast and tags so that walked structs stay walked for as long
+    as the ast is around (i.e. while it's in the memory cache).
+    """
+    global __symbol_indexes
+    if __symbol_indexes is None:
+        import weakref
+        __symbol_indexes = weakref.WeakKeyDictionary()
+
+    indexes = __symbol_indexes.get(ast)
+    if indexes is None:
+        indexes = {}
+        __symbol_indexes[ast] = indexes
+
+    key = tuple(tags)
+    index = indexes.get(key)
+    if index is None:
+        index = SymbolIndex(ast, tags)
+        indexes[key] = index
+    return index
+
+
+def included_files(text: str):
+    """
+    finds the files that went into some preprocessed source from the line markers cpp left in it.
+    :param text:
+    :return: the files in the order they were first included
+    """
+    files = {}
+    for match in re.finditer(r'^#\s*(?:line\s+)?\d+\s+"((?:[^"\\]|\\.)*)"', text, re.MULTILINE):
+        path = re.sub(r'\\(.)', r'\1', match.group(1))
+        # skip <built-in>, <command-line> etc
+        if not path.startswith('<'):
+            files[path] = True
+    return list(files)
+
+
+# the modules of pycparser that an ast is made of, neither of them imports anything else from pycparser
+PYCPARSER_AST_MODULES = ['c_ast', 'plyparser']
+
+
+def pycparser_module(name: str):
+    """
+    gets one of PYCPARSER_AST_MODULES without importing the pycparser package, which
+    imports the parser, so that an ast from the cache can be loaded and walked without it
+    """
+    full_name = 'pycparser.%s' % name
+    module = sys.modules.get(full_name)
+    if module is None:
+        import importlib.util
+        package = importlib.util.find_spec('pycparser')
+        spec = importlib.util.spec_from_file_location(
+            full_name, os.path.join(package.submodule_search_locations[0], name + '.py'))
+        module = importlib.util.module_from_spec(spec)
+        # if the package is imported later on it picks this up instead of loading it again
+        sys.modules[full_name] = module
+        spec.loader.exec_module(module)
+    return module
+
+
+__pycparser_version = None
+
+
+def pycparser_version():
+    """
+    gets the version of pycparser without importing it, importing the package
+    pulls in the parser which is what the ast cache is trying to avoid.
+    """
+    global __pycparser_version
+    if __pycparser_version is None:
+        import importlib.util
+        spec = importlib.util.find_spec('pycparser')
+        with open(spec.origin) as f:
+            match = re.search(r'^__version__\s*=\s*[\'"]([^\'"]+)[\'"]', f.read(), re.MULTILINE)
+        if match is not None:
+            __pycparser_version = match.group(1)
+        else:
+            import pycparser
+            __pycparser_version = pycparser.__version__
+    return __pycparser_version
+
+
+def parser_table_dir(cache: AstCache = None):
+    """
+    works out where pycparser's lexer and parser tables should live. If the tables
+    that come with pycparser can be imported they are used, otherwise ply would
+    regenerate them on every run so they are kept in a directory versioned by the
+    pycparser version under the cache directory, or the user's cache directory if
+    there isn't one.
+    :return: the directory or None to use the tables that come with pycparser
+    """
+    import importlib.util
+    if importlib.util.find_spec('pycparser.yacctab') is not None and \
+            importlib.util.find_spec('pycparser.lextab') is not None:
+        return None
+
+    if cache is not None:
+        base = cache.cache_dir
+    else:
+        base = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'codegen')
+    return os.path.join(base, 'pycparser-%s' % pycparser_version())
+
+
+__parser = None
+
+
+def get_parser(table_dir: str = None):
+    """
+    gets the parser, it's only created once per process as building
+    it from the tables is expensive.
+    """
+    global __parser
+    if __parser is None:
+        from pycparser import CParser
+        if table_dir is None:
+            __parser = CParser()
+        else:
+            os.makedirs(table_dir, exist_ok=True)
+            # ply imports the tables as modules so they need to be on the path
+            if table_dir not in sys.path:
+                sys.path.append(table_dir)
+            __parser = CParser(lextab='codegen_lextab', yacctab='codegen_yacctab', taboutputdir=table_dir)
+    return __parser
+
+
+# pycparser's stand ins for the libc headers, searched before --headers
+FAKE_LIBC_INCLUDE = '/usr/share/python3-pycparser/fake_libc_include'
+
+
+def preprocess(input, cpp_args: list):
+    import subprocess
+    try:
+        return subprocess.check_output(['cpp'] + cpp_args + [input], universal_newlines=True)
+    except OSError as e:
+        raise RuntimeError('Unable to invoke cpp: %s' % e)
+
+
+__preprocessor = None
+
+
+def builtin_preprocess(input, defines: list, include_dirs: list):
+    """
+    preprocesses an input in process instead of running cpp. The preprocessor
+    is kept for the life of the process so included files are only preprocessed
+    once across all of the inputs in a batch.
+    :return: the preprocessed source or None if the input needs something only cpp can do
+    """
+    global __preprocessor
+    from preprocessor import Preprocessor, PreprocessorError
+    if __preprocessor is None:
+        __preprocessor = Preprocessor()
+    try:
+        return __preprocessor.preprocess(input, defines, include_dirs)
+    except PreprocessorError as e:
+        info('%s: %s, falling back to cpp' % (input, e))
+        stats.count('preprocessor_fallbacks')
+        return None
+
+
+def preprocessfile(tag: str, input, headers, extra_tags: list = [], preprocessor: str = 'cpp'):
+    """
+    preprocesses an input with the barriers for the tag and any extra tags defined.
+    :param preprocessor: cpp or builtin to preprocess in process, builtin falls back to
+    cpp for inputs it can't handle
+    """
+    defines = list(map(lambda t: __barrier(t), [tag] + extra_tags))
+    include_dirs = [FAKE_LIBC_INCLUDE, headers]
+    with stats.phase('cpp'):
+        text = None
+        if preprocessor == 'builtin':
+            text = builtin_preprocess(input, defines, include_dirs)
+        if text is None:
+            text = preprocess(input, list(map(lambda d: '-D%s' % d, defines)) +
+                              list(map(lambda d: '-I%s' % d, include_dirs)))
+    return text
+
+
+def parsefile(tag: str, input, headers, cache: AstCache = None, extra_tags: list = [], dependencies: list = None,
+              preprocessor: str = 'cpp', text: str = None):
+    """
+    preprocesses and parses an input with the barriers for the tag and any extra tags defined.
+    :param dependencies: if not None the files cpp read are appended to this list
+    :param preprocessor: cpp or builtin to preprocess in process, builtin falls back to
+    cpp for inputs it can't handle
+    :param text: the input already run through preprocessfile() with the same tags
+    """
+    barriers = list(map(lambda t: '-D%s' % __barrier(t), [tag] + extra_tags))
+    if text is None:
+        text = preprocessfile(tag, input, headers, extra_tags, preprocessor)
+    if dependencies is not None:
+        dependencies.extend(included_files(text))
+
+    key = None
+    if cache is not None or memory_cache is not None:
+        key = AstCache.key(' '.join(barriers), text)
+
+    if memory_cache is not None:
+        ast = memory_cache.get(key)
+        if ast is not None:
+            stats.count('memory_cache_hits')
+            return ast
+
+    if cache is not None:
+        with stats.phase('cache'):
+            ast = cache.get(key)
+        if ast is not None:
+            stats.count('cache_hits')
+            if memory_cache is not None:
+                memory_cache.put(key, ast)
+            return ast
+        stats.count('cache_misses')
+
+    with stats.phase('parser_setup'):
+        parser = get_parser(parser_table_dir(cache))
+    with stats.phase('parse'):
+        ast = parser.parse(text, input)
+
+    if cache is not None:
+        with stats.phase('cache'):
+            cache.put(key, ast)
+    if memory_cache is not None:
+        memory_cache.put(key, ast)
     return ast
 
 
+def create_cache(args):
+    if args.cache_dir is None:
+        return None
+    return AstCache(args.cache_dir, args.cache_size * 1024 * 1024)
+
+
 def find_annotated_structs(tag: str, annotation_types: list, ast):
+    Typedef = pycparser_module('c_ast').Typedef
+
     annotated_structs = []
 
     for child in ast.ext:
@@ -274,68 +1099,244 @@ def find_annotated_structs(tag: str, annotation_types: list, ast):
 
                 parameters = name_parts[2:]
                 annotated_structs.append(AnnotatedStruct(struct_name, annotation_type, parameters))
-                print("%s : %s -> %s" % (struct_name, annotation_type, str(parameters)))
+                stats.count('annotated_structs')
+                debug("%s : %s -> %s" % (struct_name, annotation_type, str(parameters)))
 
     return annotated_structs
 
 
-def find_structs(ast, callback, data):
+def find_structs(index: SymbolIndex, callback, data):
     outputs = []
-    for child in ast.ext:
-        if type(child) is Decl:
-            if type(child.type) is Struct:
-                callback(ast, child.type, data, outputs)
+    for struct in index.structs.values():
+        callback(index, struct, data, outputs)
 
     return outputs
 
 
-def walk_struct(ast, tag: str, struct: Struct, annotation_types=[]):
+def walk_struct(index: SymbolIndex, tag: str, struct: Struct, annotation_types=[]):
     """
     walks a struct to find fields and annotations.
-    :param ast:
+    The result is cached in the index so each struct is only walked once per tag,
+    callers must not modify the returned list.
+    :param index:
     :param tag:
     :param struct:
     :param annotation_types:
-    :return: a tuple of the fields and annotations that were found
+    :return: a tuple of the fields and an AnnotationIndex of the annotations that were found
     """
+    fields_and_annotations = index.walked(tag, struct)
+    if fields_and_annotations is not None:
+        return fields_and_annotations
+
     annotations = []
     fields = []
 
     # bucket the fields and the annotations
     for field in struct:
         if field.name.startswith(__fulltag(tag)):
-            print("found annotation %s" % field.name)
-            assert annotation_type_from_field_name(field.name) in annotation_types
-            annotations.append(FieldAnnotation(field.name))
+            debug("found annotation %s" % field.name)
+            annotation = FieldAnnotation(field.name)
+            assert annotation.annotation_type in annotation_types
+            annotations.append(annotation)
+        elif index.is_foreign_annotation(tag, field.name):
+            continue
         else:
-            print("found field %s" % field.name)
-            fields.append(Field(field, ast, tag, annotation_types))
+            debug("found field %s" % field.name)
+            fields.append(Field(field, index, tag, annotation_types))
+
+    stats.count('structs')
+    stats.count('fields', len(fields))
+    stats.count('annotations', len(annotations))
+
+    annotation_index = AnnotationIndex(fields, annotations)
+    assert len(annotation_index.orphans) == 0, \
+        'have %d orphan annotations in %s: %s' % (len(annotation_index.orphans), struct.name,
+                                                  ', '.join(map(lambda a: a.field_name, annotation_index.orphans)))
+
+    fields_and_annotations = (fields, annotation_index)
+    index.set_walked(tag, struct, fields_and_annotations)
+    return fields_and_annotations
+
+
+def struct_by_name(index: SymbolIndex, name: (str)):
+    return index.structs.get(name)
+
+
+def enum_by_name(index: SymbolIndex, name: (str)):
+    return index.enums.get(name)
+
+
+def add_cache_args(parser: argparse.ArgumentParser):
+    parser.add_argument('--cache-dir', type=str, default=os.environ.get('CODEGEN_CACHE_DIR'),
+                        help='directory to cache parsed headers in')
+    parser.add_argument('--cache-size', type=int, default=64,
+                        help='maximum size of the cache in MiB')
 
-    return fields, annotations
 
+def add_preprocessor_args(parser: argparse.ArgumentParser):
+    parser.add_argument('--preprocessor', type=str, choices=['cpp', 'builtin'],
+                        default=os.environ.get('CODEGEN_PREPROCESSOR', 'cpp'),
+                        help='preprocess with cpp or in process, builtin falls back to cpp '
+                             'for inputs it can\'t handle')
 
-def struct_by_name(ast, name: (str)):
-    print('looking for struct %s' % name)
-    for child in ast:
-        if type(child) is Decl:
-            if type(child.type) is Struct:
-                if child.type.name == name:
-                    print('found struct %s' % name)
-                    return child.type
-    return None
 
+def add_jobs_args(parser: argparse.ArgumentParser):
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(),
+                        help='number of processes to use when processing more than one input')
 
-def enum_by_name(ast, name: (str)):
-    print('looking for enum %s' % name)
-    for child in ast:
-        if type(child) is Decl and type(child.type) is CEnum:
-            return child.type
-    return None
+
+def add_output_args(parser: argparse.ArgumentParser):
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help='report what is being processed, repeat to report everything that is found')
+    parser.add_argument('--stats', '--profile', type=str, dest='stats',
+                        help='write the time spent in each phase and counts of what was processed as json')
+
+
+class Job:
+    """
+    a single input to generate an output from, and optionally the
+    depfile to write the files the input depended on to.
+    """
+    __slots__ = ['input', 'output', 'depfile']
+
+    def __init__(self, input: str, output: str, depfile: str = None):
+        self.input = input
+        self.output = output
+        self.depfile = depfile
 
 
 def create_args(tag: str):
     parser = argparse.ArgumentParser(description='%s code gen' % tag)
-    parser.add_argument('--input', type=str, required=True)
-    parser.add_argument('--output', type=str, required=True)
+    parser.add_argument('--input', type=str)
+    parser.add_argument('--output', type=str)
+    parser.add_argument('--depfile', type=str,
+                        help='write a make style depfile listing the files the input depends on')
+    parser.add_argument('--pair', type=str, nargs=2, action='append', default=[], metavar=('INPUT', 'OUTPUT'),
+                        help='an input and the output to generate from it, can be repeated')
+    parser.add_argument('--manifest', type=str,
+                        help='file with an input, output and optional depfile separated by whitespace on each line')
     parser.add_argument('--headers', type=str, required=True)
+    add_preprocessor_args(parser)
+    add_cache_args(parser)
+    add_jobs_args(parser)
+    add_output_args(parser)
     return parser
+
+
+def read_manifest(path: str):
+    jobs = []
+    with open(path) as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if len(line) == 0 or line.startswith('#'):
+                continue
+            parts = line.split()
+            if len(parts) not in [2, 3]:
+                raise ValueError('%s:%d: expected an input, an output and an optional depfile' % (path, line_number))
+            jobs.append(Job(*parts))
+    return jobs
+
+
+def jobs_from_args(parser: argparse.ArgumentParser, args):
+    """
+    collects the jobs from the single --input/--output pair, any --pair
+    arguments and the manifest in that order.
+    """
+    jobs = []
+    if args.input is not None or args.output is not None:
+        if args.input is None or args.output is None:
+            parser.error('--input and --output must be used together')
+        jobs.append(Job(args.input, args.output, args.depfile))
+    elif args.depfile is not None:
+        parser.error('--depfile can only be used with --input/--output')
+    for pair in args.pair:
+        jobs.append(Job(*pair))
+    if args.manifest is not None:
+        jobs.extend(read_manifest(args.manifest))
+    if len(jobs) == 0:
+        parser.error('nothing to do, use --input/--output, --pair or --manifest')
+    return jobs
+
+
+def __run_job(process, job: Job, args):
+    global verbosity
+    verbosity = args.verbose
+    stats.reset()
+    error = None
+    # not a phase as the phases are all inside it
+    start = time.perf_counter()
+    try:
+        process(job, args)
+    except Exception:
+        error = traceback.format_exc()
+    stats.add_time('total', time.perf_counter() - start)
+    return error, stats.to_dict()
+
+
+def __write_stats(path: str, jobs: list, results: list, elapsed: float):
+    total = Stats()
+    inputs = []
+    for job, (error, job_stats) in zip(jobs, results):
+        inputs.append({'input': job.input, 'output': job.output, 'ok': error is None,
+                       'timings': job_stats['timings'], 'counters': job_stats['counters']})
+        for name, value in job_stats['timings'].items():
+            total.add_time(name, value)
+        for name, value in job_stats['counters'].items():
+            total.count(name, value)
+    total.count('inputs', len(jobs))
+
+    summary = total.to_dict()
+    summary['wall'] = elapsed
+    with open(path, 'w') as f:
+        json.dump({'total': summary, 'inputs': inputs}, f, indent=2)
+        f.write('\n')
+
+
+def run_jobs(process, jobs: list, args):
+    """
+    calls process(job, args) for each job. More than one job is fanned out
+    over a pool of up to args.jobs processes, errors are reported per input in the
+    order the jobs were given.
+    :return: the number of jobs that failed
+    """
+    global verbosity
+    verbosity = args.verbose
+    start = time.perf_counter()
+
+    workers = min(max(args.jobs or 1, 1), len(jobs))
+
+    if workers == 1:
+        results = list(map(lambda job: __run_job(process, job, args), jobs))
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = list(map(lambda job: executor.submit(__run_job, process, job, args), jobs))
+            results = list(map(lambda future: future.result(), futures))
+
+    failed = 0
+    for job, (error, job_stats) in zip(jobs, results):
+        if error is not None:
+            failed += 1
+            print('error processing %s -> %s\n%s' % (job.input, job.output, error), file=sys.stderr)
+
+    if args.stats is not None:
+        __write_stats(args.stats, jobs, results, time.perf_counter() - start)
+
+    if len(jobs) > 1:
+        info('processed %d inputs, %d failed' % (len(jobs), failed))
+    return failed
+
+
+def run(tag: str, process, argv: list = None):
+    """
+    parses the arguments for a generator and runs it
+    :return: the exit status
+    """
+    parser = create_args(tag)
+    args = parser.parse_args(argv)
+    jobs = jobs_from_args(parser, args)
+    return 1 if run_jobs(process, jobs, args) != 0 else 0
+
+
+def main(tag: str, process):
+    sys.exit(run(tag, process))
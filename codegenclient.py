@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+# This is run for every generated file so it only uses modules that are cheap
+# to import, the generators themselves are already loaded in the server.
+
+import json
+import os
+import socket
+import sys
+
+generators = ['sqlitegen', 'jsongen', 'rpcgen', 'rpcroutergen', 'multigen']
+
+
+def default_socket_path():
+    path = os.environ.get('CODEGEN_SOCKET')
+    if path is not None:
+        return path
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir is not None:
+        return os.path.join(runtime_dir, 'codegen.sock')
+    return '/tmp/codegen-%d.sock' % os.getuid()
+
+
+def send_message(sock: socket.socket, message: dict):
+    sock.sendall(json.dumps(message).encode() + b'\n')
+
+
+def receive_message(sock_file):
+    line = sock_file.readline()
+    if len(line) == 0:
+        return None
+    return json.loads(line)
+
+
+def request(path: str, generator: str, argv: list):
+    """
+    asks the server at path to run a generator as if it was run with argv from the current directory
+    :return: the response or None if there isn't a server
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        sock.close()
+        return None
+
+    with sock, sock.makefile('rb') as sock_file:
+        send_message(sock, {'generator': generator, 'argv': argv, 'cwd': os.getcwd()})
+        return receive_message(sock_file)
+
+
+def run_locally(generator: str, argv: list):
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), generator + '.py')
+    os.execv(sys.executable, [sys.executable, script] + argv)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in generators:
+        print('usage: %s <%s> [generator arguments]' % (sys.argv[0], '|'.join(generators)), file=sys.stderr)
+        sys.exit(2)
+
+    generator = sys.argv[1]
+    argv = sys.argv[2:]
+
+    response = request(default_socket_path(), generator, argv)
+    if response is None:
+        # no server running, do it the slow way
+        run_locally(generator, argv)
+
+    sys.stdout.write(response['stdout'])
+    sys.stderr.write(response['stderr'])
+    sys.exit(response['status'])
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+import codegen
+import codegenclient
+import jsongen
+import multigen
+import rpcgen
+import rpcroutergen
+import sqlitegen
+import argparse
+import io
+import os
+import signal
+import socketserver
+import sys
+import traceback
+from contextlib import redirect_stdout, redirect_stderr
+
+TAG = 'codegenserver'
+
+runners = {
+    'sqlitegen': lambda argv: codegen.run(sqlitegen.TAG, sqlitegen.process, argv),
+    'jsongen': lambda argv: codegen.run(jsongen.TAG, jsongen.process, argv),
+    'rpcgen': lambda argv: codegen.run(rpcgen.TAG, rpcgen.process, argv),
+    'rpcroutergen': rpcroutergen.run,
+    'multigen': multigen.run
+}
+
+
+def run_request(request: dict):
+    """
+    runs a generator as if it had been started with the arguments in the request
+    from the directory in the request, capturing anything it prints.
+    """
+    stdout = io.StringIO()
+    stderr = io.StringIO()
+    status = 1
+
+    cwd = os.getcwd()
+    verbosity = codegen.verbosity
+    argv = sys.argv
+    try:
+        os.chdir(request['cwd'])
+        # so usage and errors name the generator
+        sys.argv = [request['generator'] + '.py'] + request['argv']
+        with redirect_stdout(stdout), redirect_stderr(stderr):
+            try:
+                status = runners[request['generator']](request['argv'])
+            except SystemExit as e:
+                # argparse exits on bad arguments
+                status = e.code if isinstance(e.code, int) else 1
+            except Exception:
+                traceback.print_exc()
+    finally:
+        os.chdir(cwd)
+        codegen.verbosity = verbosity
+        sys.argv = argv
+
+    return {'status': status, 'stdout': stdout.getvalue(), 'stderr': stderr.getvalue()}
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        request = codegenclient.receive_message(self.rfile)
+        if request is None:
+            return
+        # checked before anything is read from it so a bad request still gets a response
+        if not isinstance(request, dict) or not isinstance(request.get('argv'), list) or \
+                not isinstance(request.get('cwd'), str):
+            response = {'status': 2, 'stdout': '', 'stderr': 'bad request\n'}
+        elif request.get('generator') not in runners:
+            response = {'status': 2, 'stdout': '', 'stderr': 'unknown generator %s\n' % request.get('generator')}
+        else:
+            codegen.info('%s %s' % (request['generator'], ' '.join(map(str, request['argv']))))
+            response = run_request(request)
+        codegenclient.send_message(self.connection, response)
+
+
+class Server(socketserver.UnixStreamServer):
+    """
+    requests are handled one at a time, the generators share global state
+    (the parser, stats, caches) and the working directory is changed for
+    each request.
+    """
+    request_queue_size = 128
+
+    def __init__(self, path: str, idle_timeout: float):
+        # the socket is created with only the owner able to connect, a chmod after
+        # binding would leave a window where anyone could
+        umask = os.umask(0o177)
+        try:
+            super().__init__(path, RequestHandler)
+        finally:
+            os.umask(umask)
+        self.timeout = idle_timeout if idle_timeout > 0 else None
+        self.idle = False
+
+    def handle_timeout(self):
+        self.idle = True
+
+
+def create_args():
+    parser = argparse.ArgumentParser(description='keeps the generators loaded and runs them for codegenclient.py')
+    parser.add_argument('--socket', type=str, default=codegenclient.default_socket_path())
+    parser.add_argument('--memory-entries', type=int, default=256,
+                        help='number of parsed headers to keep in memory')
+    parser.add_argument('--idle-timeout', type=float, default=0,
+                        help='exit after this many seconds without a request, 0 to never exit')
+    parser.add_argument('-v', '--verbose', action='count', default=0)
+    codegen.add_cache_args(parser)
+    return parser
+
+
+if __name__ == '__main__':
+    args = create_args().parse_args()
+    codegen.verbosity = args.verbose
+    codegen.memory_cache = codegen.MemoryAstCache(args.memory_entries)
+
+    # the requests default to the cache the server was started with
+    if args.cache_dir is not None:
+        os.environ['CODEGEN_CACHE_DIR'] = args.cache_dir
+
+    if os.path.exists(args.socket):
+        if codegenclient.request(args.socket, None, []) is not None:
+            print('%s is already running on %s' % (TAG, args.socket), file=sys.stderr)
+            sys.exit(1)
+        # a stale socket from a server that didn't exit cleanly
+        os.remove(args.socket)
+
+    server = Server(args.socket, args.idle_timeout)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    codegen.info('%s listening on %s' % (TAG, args.socket))
+    try:
+        while not server.idle:
+            server.handle_request()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(args.socket)
@@ -0,0 +1,63 @@
+#pragma once
+
+#include <glib.h>
+
+/*
+ * A bump allocator for the parsers jsongen generates with arena. The strings and blobs for a whole
+ * struct are copied into a single allocation from it so the json can be freed as soon as it has
+ * been parsed, and everything that was parsed is freed at once with jsongen_arena_reset().
+ */
+
+struct jsongen_arena_block {
+	struct jsongen_arena_block* next;
+	gsize size;
+	gchar data[];
+};
+
+struct jsongen_arena {
+	/* the size of new blocks, allocations that are bigger get a block to themselves */
+	gsize block_size;
+	/* the block being allocated from is at the head */
+	struct jsongen_arena_block* blocks;
+	gsize used;
+};
+
+static inline void jsongen_arena_init(struct jsongen_arena* arena, gsize block_size) {
+	arena->block_size = block_size;
+	arena->blocks = NULL;
+	arena->used = 0;
+}
+
+static inline gpointer jsongen_arena_alloc(struct jsongen_arena* arena, gsize size) {
+	if (arena->blocks == NULL || arena->blocks->size - arena->used < size) {
+		gsize block_size = MAX(arena->block_size, size);
+		struct jsongen_arena_block* block = g_malloc(sizeof(*block) + block_size);
+		block->next = arena->blocks;
+		block->size = block_size;
+		arena->blocks = block;
+		arena->used = 0;
+	}
+	gpointer ptr = arena->blocks->data + arena->used;
+	arena->used += size;
+	return ptr;
+}
+
+/* frees everything that has been allocated, the newest block is kept for the next allocations */
+static inline void jsongen_arena_reset(struct jsongen_arena* arena) {
+	if (arena->blocks == NULL)
+		return;
+	struct jsongen_arena_block* block = arena->blocks->next;
+	while (block != NULL) {
+		struct jsongen_arena_block* next = block->next;
+		g_free(block);
+		block = next;
+	}
+	arena->blocks->next = NULL;
+	arena->used = 0;
+}
+
+static inline void jsongen_arena_free(struct jsongen_arena* arena) {
+	jsongen_arena_reset(arena);
+	g_free(arena->blocks);
+	arena->blocks = NULL;
+}
@@ -0,0 +1,364 @@
+#pragma once
+
+#include <glib.h>
+#include <string.h>
+
+/*
+ * A pull reader for the parsers jsongen generates with stream. It reads the members of a json
+ * object straight from a buffer one at a time instead of building a tree of nodes first.
+ * Strings are unescaped in place and terminated so the buffer needs to be writable and have
+ * room for a terminator after the json, the strings in the parsed struct point into it.
+ */
+
+/* how deeply arrays and objects can be nested in the values that are skipped over */
+#define JSONGEN_READER_MAX_DEPTH 64
+
+enum jsongen_value_type {
+	JSONGEN_VALUE_NULL,
+	JSONGEN_VALUE_BOOLEAN,
+	JSONGEN_VALUE_INT,
+	JSONGEN_VALUE_DOUBLE,
+	JSONGEN_VALUE_STRING,
+	JSONGEN_VALUE_OBJECT,
+	JSONGEN_VALUE_ARRAY,
+};
+
+struct jsongen_value {
+	enum jsongen_value_type type;
+	gboolean boolean;
+	gint64 integer;
+	gdouble real;
+	/* points into the buffer */
+	const gchar* string;
+};
+
+struct jsongen_reader {
+	gchar* buffer;
+	gsize length;
+	gsize pos;
+	/* no members have been read from the object yet */
+	gboolean first;
+	gboolean closed;
+	gboolean failed;
+};
+
+static inline void jsongen_reader_init(struct jsongen_reader* reader, gchar* buffer, gsize length) {
+	memset(reader, 0, sizeof(*reader));
+	reader->buffer = buffer;
+	reader->length = length;
+	/* everything stops at the terminator so nothing needs to check the length */
+	buffer[length] = '\0';
+}
+
+static inline gchar jsongen_reader_peek(struct jsongen_reader* reader) {
+	while (reader->buffer[reader->pos] == ' ' || reader->buffer[reader->pos] == '\t' ||
+	       reader->buffer[reader->pos] == '\n' || reader->buffer[reader->pos] == '\r')
+		reader->pos++;
+	return reader->buffer[reader->pos];
+}
+
+static inline gboolean jsongen_reader_expect(struct jsongen_reader* reader, gchar c) {
+	if (jsongen_reader_peek(reader) != c)
+		return FALSE;
+	reader->pos++;
+	return TRUE;
+}
+
+static inline gint jsongen_reader_hex4(const gchar* p) {
+	gint value = 0;
+	for (int i = 0; i < 4; i++) {
+		gint digit = g_ascii_xdigit_value(p[i]);
+		if (digit < 0)
+			return -1;
+		value = (value << 4) | digit;
+	}
+	return value;
+}
+
+/* reads the string at the current position, unescaping it in place */
+static inline gboolean jsongen_reader_string(struct jsongen_reader* reader, gchar** string, gsize* length) {
+	if (!jsongen_reader_expect(reader, '"'))
+		return FALSE;
+
+	gchar* buffer = reader->buffer;
+	gsize start = reader->pos;
+	gsize in = start;
+	gsize out = start;
+	while (buffer[in] != '"') {
+		guchar c = buffer[in];
+		/* control characters, including the terminator, can't appear in strings */
+		if (c < 0x20)
+			return FALSE;
+		if (c != '\\') {
+			buffer[out++] = buffer[in++];
+			continue;
+		}
+		switch (buffer[in + 1]) {
+			case '"':
+			case '\\':
+			case '/':
+				buffer[out++] = buffer[in + 1];
+				break;
+			case 'b':
+				buffer[out++] = '\b';
+				break;
+			case 'f':
+				buffer[out++] = '\f';
+				break;
+			case 'n':
+				buffer[out++] = '\n';
+				break;
+			case 'r':
+				buffer[out++] = '\r';
+				break;
+			case 't':
+				buffer[out++] = '\t';
+				break;
+			case 'u': {
+				gint unit = jsongen_reader_hex4(buffer + in + 2);
+				if (unit < 0)
+					return FALSE;
+				gunichar codepoint = unit;
+				/* the strings are terminated, anything after an embedded one would be lost */
+				if (unit == 0)
+					return FALSE;
+				if (unit >= 0xdc00 && unit <= 0xdfff)
+					return FALSE;
+				if (unit >= 0xd800 && unit <= 0xdbff) {
+					if (buffer[in + 6] != '\\' || buffer[in + 7] != 'u')
+						return FALSE;
+					gint low = jsongen_reader_hex4(buffer + in + 8);
+					if (low < 0xdc00 || low > 0xdfff)
+						return FALSE;
+					codepoint = 0x10000 + ((unit - 0xd800) << 10) + (low - 0xdc00);
+					in += 6;
+				}
+				/* never longer than the escape it replaces */
+				out += g_unichar_to_utf8(codepoint, buffer + out);
+				in += 4;
+				break;
+			}
+			default:
+				return FALSE;
+		}
+		in += 2;
+	}
+
+	buffer[out] = '\0';
+	reader->pos = in + 1;
+	*string = buffer + start;
+	*length = out - start;
+	return TRUE;
+}
+
+static inline gboolean jsongen_reader_number(struct jsongen_reader* reader, struct jsongen_value* value) {
+	const gchar* start = reader->buffer + reader->pos;
+	const gchar* p = start;
+	gboolean integer = TRUE;
+
+	if (*p == '-')
+		p++;
+	if (*p == '0')
+		p++;
+	else if (g_ascii_isdigit(*p)) {
+		while (g_ascii_isdigit(*p))
+			p++;
+	} else
+		return FALSE;
+	if (*p == '.') {
+		integer = FALSE;
+		p++;
+		if (!g_ascii_isdigit(*p))
+			return FALSE;
+		while (g_ascii_isdigit(*p))
+			p++;
+	}
+	if (*p == 'e' || *p == 'E') {
+		integer = FALSE;
+		p++;
+		if (*p == '+' || *p == '-')
+			p++;
+		if (!g_ascii_isdigit(*p))
+			return FALSE;
+		while (g_ascii_isdigit(*p))
+			p++;
+	}
+
+	if (integer) {
+		value->type = JSONGEN_VALUE_INT;
+		value->integer = g_ascii_strtoll(start, NULL, 10);
+	} else {
+		value->type = JSONGEN_VALUE_DOUBLE;
+		value->real = g_ascii_strtod(start, NULL);
+	}
+	reader->pos += p - start;
+	return TRUE;
+}
+
+static inline gboolean jsongen_reader_literal(struct jsongen_reader* reader, const gchar* literal) {
+	gsize length = strlen(literal);
+	if (strncmp(reader->buffer + reader->pos, literal, length) != 0)
+		return FALSE;
+	reader->pos += length;
+	return TRUE;
+}
+
+static inline gboolean jsongen_reader_any(struct jsongen_reader* reader, struct jsongen_value* value, guint depth);
+
+/*
+ * reads the next member of the object that is being read.
+ * returns 1 and the name of the member when there is one, 0 at the end of the object and -1 if it isn't valid
+ */
+static inline gint jsongen_reader_member(struct jsongen_reader* reader, gboolean* first, gchar** name,
+                                         gsize* length) {
+	if (jsongen_reader_expect(reader, '}'))
+		return 0;
+	if (!*first && !jsongen_reader_expect(reader, ','))
+		return -1;
+	*first = FALSE;
+	if (!jsongen_reader_string(reader, name, length))
+		return -1;
+	if (!jsongen_reader_expect(reader, ':'))
+		return -1;
+	return 1;
+}
+
+/* reads a value and anything nested in it, arrays and objects are skipped over */
+static inline gboolean jsongen_reader_any(struct jsongen_reader* reader, struct jsongen_value* value, guint depth) {
+	gchar* name;
+	gsize length;
+	gboolean first = TRUE;
+	struct jsongen_value nested;
+
+	switch (jsongen_reader_peek(reader)) {
+		case '{': {
+			if (depth >= JSONGEN_READER_MAX_DEPTH)
+				return FALSE;
+			reader->pos++;
+			gint member;
+			while ((member = jsongen_reader_member(reader, &first, &name, &length)) > 0) {
+				if (!jsongen_reader_any(reader, &nested, depth + 1))
+					return FALSE;
+			}
+			value->type = JSONGEN_VALUE_OBJECT;
+			return member == 0;
+		}
+		case '[':
+			if (depth >= JSONGEN_READER_MAX_DEPTH)
+				return FALSE;
+			reader->pos++;
+			while (!jsongen_reader_expect(reader, ']')) {
+				if (!first && !jsongen_reader_expect(reader, ','))
+					return FALSE;
+				first = FALSE;
+				if (!jsongen_reader_any(reader, &nested, depth + 1))
+					return FALSE;
+			}
+			value->type = JSONGEN_VALUE_ARRAY;
+			return TRUE;
+		case '"':
+			value->type = JSONGEN_VALUE_STRING;
+			if (!jsongen_reader_string(reader, &name, &length))
+				return FALSE;
+			value->string = name;
+			return TRUE;
+		case 't':
+			value->type = JSONGEN_VALUE_BOOLEAN;
+			value->boolean = TRUE;
+			return jsongen_reader_literal(reader, "true");
+		case 'f':
+			value->type = JSONGEN_VALUE_BOOLEAN;
+			value->boolean = FALSE;
+			return jsongen_reader_literal(reader, "false");
+		case 'n':
+			value->type = JSONGEN_VALUE_NULL;
+			return jsongen_reader_literal(reader, "null");
+		default:
+			return jsongen_reader_number(reader, value);
+	}
+}
+
+/* starts reading the object the buffer should contain */
+static inline gboolean jsongen_reader_begin_object(struct jsongen_reader* reader) {
+	/* json-glib only accepts valid utf-8 */
+	if (!g_utf8_validate(reader->buffer, reader->length, NULL) || !jsongen_reader_expect(reader, '{')) {
+		reader->failed = TRUE;
+		return FALSE;
+	}
+	reader->first = TRUE;
+	return TRUE;
+}
+
+/* returns FALSE at the end of the object or if it isn't valid, which jsongen_reader_end() tells apart */
+static inline gboolean jsongen_reader_next_member(struct jsongen_reader* reader, const gchar** name, gsize* length) {
+	if (reader->failed || reader->closed)
+		return FALSE;
+	gchar* member;
+	gint ret = jsongen_reader_member(reader, &reader->first, &member, length);
+	if (ret < 0)
+		reader->failed = TRUE;
+	else if (ret == 0)
+		reader->closed = TRUE;
+	else
+		*name = member;
+	return ret > 0;
+}
+
+static inline gboolean jsongen_reader_read_value(struct jsongen_reader* reader, struct jsongen_value* value) {
+	if (!jsongen_reader_any(reader, value, 1)) {
+		reader->failed = TRUE;
+		return FALSE;
+	}
+	return TRUE;
+}
+
+/* checks that the whole object was read and that there's nothing after it */
+static inline gboolean jsongen_reader_end(struct jsongen_reader* reader) {
+	return !reader->failed && reader->closed && jsongen_reader_peek(reader) == '\0' &&
+	       reader->pos == reader->length;
+}
+
+/* these convert values the same way json_node_get_*() does */
+
+static inline gint64 jsongen_value_get_int(const struct jsongen_value* value) {
+	switch (value->type) {
+		case JSONGEN_VALUE_INT:
+			return value->integer;
+		case JSONGEN_VALUE_DOUBLE:
+			return (gint64) value->real;
+		case JSONGEN_VALUE_BOOLEAN:
+			return value->boolean;
+		default:
+			return 0;
+	}
+}
+
+static inline gdouble jsongen_value_get_double(const struct jsongen_value* value) {
+	switch (value->type) {
+		case JSONGEN_VALUE_INT:
+			return value->integer;
+		case JSONGEN_VALUE_DOUBLE:
+			return value->real;
+		case JSONGEN_VALUE_BOOLEAN:
+			return value->boolean;
+		default:
+			return 0;
+	}
+}
+
+static inline gboolean jsongen_value_get_boolean(const struct jsongen_value* value) {
+	switch (value->type) {
+		case JSONGEN_VALUE_INT:
+			return value->integer != 0;
+		case JSONGEN_VALUE_DOUBLE:
+			return value->real != 0;
+		case JSONGEN_VALUE_BOOLEAN:
+			return value->boolean;
+		default:
+			return FALSE;
+	}
+}
+
+static inline const gchar* jsongen_value_get_string(const struct jsongen_value* value) {
+	return value->type == JSONGEN_VALUE_STRING ? value->string : NULL;
+}
@@ -0,0 +1,124 @@
+#pragma once
+
+#include <glib.h>
+#include <math.h>
+#include <string.h>
+
+/*
+ * Writers for the builders jsongen generates with buffer. The generated code makes sure the buffer
+ * has room for the largest json a struct could produce before it starts so these don't check, each
+ * writes a value at p and returns where the next one goes.
+ */
+
+/* the most each writer can write, apart from strings and blobs that depend on their length */
+#define JSONGEN_WRITER_INT_SIZE 20
+#define JSONGEN_WRITER_DOUBLE_SIZE (G_ASCII_DTOSTR_BUF_SIZE + 2)
+#define JSONGEN_WRITER_BOOLEAN_SIZE 5
+#define JSONGEN_WRITER_STRING_SIZE(length) (2 + ((length) * 6))
+#define JSONGEN_WRITER_BASE64_SIZE(length) (2 + (((length) / 3 + 1) * 4) + 4)
+
+static inline gchar* jsongen_write_uint(gchar* p, guint64 value) {
+	gchar digits[JSONGEN_WRITER_INT_SIZE];
+	int n = 0;
+	do {
+		digits[n++] = '0' + (value % 10);
+		value /= 10;
+	} while (value != 0);
+	while (n > 0)
+		*p++ = digits[--n];
+	return p;
+}
+
+static inline gchar* jsongen_write_int(gchar* p, gint64 value) {
+	if (value >= 0)
+		return jsongen_write_uint(p, value);
+	*p++ = '-';
+	/* negated as unsigned so G_MININT64 doesn't overflow */
+	return jsongen_write_uint(p, -(guint64) value);
+}
+
+static inline gchar* jsongen_write_double(gchar* p, gdouble value) {
+	if (!isfinite(value)) {
+		memcpy(p, "null", 4);
+		return p + 4;
+	}
+	g_ascii_dtostr(p, G_ASCII_DTOSTR_BUF_SIZE, value);
+	gsize length = strlen(p);
+	/* whole numbers still need to read back as doubles */
+	if (strpbrk(p, ".eE") == NULL) {
+		memcpy(p + length, ".0", 2);
+		length += 2;
+	}
+	return p + length;
+}
+
+static inline gchar* jsongen_write_boolean(gchar* p, gboolean value) {
+	if (value) {
+		memcpy(p, "true", 4);
+		return p + 4;
+	}
+	memcpy(p, "false", 5);
+	return p + 5;
+}
+
+static inline gchar* jsongen_write_null(gchar* p) {
+	memcpy(p, "null", 4);
+	return p + 4;
+}
+
+static inline gchar* jsongen_write_string(gchar* p, const gchar* value) {
+	static const gchar hex[] = "0123456789abcdef";
+
+	if (value == NULL)
+		return jsongen_write_null(p);
+
+	*p++ = '"';
+	for (const guchar* c = (const guchar*) value; *c != '\0'; c++) {
+		if (*c >= 0x20 && *c != '"' && *c != '\\') {
+			*p++ = *c;
+			continue;
+		}
+		*p++ = '\\';
+		switch (*c) {
+			case '"':
+			case '\\':
+				*p++ = *c;
+				break;
+			case '\b':
+				*p++ = 'b';
+				break;
+			case '\f':
+				*p++ = 'f';
+				break;
+			case '\n':
+				*p++ = 'n';
+				break;
+			case '\r':
+				*p++ = 'r';
+				break;
+			case '\t':
+				*p++ = 't';
+				break;
+			default:
+				memcpy(p, "u00", 3);
+				p[3] = hex[*c >> 4];
+				p[4] = hex[*c & 0xf];
+				p += 5;
+				break;
+		}
+	}
+	*p++ = '"';
+	return p;
+}
+
+static inline gchar* jsongen_write_base64(gchar* p, const guint8* value, gsize length) {
+	gint state = 0;
+	gint save = 0;
+	*p++ = '"';
+	if (length > 0) {
+		p += g_base64_encode_step(value, length, FALSE, p, &state, &save);
+		p += g_base64_encode_close(FALSE, p, &state, &save);
+	}
+	*p++ = '"';
+	return p;
+}
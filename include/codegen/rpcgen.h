@@ -7,3 +7,43 @@
 #define RPCGEN_ERR_INVALIDTOPIC    2
 #define RPCGEN_ERR_BADTOPICPART    3
 #define RPCGEN_ERR_BADREQUEST      4
+#define RPCGEN_ERR_BUSY            5
+
+/* the number of RPCGEN_ERR_* codes */
+#define RPCGEN_ERR_COUNT           6
+
+/*
+ * returned by the dispatchers when the endpoint is going to be called from the thread pool,
+ * the code is added to the response and passed to the complete function once it has been called
+ */
+#define RPCGEN_PENDING             -1
+
+/*
+ * Counters for an endpoint when rpcgen is generating stats, latencies are counted in buckets
+ * by the number of bits needed for the number of microseconds they took so bucket n counts the
+ * calls that took less than 2^n us but at least 2^(n-1) us.
+ */
+#define RPCGEN_STATS_BUCKETS       32
+
+struct rpcgen_endpoint_stats {
+	const gchar* name;
+	guint64 calls;
+	guint64 codes[RPCGEN_ERR_COUNT];
+	/* calls where the handler returned something that isn't one of the RPCGEN_ERR_* codes */
+	guint64 other_codes;
+	guint64 total_us;
+	guint64 buckets[RPCGEN_STATS_BUCKETS];
+};
+
+static inline void rpcgen_stats_record(struct rpcgen_endpoint_stats* stats, int code, gint64 elapsed_us) {
+	stats->calls++;
+	if (code >= 0 && code < RPCGEN_ERR_COUNT)
+		stats->codes[code]++;
+	else
+		stats->other_codes++;
+	if (elapsed_us < 0)
+		elapsed_us = 0;
+	stats->total_us += elapsed_us;
+	guint bucket = elapsed_us > 0 ? g_bit_storage(elapsed_us) : 0;
+	stats->buckets[MIN(bucket, RPCGEN_STATS_BUCKETS - 1)]++;
+}
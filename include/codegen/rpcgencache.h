@@ -0,0 +1,101 @@
+#pragma once
+
+#include <glib.h>
+#include <json-glib/json-glib.h>
+
+/*
+ * A bounded LRU of the responses of an endpoint with cache set, keyed by the values of its
+ * topic parts. The generated code creates one of these for each endpoint with the limits
+ * from the rpc json, the hash table and queue are created when it's first used.
+ */
+struct rpcgen_cache {
+	guint max_entries;
+	/* how long entries are kept for, 0 to keep them until they are pushed out */
+	gint64 ttl_us;
+	/* keys to links in lru */
+	GHashTable* entries;
+	/* entries with the most recently used at the head */
+	GQueue lru;
+};
+
+struct rpcgen_cache_entry {
+	gchar* key;
+	/* an object with the members the handler added to the response */
+	JsonNode* response;
+	gint64 expires;
+};
+
+static inline void rpcgen_cache_entry_free(struct rpcgen_cache_entry* entry) {
+	g_free(entry->key);
+	json_node_unref(entry->response);
+	g_free(entry);
+}
+
+static inline void rpcgen_cache_remove_link(struct rpcgen_cache* cache, GList* link) {
+	struct rpcgen_cache_entry* entry = link->data;
+	g_hash_table_remove(cache->entries, entry->key);
+	g_queue_delete_link(&cache->lru, link);
+	rpcgen_cache_entry_free(entry);
+}
+
+static inline const struct rpcgen_cache_entry* rpcgen_cache_lookup(struct rpcgen_cache* cache, const gchar* key) {
+	if (cache->entries == NULL)
+		return NULL;
+	GList* link = g_hash_table_lookup(cache->entries, key);
+	if (link == NULL)
+		return NULL;
+	struct rpcgen_cache_entry* entry = link->data;
+	if (cache->ttl_us > 0 && g_get_monotonic_time() >= entry->expires) {
+		rpcgen_cache_remove_link(cache, link);
+		return NULL;
+	}
+	g_queue_unlink(&cache->lru, link);
+	g_queue_push_head_link(&cache->lru, link);
+	return entry;
+}
+
+/* takes ownership of key and response */
+static inline void rpcgen_cache_insert(struct rpcgen_cache* cache, gchar* key, JsonNode* response) {
+	if (cache->entries == NULL)
+		cache->entries = g_hash_table_new(g_str_hash, g_str_equal);
+
+	GList* existing = g_hash_table_lookup(cache->entries, key);
+	if (existing != NULL)
+		rpcgen_cache_remove_link(cache, existing);
+
+	struct rpcgen_cache_entry* entry = g_new0(struct rpcgen_cache_entry, 1);
+	entry->key = key;
+	entry->response = response;
+	entry->expires = g_get_monotonic_time() + cache->ttl_us;
+	g_queue_push_head(&cache->lru, entry);
+	g_hash_table_insert(cache->entries, entry->key, cache->lru.head);
+
+	while (g_queue_get_length(&cache->lru) > cache->max_entries)
+		rpcgen_cache_remove_link(cache, cache->lru.tail);
+}
+
+static inline gboolean rpcgen_cache_invalidate(struct rpcgen_cache* cache, const gchar* key) {
+	if (cache->entries == NULL)
+		return FALSE;
+	GList* link = g_hash_table_lookup(cache->entries, key);
+	if (link == NULL)
+		return FALSE;
+	rpcgen_cache_remove_link(cache, link);
+	return TRUE;
+}
+
+static inline void rpcgen_cache_clear(struct rpcgen_cache* cache) {
+	while (cache->lru.head != NULL)
+		rpcgen_cache_remove_link(cache, cache->lru.head);
+}
+
+static inline void rpcgen_cache_add_member(JsonObject* object, const gchar* name, JsonNode* node, gpointer data) {
+	JsonBuilder* builder = data;
+	json_builder_set_member_name(builder, name);
+	json_builder_add_value(builder, json_node_copy(node));
+}
+
+/* adds the members of a response that was built separately to the response being built */
+static inline void rpcgen_cache_replay(JsonNode* cached, JsonBuilder* response) {
+	json_object_foreach_member(json_node_get_object(cached), rpcgen_cache_add_member, response);
+}
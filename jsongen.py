@@ -1,11 +1,17 @@
 #!/usr/bin/env python3
 
+from __future__ import annotations
 import codegen
-from pycparser.c_ast import Struct
 from enum import Enum
+from typing import TYPE_CHECKING
 import re
 
+if TYPE_CHECKING:
+    from pycparser.c_ast import Struct
+
 TAG = 'jsongen'
+BARRIER_TAG = TAG
+OUTPUT_SUFFIX = '.json.h'
 
 annotation_types = {
     'member', 'flags', 'default'
@@ -51,6 +57,124 @@ class JsonField:
                         self.optional = True
 
 
+def enum_function_name(enum_name: str, suffix: str):
+    return '__%s_enum_%s_%s' % (TAG, enum_name, suffix)
+
+
+def enum_guard_name(enum_name: str):
+    return '__%s_ENUM_%s' % (TAG.upper(), enum_name)
+
+
+class JsonEnum(codegen.CodeBlock):
+    """
+    the tables and functions for converting an enum to and from strings, written once for
+    each enum used by the parsers and builders in a file. They're guarded so that headers
+    generated from different inputs that use the same enum can be included together.
+    The strings for a value are the part of its name after the name of the enum, i.e. COLOUR_RED is
+    RED or red. Values are written as the lower case version.
+    """
+    __slots__ = ['enum']
+
+    # the largest value that is looked up in an array, anything bigger uses a switch
+    MAX_ARRAY_VALUE = 1024
+
+    def __init__(self, enum, output_file):
+        super().__init__(output_file)
+        self.enum = enum
+
+    def __value_strings(self):
+        values = []
+        for v in self.enum.values:
+            matches = re.search('%s_(.*)' % self.enum.name.upper(), v.name)
+            values.append((v.name, matches.group(1) if matches is not None else v.name))
+        return values
+
+    def __numeric_values(self):
+        """
+        :return: the value of each enumerator or None if any of them aren't simple constants
+        """
+        numeric = []
+        next_value = 0
+        for v in self.enum.values:
+            if v.value is not None:
+                if type(v.value).__name__ != 'Constant' or v.value.type != 'int':
+                    return None
+                try:
+                    next_value = int(v.value.value.rstrip('uUlL'), 0)
+                except ValueError:
+                    return None
+            numeric.append(next_value)
+            next_value += 1
+        return numeric
+
+    def write(self):
+        enum_type = 'enum %s' % self.enum.name
+        values = self.__value_strings()
+        table = enum_function_name(self.enum.name, 'values')
+        names = enum_function_name(self.enum.name, 'names')
+        guard = enum_guard_name(self.enum.name)
+
+        self.add_raw('#ifndef %s\n#define %s\n' % (guard, guard))
+        # sorted in the order strcmp() sorts them so they can be binary searched
+        strings = {}
+        for name, string in values:
+            strings.setdefault(string, name)
+            strings.setdefault(string.lower(), name)
+        self.start_scope(prefix='static const struct { const gchar* str; %s val; } %s[] = ' % (enum_type, table))
+        self.add_items(list(map(lambda s: '{ .str = "%s", .val = %s }' % (s, strings[s]),
+                                sorted(strings, key=lambda s: s.encode()))))
+        self.end_scope(terminate=True)
+
+        self.start_function(enum_function_name(self.enum.name, 'from_string'), static=True, rtype='gboolean',
+                            args=[codegen.Argument('str', 'const gchar*'), codegen.Argument('val', enum_type + '*')])
+        self.start_condition('str == NULL')
+        self.add_statement('return FALSE')
+        self.end_condition()
+        self.add_statement('gsize lo = 0')
+        self.add_statement('gsize hi = G_N_ELEMENTS(%s)' % table)
+        self.start_scope(prefix='while(lo < hi)')
+        self.add_statement('gsize mid = (lo + hi) / 2')
+        self.add_statement('int cmp = strcmp(str, %s[mid].str)' % table)
+        self.start_condition('cmp == 0')
+        self.add_statement('*val = %s[mid].val' % table)
+        self.add_statement('return TRUE')
+        self.end_condition()
+        self.start_condition('cmp < 0')
+        self.add_statement('hi = mid')
+        self.add_else()
+        self.add_statement('lo = mid + 1')
+        self.end_condition()
+        self.end_scope()
+        self.add_statement('return FALSE')
+        self.end_function()
+
+        numeric = self.__numeric_values()
+        use_array = numeric is not None and min(numeric, default=0) >= 0 and \
+            max(numeric, default=0) <= self.MAX_ARRAY_VALUE
+        if use_array:
+            self.start_scope(prefix='static const gchar* const %s[] = ' % names)
+            self.add_items(list(map(lambda v: '[%s] = "%s"' % (v[0], v[1].lower()), values)))
+            self.end_scope(terminate=True)
+
+        self.start_function(enum_function_name(self.enum.name, 'to_string'), static=True, rtype='const gchar*',
+                            args=[codegen.Argument('val', enum_type)])
+        if use_array:
+            self.start_condition('(gsize) val < G_N_ELEMENTS(%s)' % names)
+            self.add_statement('return %s[val]' % names)
+            self.end_condition()
+        else:
+            self.start_switch('val')
+            for name, string in values:
+                self.start_case(name)
+                self.add_statement('return "%s"' % string.lower())
+                self.end_case(add_break=False)
+            self.end_switch()
+        self.add_statement('return NULL')
+        self.end_function()
+        self.add_raw('#endif\n')
+        self.flush()
+
+
 class JsonCodeBlock(codegen.CodeBlock):
     __slots__ = ['struct_name', 'fields_and_annotations', 'root']
 
@@ -75,25 +199,23 @@ class JsonCodeBlock(codegen.CodeBlock):
 
     def __dowalk(self, root: JsonField, fields_and_annotations):
         for field in fields_and_annotations[0]:
-            print(field.field_name)
+            codegen.debug(field.field_name)
 
             json_member = field.field_name
             inline = False
-            field_annotations = []
-
-            for annotation in fields_and_annotations[1]:
-                if annotation.field_name == field.field_name:
-                    field_annotations.append(annotation)
-                    if annotation.annotation_type == 'member':
-                        assert len(annotation.parameters) == 1
-                        json_member = annotation.parameters[0]
-                        print('overriding member with %s' % json_member)
-                    elif annotation.annotation_type == 'flags' and 'inline' in annotation.parameters:
-                        inline = True
+            field_annotations = fields_and_annotations[1].for_field(field.field_name)
+
+            for annotation in field_annotations:
+                if annotation.annotation_type == 'member':
+                    assert len(annotation.parameters) == 1
+                    json_member = annotation.parameters[0]
+                    codegen.debug('overriding member with %s' % json_member)
+                elif annotation.annotation_type == 'flags' and 'inline' in annotation.parameters:
+                    inline = True
 
             if field.type == codegen.FieldType.STRUCT:
                 new_root = JsonField(json_member, JsonFieldType.INLINE if inline else JsonFieldType.OBJECT,
-                                     field.field_name)
+                                     field.field_name, field_annotations)
                 self.__dowalk(new_root, field.fields_and_annotations)
                 root.children.append(new_root)
                 continue
@@ -114,61 +236,125 @@ class JsonCodeBlock(codegen.CodeBlock):
         self.root = JsonField(None, JsonFieldType.OBJECT)
         self.__dowalk(self.root, fields_and_annotations)
 
+    def enums(self, field: JsonField = None):
+        """
+        :return: the enums used by the fields
+        """
+        field = field if field is not None else self.root
+        if field.type == JsonFieldType.ENUM:
+            return [field.c_field.enum]
+        enums = []
+        for c in field.children:
+            enums.extend(self.enums(c))
+        return enums
+
+    def lookups(self):
+        """
+        :return: tuples of the name of a lookup function the output uses and the keys for it
+        """
+        return []
+
+    def includes(self):
+        """
+        :return: the headers the output needs
+        """
+        return []
+
 
 class JsonParser(JsonCodeBlock):
-    def __init__(self, struct_name: str, fields_and_annotations, output_file):
+    """
+    writes a parser that either looks up each member in turn or, with iterate, goes over the members of the
+    object once and switches on the name of each to find the fields it's for. With stream the members are
+    read from a buffer with the reader in codegen/jsongenreader.h instead of from a JsonObject. With arena
+    strings and blobs are copied into memory from a struct jsongen_arena once everything has been parsed.
+    With object the parser is also defined as the one other generated code should use for the struct.
+    """
+    __slots__ = ['iterate', 'stream', 'arena', 'object', 'arena_locals']
+
+    def __init__(self, struct_name: str, fields_and_annotations, output_file, iterate: bool = False,
+                 stream: bool = False, arena: bool = False, object: bool = False):
         super().__init__(struct_name, fields_and_annotations, output_file)
+        assert not object or not (stream or arena), \
+            'the object parser for %s has to take a JsonObject and not use an arena' % struct_name
+        self.iterate = iterate or stream
+        self.stream = stream
+        self.arena = arena
+        self.object = object
+        # the fields that are copied into the arena to the local that holds them until then
+        self.arena_locals = {}
+
+    def __value(self, json_type: str, member: str):
+        if self.stream:
+            return 'jsongen_value_get_%s(&value)' % json_type
+        if self.iterate:
+            return 'json_node_get_%s(node)' % json_type
+        return 'json_object_get_%s_member((JsonObject*) root, "%s")' % (json_type, member)
 
     def __get_int(self, member: str, field: codegen.Field, path):
-        self.add_statement('%s->%s = json_object_get_int_member((JsonObject*) root, "%s")' % (
-            self.struct_name, flatten_path(path, field.field_name), member))
+        self.add_statement('%s->%s = %s' % (self.struct_name, flatten_path(path, field.field_name),
+                                            self.__value('int', member)))
 
     def __get_boolean(self, member: str, field: codegen.Field, path):
-        self.add_statement('%s->%s = json_object_get_boolean_member((JsonObject*) root, "%s")' % (
-            self.struct_name, flatten_path(path, field.field_name), member))
+        self.add_statement('%s->%s = %s' % (self.struct_name, flatten_path(path, field.field_name),
+                                            self.__value('boolean', member)))
 
     def __get_double(self, member: str, field: codegen.Field, path):
-        self.add_statement('%s->%s = json_object_get_double_member((JsonObject*) root, "%s")' % (
-            self.struct_name, flatten_path(path, field.field_name), member))
+        self.add_statement('%s->%s = %s' % (self.struct_name, flatten_path(path, field.field_name),
+                                            self.__value('double', member)))
 
     def __get_string(self, member: str, field: codegen.Field, path):
-        self.add_statement('%s->%s = json_object_get_string_member((JsonObject*) root, "%s")' % (
-            self.struct_name, flatten_path(path, field.field_name), member))
+        if self.arena:
+            # set to the string in the json for now so it's the same as without arena if that is NULL
+            local = self.arena_locals[flatten_path(path, field.field_name)]
+            self.add_statement('%s = %s' % (local, self.__value('string', member)))
+            self.add_statement('%s->%s = %s' % (self.struct_name, flatten_path(path, field.field_name), local))
+            return
+        self.add_statement('%s->%s = %s' % (self.struct_name, flatten_path(path, field.field_name),
+                                            self.__value('string', member)))
 
     def __get_base64blob(self, member: str, field: codegen.Field, path):
+        if self.arena:
+            self.add_statement('%s = %s' % (self.arena_locals[flatten_path(path, field.field_name)],
+                                            self.__value('string', member)))
+            # the copy only sets these if the member has a value, null is an empty blob
+            self.add_statement('%s->%s = NULL' % (self.struct_name, flatten_path(path, field.field_name)))
+            self.add_statement('%s->%slen = 0' % (self.struct_name, flatten_path(path, field.field_name)))
+            return
         self.start_scope()
-        self.add_statement('const gchar* payloadb64 = json_object_get_string_member((JsonObject*) root, "%s")' % member)
+        self.add_statement('const gchar* payloadb64 = %s' % self.__value('string', member))
+        # g_base64_decode() doesn't take NULL, null is an empty blob
+        self.start_condition('payloadb64 == NULL')
+        self.add_statement('%s->%s = NULL' % (self.struct_name, flatten_path(path, field.field_name)))
+        self.add_statement('%s->%slen = 0' % (self.struct_name, flatten_path(path, field.field_name)))
+        self.add_else()
         self.add_statement('%s->%s = g_base64_decode(payloadb64, &%s->%slen)' % (
             self.struct_name, flatten_path(path, field.field_name), self.struct_name,
             flatten_path(path, field.field_name)))
+        self.end_condition()
         self.end_scope()
 
     def __get_enum(self, member: str, field: codegen.Field, path):
-        # create a struct for string->enum mapping
-        self.start_scope(prefix='struct mapping ')
-        self.add_statement("const gchar* str")
-        self.add_statement("enum %s val" % field.c_type)
-        self.end_scope(terminate=True)
-
-        # fill in the mappings
-        self.start_scope(prefix='const struct mapping map[] = ')
-        mappings = []
-        for v in field.enum.values:
-            v.show()
-            matches = re.search('%s_(.*)' % field.enum.name.upper(), v.name)
-            mappings.append('{ .str = \"%s\", .val = %s }' % (matches.group(1), v.name))
-            mappings.append('{ .str = \"%s\", .val = %s }' % (matches.group(1).lower(), v.name))
-        self.add_items(mappings)
-        self.end_scope(terminate=True)
+        self.start_scope()
+        self.add_statement('const gchar* enumtmp = %s' % self.__value('string', member))
+        self.add_statement('%s(enumtmp, &%s->%s)' % (enum_function_name(field.enum.name, 'from_string'),
+                                                   self.struct_name, flatten_path(path, field.field_name)))
+        self.end_scope()
 
-        self.add_statement('const gchar* enumtmp = json_object_get_string_member((JsonObject*)root, "%s")' % (member))
-        self.start_scope(prefix='for(int i = 0; i < G_N_ELEMENTS(map); i++)')
-        self.start_condition('strcmp(enumtmp, map[i].str) == 0')
-        self.add_statement('%s->%s = map[i].val' % (
-            self.struct_name, flatten_path(path, field.field_name)))
-        self.add_break()
-        self.end_condition()
-        self.end_scope(terminate=True)
+    def __get(self, field: JsonField, path):
+        if field.type == JsonFieldType.INT:
+            self.__get_int(field.name, field.c_field, path)
+        elif field.type == JsonFieldType.BOOLEAN:
+            self.__get_boolean(field.name, field.c_field, path)
+        elif field.type == JsonFieldType.DOUBLE:
+            self.__get_double(field.name, field.c_field, path)
+        elif field.type == JsonFieldType.STRING:
+            self.__get_string(field.name, field.c_field, path)
+        elif field.type == JsonFieldType.BASE64BLOB:
+            self.__get_base64blob(field.name, field.c_field, path)
+        elif field.type == JsonFieldType.ENUM:
+            self.__get_enum(field.name, field.c_field, path)
+        else:
+            assert False, ('couldn\'t write json type %s' % field.type)
 
     def __write(self, field: JsonField, path=[]):
 
@@ -182,20 +368,8 @@ class JsonParser(JsonCodeBlock):
                 path.append(field.c_field)
             for c in field.children:
                 self.__write(c, path.copy())
-        elif field.type == JsonFieldType.INT:
-            self.__get_int(field.name, field.c_field, path)
-        elif field.type == JsonFieldType.BOOLEAN:
-            self.__get_boolean(field.name, field.c_field, path)
-        elif field.type == JsonFieldType.DOUBLE:
-            self.__get_double(field.name, field.c_field, path)
-        elif field.type == JsonFieldType.STRING:
-            self.__get_string(field.name, field.c_field, path)
-        elif field.type == JsonFieldType.BASE64BLOB:
-            self.__get_base64blob(field.name, field.c_field, path)
-        elif field.type == JsonFieldType.ENUM:
-            self.__get_enum(field.name, field.c_field, path)
         else:
-            assert False, ('couldn\'t write json type %s' % field.type)
+            self.__get(field, path)
 
         if member:
             if not field.optional:
@@ -203,18 +377,323 @@ class JsonParser(JsonCodeBlock):
                 self.add_statement('goto err', )
             self.end_condition()
 
+    def __members(self, field: JsonField, members: list, guards: tuple = (), path=[]):
+        """
+        collects the fields for each member in the order they appear in the struct, the fields of
+        sub-structs are looked up in the same object as the struct they are in.
+        :param members: tuples of the member name, the field, its path and the names of the optional
+        members it's in. Like the default parser fields are only parsed, and only need to be there,
+        if all of those are present.
+        """
+        if field.type is not JsonFieldType.INLINE and field is not self.root:
+            members.append((field.name, field, path, guards))
+            if field.optional:
+                guards = guards + (field.name,)
+        if field.type == JsonFieldType.OBJECT or field.type == JsonFieldType.INLINE:
+            if field.c_field is not None:
+                path.append(field.c_field)
+            for c in field.children:
+                self.__members(c, members, guards, path.copy())
+
+    def member_lookup_function_name(self):
+        return '__%s_%s_member_index' % (TAG, self.struct_name)
+
+    def lookups(self):
+        if not self.iterate:
+            return []
+        members = []
+        self.__members(self.root, members)
+        names = list(dict.fromkeys(map(lambda m: m[0], members)))
+        return [(self.member_lookup_function_name(), list(map(lambda m: m.encode(), names)))]
+
+    @staticmethod
+    def __seen_bit(tracked: list, name: str):
+        bit = tracked.index(name)
+        return 'seen[%d]' % (bit // 64), 'G_GUINT64_CONSTANT(1) << %d' % (bit % 64)
+
+    def __write_iterate(self):
+        members = []
+        self.__members(self.root, members)
+        names = list(dict.fromkeys(map(lambda m: m[0], members)))
+        # the members that need to be present, along with the optional members they're in
+        required = []
+        # members in optional members are kept until the end as they're only parsed if those are present
+        deferred = []
+        guard_names = []
+        for name, field, path, guards in members:
+            if not field.optional and (name, guards) not in required:
+                required.append((name, guards))
+            if len(guards) > 0 and field.type != JsonFieldType.OBJECT and name not in deferred:
+                deferred.append(name)
+            guard_names.extend(guards)
+        # a bit for each of the members that matter at the end that is set when they are seen
+        tracked = list(filter(lambda n: n in guard_names or n in deferred or
+                              any(map(lambda r: r[0] == n, required)), names))
+        words = (len(tracked) + 63) // 64
+
+        if words > 0:
+            self.add_statement('guint64 seen[%d] = { 0 }' % words)
+        for name in deferred:
+            if self.stream:
+                self.add_statement('struct jsongen_value deferred%d = { 0 }' % names.index(name))
+            else:
+                self.add_statement('JsonNode* deferred%d = NULL' % names.index(name))
+        self.add_statement('const gchar* member')
+        if self.stream:
+            self.add_statement('gsize memberlen')
+            self.add_statement('struct jsongen_value value')
+            self.add_statement('struct jsongen_reader reader')
+            self.add_statement('jsongen_reader_init(&reader, buffer, length)')
+            self.start_condition('!jsongen_reader_begin_object(&reader)')
+            self.add_statement('goto err')
+            self.end_condition()
+            self.start_scope(prefix='while(jsongen_reader_next_member(&reader, &member, &memberlen))')
+            self.start_condition('!jsongen_reader_read_value(&reader, &value)')
+            self.add_statement('goto err')
+            self.end_condition()
+            self.start_switch('%s(member, memberlen)' % self.member_lookup_function_name())
+        else:
+            self.add_statement('JsonNode* node')
+            self.add_statement('JsonObjectIter iter')
+            self.add_statement('json_object_iter_init(&iter, (JsonObject*) root)')
+            self.start_scope(prefix='while(json_object_iter_next(&iter, &member, &node))')
+            self.start_switch('%s(member, strlen(member))' % self.member_lookup_function_name())
+        for index, name in enumerate(names):
+            self.start_case(index)
+            for member, field, path, guards in members:
+                if member == name and field.type != JsonFieldType.OBJECT and len(guards) == 0:
+                    self.__get(field, path)
+            if name in deferred:
+                self.add_statement('deferred%d = %s' % (index, 'value' if self.stream else 'node'))
+            if name in tracked:
+                self.add_statement('%s |= %s' % self.__seen_bit(tracked, name))
+            self.end_case()
+        self.end_switch()
+        self.end_scope()
+        if self.stream:
+            self.start_condition('!jsongen_reader_end(&reader)')
+            self.add_statement('goto err')
+            self.end_condition()
+
+        for word in range(words):
+            bits = 0
+            for name, guards in required:
+                if len(guards) == 0 and tracked.index(name) // 64 == word:
+                    bits |= 1 << (tracked.index(name) % 64)
+            if bits == 0:
+                continue
+            mask = 'G_MAXUINT64' if bits == (1 << 64) - 1 else 'G_GUINT64_CONSTANT(0x%x)' % bits
+            if bits == (1 << min(64, len(tracked) - (word * 64))) - 1:
+                self.start_condition('seen[%d] != %s' % (word, mask))
+            else:
+                self.start_condition('(seen[%d] & %s) != %s' % (word, mask, mask))
+            self.add_statement('goto err')
+            self.end_condition()
+
+        # the members in optional members once it's known which of those are present
+        groups = list(dict.fromkeys(filter(lambda g: len(g) > 0, map(lambda m: m[3], members))))
+        for group in groups:
+            self.start_condition(' && '.join(map(lambda g: '(%s & (%s)) != 0' % self.__seen_bit(tracked, g), group)))
+            for name, guards in required:
+                if guards == group:
+                    self.start_condition('(%s & (%s)) == 0' % self.__seen_bit(tracked, name))
+                    self.add_statement('goto err')
+                    self.end_condition()
+            for name, field, path, guards in members:
+                if guards != group or field.type == JsonFieldType.OBJECT:
+                    continue
+                present = (name, guards) in required
+                if not present:
+                    self.start_condition('(%s & (%s)) != 0' % self.__seen_bit(tracked, name))
+                self.add_statement('%s = deferred%d' % ('value' if self.stream else 'node', names.index(name)))
+                self.__get(field, path)
+                if not present:
+                    self.end_condition()
+            self.end_condition()
+
+    def includes(self):
+        includes = []
+        if self.stream:
+            includes.append('codegen/jsongenreader.h')
+        if self.arena:
+            includes.append('codegen/jsongenarena.h')
+        return includes
+
+    def __arena_fields(self, field: JsonField, fields: list, path=[]):
+        """
+        :param fields: tuples of the fields that are copied into the arena and their paths
+        """
+        if field.type == JsonFieldType.OBJECT or field.type == JsonFieldType.INLINE:
+            if field.c_field is not None:
+                path.append(field.c_field)
+            for c in field.children:
+                self.__arena_fields(c, fields, path.copy())
+        elif field.type == JsonFieldType.STRING or field.type == JsonFieldType.BASE64BLOB:
+            fields.append((field, path))
+
+    def __write_arena_copy(self, fields: list):
+        """
+        copies the strings and decodes the blobs that were found into a single allocation from the arena
+        """
+        self.add_statement('gsize arenasize = 0')
+        for field, path in fields:
+            local = self.arena_locals[flatten_path(path, field.c_field.field_name)]
+            self.start_condition('%s != NULL' % local)
+            if field.type == JsonFieldType.STRING:
+                self.add_statement('arenasize += strlen(%s) + 1' % local)
+            else:
+                self.add_statement('arenasize += (strlen(%s) / 4) * 3 + 3' % local)
+            self.end_condition()
+        self.start_condition('arenasize == 0')
+        self.add_statement('return TRUE')
+        self.end_condition()
+        self.add_statement('gchar* arenanext = jsongen_arena_alloc(arena, arenasize)')
+        for field, path in fields:
+            member = '%s->%s' % (self.struct_name, flatten_path(path, field.c_field.field_name))
+            local = self.arena_locals[flatten_path(path, field.c_field.field_name)]
+            self.start_condition('%s != NULL' % local)
+            if field.type == JsonFieldType.STRING:
+                self.add_statement('gsize arenalen = strlen(%s) + 1' % local)
+                self.add_statement('memcpy(arenanext, %s, arenalen)' % local)
+                self.add_statement('%s = arenanext' % member)
+                self.add_statement('arenanext += arenalen')
+            else:
+                self.add_statement('gint state = 0')
+                self.add_statement('guint save = 0')
+                self.add_statement('%s = (guint8*) arenanext' % member)
+                self.add_statement('%slen = g_base64_decode_step(%s, strlen(%s), (guchar*) arenanext, &state, &save)'
+                                   % (member, local, local))
+                self.add_statement('arenanext += %slen' % member)
+            self.end_condition()
+
+    def __write_clear(self, field: JsonField, path=[]):
+        if field.type == JsonFieldType.OBJECT or field.type == JsonFieldType.INLINE:
+            if field.c_field is not None:
+                path.append(field.c_field)
+            for c in field.children:
+                self.__write_clear(c, path.copy())
+        elif field.type == JsonFieldType.BASE64BLOB:
+            member = '%s->%s' % (self.struct_name, flatten_path(path, field.c_field.field_name))
+            self.add_statement('g_free(%s)' % member)
+            self.add_statement('%s = NULL' % member)
+            self.add_statement('%slen = 0' % member)
+
+    def __owns_memory(self, field: JsonField):
+        if field.type == JsonFieldType.OBJECT or field.type == JsonFieldType.INLINE:
+            return any(map(self.__owns_memory, field.children))
+        return field.type == JsonFieldType.BASE64BLOB
+
+    def owns_memory(self):
+        """
+        :return: True if the parser allocates memory for some of the fields that needs to be freed
+        """
+        return not self.arena and self.__owns_memory(self.root)
+
+    def write_clear(self):
+        """
+        writes a function that frees what the parsers without arena allocated for the struct, the struct needs
+        to have been zeroed before it was parsed so that it can be cleared if the parse failed part way through
+        """
+        self.start_scope(prefix='static void __attribute__((unused)) %s(struct %s* %s)' % (
+            clear_function_name(self.struct_name), self.struct_name, self.struct_name))
+        self.__write_clear(self.root)
+        self.end_scope()
+        self.add_raw('\n')
+        self.flush()
+
+    def write_object_parser(self):
+        """
+        writes defines for the parser and for freeing what it allocated so that generated code that parses a
+        JsonObject into the struct, like the dispatchers rpcgen writes for request_struct, can use whichever
+        parser the struct has
+        """
+        self.add_raw('#define %s %s\n' % (object_parser_name(self.struct_name), self.function_name()))
+        if self.owns_memory():
+            self.add_raw('#define %s(s) %s(s)\n\n' % (object_clear_name(self.struct_name),
+                                                       clear_function_name(self.struct_name)))
+        else:
+            self.add_raw('#define %s(s) ((void) (s))\n\n' % object_clear_name(self.struct_name))
+        self.flush()
+
+    def function_name(self):
+        parameters = []
+        for parameter, enabled in [('iterate', self.iterate), ('stream', self.stream), ('arena', self.arena)]:
+            if enabled:
+                parameters.append(parameter)
+        return parser_function_name(self.struct_name, parameters)
+
     def write(self):
-        self.start_scope(
-            prefix='static gboolean __attribute__((unused)) __%s_%s_from_json(struct %s* %s, const JsonObject* root)' % (
-                TAG, self.struct_name, self.struct_name, self.struct_name))
-        self.__write(self.root)
+        function_name = self.function_name()
+        if self.stream:
+            # the buffer needs to be writable and have room for a terminator after length
+            args = 'gchar* buffer, gsize length'
+        else:
+            args = 'const JsonObject* root'
+        if self.arena:
+            args += ', struct jsongen_arena* arena'
+        self.start_scope(prefix='static gboolean __attribute__((unused)) %s(struct %s* %s, %s)' % (
+            function_name, self.struct_name, self.struct_name, args))
+
+        arena_fields = []
+        if self.arena:
+            self.__arena_fields(self.root, arena_fields)
+            for index, (field, path) in enumerate(arena_fields):
+                local = 'arenatmp%d' % index
+                self.arena_locals[flatten_path(path, field.c_field.field_name)] = local
+                self.add_statement('const gchar* %s = NULL' % local)
+
+        if self.iterate:
+            self.__write_iterate()
+        else:
+            self.__write(self.root)
+        if self.arena:
+            self.__write_arena_copy(arena_fields)
         self.add_statement('return TRUE')
         self.add_label('err')
         self.add_statement('return FALSE')
-        self.output_file.write('}\n\n')
+        self.end_scope()
+        self.add_raw('\n')
+        self.flush()
+
+
+def parser_function_name(struct_name: str, parameters: list = []):
+    """
+    :param parameters: the parameters of the parser typedef, parsers that iterate, read from a buffer
+    or allocate from an arena each get their own name so several can be generated for the same struct
+    """
+    if 'stream' in parameters:
+        function_name = stream_parser_function_name(struct_name)
+    elif 'iterate' in parameters:
+        function_name = '__%s_%s_from_json_iterate' % (TAG, struct_name)
+    else:
+        function_name = '__%s_%s_from_json' % (TAG, struct_name)
+    if 'arena' in parameters:
+        function_name += '_arena'
+    return function_name
+
+
+def clear_function_name(struct_name: str):
+    return '__%s_%s_clear' % (TAG, struct_name)
+
+
+def object_parser_name(struct_name: str):
+    return '__%s_OBJECT_PARSER_%s' % (TAG.upper(), struct_name)
+
+
+def object_clear_name(struct_name: str):
+    return '__%s_OBJECT_CLEAR_%s' % (TAG.upper(), struct_name)
+
+
+def stream_parser_function_name(struct_name: str):
+    return '__%s_%s_from_buffer' % (TAG, struct_name)
 
 
 class JsonBuilder(JsonCodeBlock):
+    """
+    writes a builder that adds the struct to a JsonBuilder or, with buffer, one that writes the json straight
+    into a GString with the writers in codegen/jsongenwriter.h.
+    """
+    __slots__ = ['buffer']
 
     def __add_int(self, field: codegen.Field, path):
         self.add_statement('json_builder_add_int_value(jsonbuilder, %s->%s)' % (
@@ -236,8 +715,23 @@ class JsonBuilder(JsonCodeBlock):
         self.add_statement('g_free(payloadb64)')
         self.end_scope()
 
-    def __init__(self, struct_name: str, fields_and_annotations, output_file):
+    def __add_enum(self, field: codegen.Field, path):
+        self.start_scope()
+        self.add_statement('const gchar* enumtmp = %s(%s->%s)' % (enum_function_name(field.enum.name, 'to_string'),
+                                                               self.struct_name, flatten_path(path, field.field_name)))
+        self.start_condition('enumtmp != NULL')
+        self.add_statement('json_builder_add_string_value(jsonbuilder, enumtmp)')
+        self.add_else()
+        self.add_statement('json_builder_add_null_value(jsonbuilder)')
+        self.end_condition()
+        self.end_scope()
+
+    def __init__(self, struct_name: str, fields_and_annotations, output_file, buffer: bool = False):
         super().__init__(struct_name, fields_and_annotations, output_file)
+        self.buffer = buffer
+
+    def includes(self):
+        return ['codegen/jsongenwriter.h'] if self.buffer else []
 
     def __set_field_name(self, name: str):
         self.add_statement('json_builder_set_member_name(jsonbuilder, "%s")' % name)
@@ -267,28 +761,169 @@ class JsonBuilder(JsonCodeBlock):
         elif field.type == JsonFieldType.BASE64BLOB:
             self.__add_base64blob(field.c_field, path)
         elif field.type == JsonFieldType.ENUM:
-            pass
+            self.__add_enum(field.c_field, path)
         else:
             assert False, ('couldn\'t write json type %s' % field.type)
 
+    def __parts(self, field: JsonField, parts: list, first: list, path=[]):
+        """
+        flattens the fields into the text between values, with the member names and punctuation for the
+        whole struct worked out here, and the values to write.
+        :param parts: strings for text and tuples of the field and its path for values
+        :param first: if the next member is the first in its object
+        """
+        if field.type is not JsonFieldType.INLINE and field is not self.root:
+            parts.append('%s"%s":' % ('' if first[0] else ',', field.name))
+            first[0] = False
+        if field.type == JsonFieldType.OBJECT or field.type == JsonFieldType.INLINE:
+            if field.c_field is not None:
+                path.append(field.c_field)
+            if field.type == JsonFieldType.OBJECT:
+                parts.append('{')
+                first = [True]
+            for c in field.children:
+                self.__parts(c, parts, first, path.copy())
+            if field.type == JsonFieldType.OBJECT:
+                parts.append('}')
+        else:
+            parts.append((field, path))
+
+    def __buffer_parts(self):
+        parts = []
+        self.__parts(self.root, parts, [True])
+        merged = []
+        for part in parts:
+            if type(part) is str and len(merged) > 0 and type(merged[-1]) is str:
+                merged[-1] += part
+            else:
+                merged.append(part)
+        return merged
+
+    def __field(self, field: JsonField, path):
+        return '%s->%s' % (self.struct_name, flatten_path(path, field.c_field.field_name))
+
+    @staticmethod
+    def __unsigned(field: JsonField):
+        return field.c_field.c_type.startswith('gu') or field.c_field.c_type == 'gsize'
+
+    def __write_size(self, parts: list):
+        self.start_function(buffer_size_function_name(self.struct_name), static=True, rtype='gsize',
+                            args=[codegen.Argument(self.struct_name, 'const struct %s*' % self.struct_name)])
+        fixed = []
+        text = 0
+        for part in parts:
+            if type(part) is str:
+                text += len(part.encode())
+                continue
+            field, path = part
+            if field.type == JsonFieldType.INT:
+                fixed.append('JSONGEN_WRITER_INT_SIZE')
+            elif field.type == JsonFieldType.DOUBLE:
+                fixed.append('JSONGEN_WRITER_DOUBLE_SIZE')
+            elif field.type == JsonFieldType.BOOLEAN:
+                fixed.append('JSONGEN_WRITER_BOOLEAN_SIZE')
+            elif field.type == JsonFieldType.ENUM:
+                # the longest of the names, or null
+                longest = max(map(lambda v: len(v.name), field.c_field.enum.values), default=0)
+                fixed.append('%d' % max(longest + 2, 4))
+        self.add_statement('gsize size = %s' % ' + '.join(['%d' % text] + fixed))
+        for part in parts:
+            if type(part) is str:
+                continue
+            field, path = part
+            if field.type == JsonFieldType.STRING:
+                self.start_condition('%s != NULL' % self.__field(field, path))
+                self.add_statement('size += JSONGEN_WRITER_STRING_SIZE(strlen(%s))' % self.__field(field, path))
+                self.add_else()
+                self.add_statement('size += 4')
+                self.end_condition()
+            elif field.type == JsonFieldType.BASE64BLOB:
+                self.add_statement('size += JSONGEN_WRITER_BASE64_SIZE(%slen)' % self.__field(field, path))
+        self.add_statement('return size')
+        self.end_function()
+
+    def __write_buffer(self):
+        parts = self.__buffer_parts()
+        self.__write_size(parts)
+
+        struct_arg = codegen.Argument(self.struct_name, 'const struct %s*' % self.struct_name)
+        self.start_function(buffer_builder_function_name(self.struct_name), static=True,
+                            args=[struct_arg, codegen.Argument('buffer', 'GString*')])
+        # make room for the largest the json could be up front so the writers don't need to check
+        self.add_statement('gsize start = buffer->len')
+        self.add_statement('g_string_set_size(buffer, start + %s(%s))' % (
+            buffer_size_function_name(self.struct_name), self.struct_name))
+        self.add_statement('gchar* p = buffer->str + start')
+        for part in parts:
+            if type(part) is str:
+                self.add_statement('memcpy(p, %s, %d)' % (codegen.c_string(part.encode()), len(part.encode())))
+                self.add_statement('p += %d' % len(part.encode()))
+                continue
+            field, path = part
+            value = self.__field(field, path)
+            if field.type == JsonFieldType.INT:
+                self.add_statement('p = jsongen_write_%s(p, %s)' % ('uint' if self.__unsigned(field) else 'int',
+                                                                    value))
+            elif field.type == JsonFieldType.DOUBLE:
+                self.add_statement('p = jsongen_write_double(p, %s)' % value)
+            elif field.type == JsonFieldType.BOOLEAN:
+                self.add_statement('p = jsongen_write_boolean(p, %s)' % value)
+            elif field.type == JsonFieldType.STRING:
+                self.add_statement('p = jsongen_write_string(p, %s)' % value)
+            elif field.type == JsonFieldType.BASE64BLOB:
+                self.add_statement('p = jsongen_write_base64(p, %s, %slen)' % (value, value))
+            elif field.type == JsonFieldType.ENUM:
+                self.start_scope()
+                self.add_statement('const gchar* enumtmp = %s(%s)' % (
+                    enum_function_name(field.c_field.enum.name, 'to_string'), value))
+                self.start_condition('enumtmp != NULL')
+                self.add_statement('*p++ = \'"\'')
+                self.add_statement('memcpy(p, enumtmp, strlen(enumtmp))')
+                self.add_statement('p += strlen(enumtmp)')
+                self.add_statement('*p++ = \'"\'')
+                self.add_else()
+                self.add_statement('p = jsongen_write_null(p)')
+                self.end_condition()
+                self.end_scope()
+            else:
+                assert False, ('couldn\'t write json type %s' % field.type)
+        self.add_statement('g_string_truncate(buffer, p - buffer->str)')
+        self.end_function()
+        self.flush()
+
+    def function_name(self):
+        if self.buffer:
+            return buffer_builder_function_name(self.struct_name)
+        return '__%s_%s_to_json' % (TAG, self.struct_name)
+
     def write(self):
-        function_name = '__%s_%s_to_json' % (TAG, self.struct_name)
+        if self.buffer:
+            self.__write_buffer()
+            return
+        function_name = self.function_name()
         struct_arg = codegen.Argument(self.struct_name, 'const struct %s*' % self.struct_name)
         jsonbuilder_arg = codegen.Argument('jsonbuilder', 'JsonBuilder*')
         self.start_function(function_name, static=True, args=[struct_arg, jsonbuilder_arg])
         self.__write(self.root)
         self.end_function()
+        self.flush()
+
 
+def __generate_parser(struct_name: str, fields_and_annotations, output_file, parameters: list):
+    return JsonParser(struct_name, fields_and_annotations, output_file, iterate='iterate' in parameters,
+                      stream='stream' in parameters, arena='arena' in parameters, object='object' in parameters)
 
-output_file = None
 
+def buffer_builder_function_name(struct_name: str):
+    return '__%s_%s_to_buffer' % (TAG, struct_name)
 
-def __generate_parser(struct_name: str, fields_and_annotations):
-    return JsonParser(struct_name, fields_and_annotations, output_file)
 
+def buffer_size_function_name(struct_name: str):
+    return '__%s_%s_buffer_size' % (TAG, struct_name)
 
-def __generate_builder(struct_name: str, fields_and_annotations):
-    return JsonBuilder(struct_name, fields_and_annotations, output_file)
+
+def __generate_builder(struct_name: str, fields_and_annotations, output_file, parameters: list):
+    return JsonBuilder(struct_name, fields_and_annotations, output_file, buffer='buffer' in parameters)
 
 
 flag_to_generator = {
@@ -297,35 +932,92 @@ flag_to_generator = {
 }
 
 
-def __struct_callback(ast, struct: Struct, flags: dict, outputs: list):
+def __struct_callback(index: codegen.SymbolIndex, struct: Struct, data, outputs: list):
+    flags, output_file = data
     f = flags.get(struct.name)
     if f is not None:
-        print('found flags for %s' % struct.name)
-        fields_and_annotations = codegen.walk_struct(ast, TAG, struct, annotation_types)
-        for ff in f:
-            outputs.append(flag_to_generator[ff](struct.name, fields_and_annotations))
+        codegen.debug('found flags for %s' % struct.name)
+        fields_and_annotations = codegen.walk_struct(index, TAG, struct, annotation_types)
+        for annotation_type, parameters in f:
+            outputs.append(flag_to_generator[annotation_type](struct.name, fields_and_annotations, output_file,
+                                                              parameters))
 
 
-if __name__ == '__main__':
-    args = codegen.create_args(TAG).parse_args()
-    print("%s processing %s -> %s" % (TAG, args.input, args.output))
-
-    ast = codegen.parsefile(TAG, args.input, args.headers)
-    annotated_structs = codegen.find_annotated_structs(TAG, ['parser', 'builder'], ast)
+def generate(index: codegen.SymbolIndex, input, output_file):
+    annotated_structs = codegen.find_annotated_structs(TAG, ['parser', 'builder'], index.ast)
 
     flags = {}
 
-    output_file = open(args.output, 'w+')
-
     for annotated_struct in annotated_structs:
         f = flags.get(annotated_struct.struct_name)
         if f is None:
             f = []
             flags[annotated_struct.struct_name] = f
-        f.append(annotated_struct.annotation_type)
+        f.append((annotated_struct.annotation_type, annotated_struct.parameters))
 
-    outputs = codegen.find_structs(ast, __struct_callback, flags)
+    with codegen.stats.phase('walk'):
+        outputs = codegen.find_structs(index, __struct_callback, (flags, output_file))
+
+    function_names = set()
+    for cb in outputs:
+        assert cb.function_name() not in function_names, \
+            'more than one of the parsers and builders for %s would be called %s' % (cb.struct_name, cb.function_name())
+        function_names.add(cb.function_name())
 
-    codegen.HeaderBlock(TAG, args.input, output_file).write()
+    codegen.HeaderBlock(TAG, input, output_file).write()
+    includes = []
     for cb in outputs:
-        cb.write()
+        for include in cb.includes():
+            if include not in includes:
+                includes.append(include)
+    if len(includes) > 0:
+        include_block = codegen.CodeBlock(output_file=output_file)
+        for include in includes:
+            include_block.add_include(include)
+        include_block.flush()
+    with codegen.stats.phase('generate'):
+        enums = {}
+        for cb in outputs:
+            for enum in cb.enums():
+                enums.setdefault(enum.name, enum)
+        for enum in enums.values():
+            JsonEnum(enum, output_file).write()
+        lookups = {}
+        for cb in outputs:
+            for name, keys in cb.lookups():
+                lookups.setdefault(name, keys)
+        for name, keys in lookups.items():
+            codegen.write_lookup(name, keys, output_file)
+        for cb in outputs:
+            cb.write()
+        cleared = []
+        object_parsers = []
+        for cb in outputs:
+            if type(cb) is not JsonParser:
+                continue
+            if cb.owns_memory() and cb.struct_name not in cleared:
+                cleared.append(cb.struct_name)
+                cb.write_clear()
+            if cb.object:
+                assert cb.struct_name not in object_parsers, 'more than one object parser for %s' % cb.struct_name
+                object_parsers.append(cb.struct_name)
+                cb.write_object_parser()
+
+
+def process(job: codegen.Job, args):
+    codegen.info("%s processing %s -> %s" % (TAG, job.input, job.output))
+
+    dependencies = []
+    ast = codegen.parsefile(BARRIER_TAG, job.input, args.headers, codegen.create_cache(args),
+                            dependencies=dependencies, preprocessor=args.preprocessor)
+    index = codegen.symbol_index(ast)
+
+    with codegen.OutputFile(job.output) as output_file:
+        generate(index, job.input, output_file)
+
+    if job.depfile is not None:
+        codegen.write_depfile(job.depfile, job.output, dependencies)
+
+
+if __name__ == '__main__':
+    codegen.main(TAG, process)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+import codegen
+import jsongen
+import sqlitegen
+import argparse
+import os
+import subprocess
+import sys
+
+TAG = 'multigen'
+
+generators = {
+    'sqlitegen': sqlitegen,
+    'jsongen': jsongen
+}
+
+
+def output_path(output_dir: str, input, generator):
+    basename = os.path.splitext(os.path.basename(input))[0]
+    return os.path.join(output_dir, basename + generator.OUTPUT_SUFFIX)
+
+
+def generate(selected: list, input, output_dir: str, headers: str, cache: codegen.AstCache = None,
+             preprocessor: str = 'cpp'):
+    """
+    runs all of the selected generators over an input. If the barriers of the generators
+    can safely be defined together the input is only preprocessed and parsed once,
+    otherwise it's parsed once per generator.
+    :return: the outputs that were generated and the files the input depended on
+    """
+    barrier_tags = list(map(lambda g: g.BARRIER_TAG, selected))
+
+    indexes = {}
+    dependencies = []
+    # everything the input includes has to be checked too, which needs it preprocessed
+    try:
+        text = codegen.preprocessfile(barrier_tags[0], input, headers, barrier_tags[1:], preprocessor)
+        additive = codegen.barriers_are_additive(codegen.included_files(text), barrier_tags)
+    except subprocess.CalledProcessError:
+        # e.g. an #error for barriers that can't be defined together
+        additive = False
+    if additive:
+        ast = codegen.parsefile(barrier_tags[0], input, headers, cache, extra_tags=barrier_tags[1:],
+                                dependencies=dependencies, text=text)
+        index = codegen.symbol_index(ast, list(map(lambda g: g.TAG, selected)))
+        for generator in selected:
+            indexes[generator] = index
+    else:
+        codegen.info('%s uses barriers exclusively, parsing once per generator' % input)
+        for generator in selected:
+            ast = codegen.parsefile(generator.BARRIER_TAG, input, headers, cache, dependencies=dependencies,
+                                    preprocessor=preprocessor)
+            indexes[generator] = codegen.symbol_index(ast)
+
+    outputs = []
+    for generator in selected:
+        output = output_path(output_dir, input, generator)
+        codegen.info("%s processing %s -> %s" % (generator.TAG, input, output))
+        with codegen.OutputFile(output) as output_file:
+            generator.generate(indexes[generator], input, output_file)
+        outputs.append(output)
+
+    return outputs, list(dict.fromkeys(dependencies))
+
+
+def selected_generators(names: str):
+    selected = []
+    for name in names.split(','):
+        assert name in generators, ('unknown generator %s' % name)
+        selected.append(generators[name])
+    return selected
+
+
+def process(job: codegen.Job, args):
+    outputs, dependencies = generate(selected_generators(args.generators), job.input, job.output, args.headers,
+                                     codegen.create_cache(args), args.preprocessor)
+    if job.depfile is not None:
+        # ninja only handles a single target in a depfile, it applies to all outputs of the rule
+        codegen.write_depfile(job.depfile, outputs[0], dependencies)
+
+
+def create_args():
+    parser = argparse.ArgumentParser(description='%s code gen' % TAG)
+    parser.add_argument('--generators', type=str, required=True,
+                        help='comma separated list of generators to run (%s)' % ', '.join(generators))
+    parser.add_argument('--input', type=str, required=True, action='append')
+    parser.add_argument('--output-dir', type=str, required=True)
+    parser.add_argument('--depfile', type=str,
+                        help='write a make style depfile listing the files the input depends on')
+    parser.add_argument('--headers', type=str, required=True)
+    codegen.add_preprocessor_args(parser)
+    codegen.add_cache_args(parser)
+    codegen.add_jobs_args(parser)
+    codegen.add_output_args(parser)
+    return parser
+
+
+def run(argv: list = None):
+    parser = create_args()
+    args = parser.parse_args(argv)
+    selected_generators(args.generators)
+    if args.depfile is not None and len(args.input) != 1:
+        parser.error('--depfile can only be used with a single input')
+    jobs = list(map(lambda input: codegen.Job(input, args.output_dir, args.depfile), args.input))
+    return 1 if codegen.run_jobs(process, jobs, args) != 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(run())
@@ -0,0 +1,849 @@
+from __future__ import annotations
+import codegen
+import os
+import re
+import sys
+from collections import OrderedDict
+
+# An in-process C preprocessor for the headers the generators read. It only
+# handles what those headers and pycparser's fake libc headers use and produces
+# output laid out the way cpp lays it out (line markers, a token's column on
+# the first token of each line, single spaces elsewhere) so that the asts come
+# out the same, coordinates included. Anything it doesn't handle raises a
+# PreprocessorError so that the caller can fall back to cpp.
+
+TOKEN = re.compile(r'''
+    (?P<space>[ \t\f\v\r]+)
+  | (?P<string>(?:u8|[uUL])?"(?:[^"\\]|\\.)*"?)
+  | (?P<char>[uUL]?'(?:[^'\\]|\\.)*'?)
+  | (?P<identifier>[A-Za-z_$][A-Za-z0-9_$]*)
+  | (?P<number>\.?[0-9](?:[eEpP][+-]|[A-Za-z0-9_.])*)
+  | (?P<punctuator>\.\.\.|<<=|>>=|->|\+\+|--|<<|>>|<=|>=|==|!=|&&|\|\||[*/%+\-&^|]=|\#\#|.)
+''', re.VERBOSE)
+
+COMMENT = re.compile(r'''//[^\n]*|/\*.*?(?:\*/|\Z)|(?:u8|[uUL])?"(?:[^"\\\n]|\\.)*"?|'(?:[^'\\\n]|\\.)*'?''',
+                     re.DOTALL)
+
+DIRECTIVE = re.compile(r'\s*#\s*(\w*)\s*(.*)$')
+
+DEFINE = re.compile(r'([A-Za-z_$][A-Za-z0-9_$]*)(\()?')
+
+IDENTIFIER = re.compile(r'[A-Za-z_$][A-Za-z0-9_$]*')
+
+WHITESPACE = re.compile(r'[ \t\f\v\r]+')
+
+# what cpp predefines that the headers might reasonably test, compiler and
+# platform specific macros aren't defined
+PREDEFINED = {
+    '__STDC__': '1',
+    '__STDC_HOSTED__': '1',
+    '__STDC_VERSION__': '201710L'
+}
+
+# operators that can be followed by = to make another operator
+EQUALS_OPERATORS = {'=', '!', '>', '<', '+', '-', '*', '/', '%', '&', '|', '^', '>>', '<<'}
+
+# the characters that can follow an operator to make another token
+PASTES = {
+    '>': '>',
+    '<': '<%:',
+    '+': '+',
+    '-': '->',
+    '/': '/*',
+    '%': ':%',
+    '&': '&',
+    '|': '|',
+    ':': ':>',
+    '->': '*',
+    '.': '.%',
+    '#': '#%'
+}
+
+BINARY_OPERATORS = {
+    '*': 10, '/': 10, '%': 10,
+    '+': 9, '-': 9,
+    '<<': 8, '>>': 8,
+    '<': 7, '<=': 7, '>': 7, '>=': 7,
+    '==': 6, '!=': 6,
+    '&': 5,
+    '^': 4,
+    '|': 3,
+    '&&': 2,
+    '||': 1
+}
+
+CHAR_ESCAPES = {'n': 10, 't': 9, 'r': 13, '0': 0, '\\': 92, '\'': 39, '"': 34, 'a': 7, 'b': 8, 'f': 12, 'v': 11}
+
+MAX_INCLUDE_DEPTH = 200
+
+
+class PreprocessorError(Exception):
+    pass
+
+
+class NeedMore(Exception):
+    """
+    raised when a function like macro invocation carries on past the end
+    of the tokens that have been read so far
+    """
+    pass
+
+
+class Token:
+    __slots__ = ['text', 'kind', 'space', 'line', 'col', 'hide', 'source']
+
+    def __init__(self, text: str, kind: str, space: bool = False, line: int = None, col: int = None,
+                 hide: frozenset = frozenset()):
+        self.text = text
+        self.kind = kind
+        # preceded by whitespace
+        self.space = space
+        # where it came from in the source, None for tokens that came out of a macro
+        self.line = line
+        self.col = col
+        # the macros that must not be expanded again in this token
+        self.hide = hide
+        # for padding, the token whose whitespace decides the spacing of the next token
+        self.source = None
+
+    def copy(self):
+        token = Token(self.text, self.kind, self.space, None, None, self.hide)
+        token.source = self.source
+        return token
+
+
+def padding(source: Token = None):
+    """
+    marks the edges of macro expansions and arguments, like cpp only
+    these are checked for tokens that would paste together when printed
+    """
+    token = Token('', 'padding')
+    token.source = source
+    return token
+
+
+class Context:
+    """
+    the state of preprocessing a single input
+    """
+    __slots__ = ['include_dirs', 'macros', 'once', 'files', 'depth']
+
+    def __init__(self, include_dirs: tuple, macros: dict):
+        self.include_dirs = include_dirs
+        # name -> (parameters or None, variadic, body as (text, kind, space) tuples)
+        self.macros = macros
+        # real paths of files with #pragma once that have been read
+        self.once = set()
+        # (path, stat key) of every file read
+        self.files = []
+        self.depth = 0
+
+
+class IncludeEntry:
+    __slots__ = ['text', 'macros', 'once', 'files']
+
+    def __init__(self, text: str, macros: dict, once: frozenset, files: tuple):
+        self.text = text
+        self.macros = macros
+        self.once = once
+        self.files = files
+
+
+def cpp_might_define(name: str):
+    """
+    cpp predefines a lot of __name__ macros for the compiler and platform, a header
+    that tests for one that isn't defined here could come out differently
+    """
+    return name.startswith('__') and name.endswith('__') and len(name) > 4
+
+
+def tokenize(text: str, line: int = None, space: bool = False):
+    tokens = []
+    for match in TOKEN.finditer(text):
+        kind = match.lastgroup
+        if kind == 'space':
+            space = True
+            continue
+        tokens.append(Token(match.group(), kind, space, line, None if line is None else match.start() + 1))
+        space = False
+    return tokens
+
+
+def avoid_paste(previous: Token, token: Token):
+    """
+    whether two tokens printed next to each other would be read back as something
+    else, cpp puts a space between them when they would.
+    """
+    a = previous.text
+    c = token.text[0] if token.kind == 'punctuator' else None
+    if a in EQUALS_OPERATORS and c == '=':
+        return True
+    if previous.kind == 'identifier':
+        return token.kind in ['identifier', 'string', 'char']
+    if previous.kind == 'number':
+        return token.kind in ['number', 'identifier', 'char'] or c in ['.', '+', '-']
+    if previous.kind == 'punctuator':
+        if a == '.' and token.kind == 'number':
+            return True
+        return c is not None and c in PASTES.get(a, '')
+    return False
+
+
+def render(tokens: list, first_line: int, first_col: int, lines: int):
+    """
+    prints tokens the way cpp does, the first token on each line is put in
+    the column it came from and later ones are separated by a space if there was
+    whitespace between them.
+    :param first_col: the column of the first token in the source, before any macros were expanded
+    :param lines: the number of source lines the tokens came from
+    """
+    # one less as the first token gets a space if there was whitespace before it
+    parts = [' ' * max(first_col - 2, 0)]
+    line = first_line
+    previous = None
+    padded = False
+    source = None
+    for token in tokens:
+        if token.kind == 'padding':
+            padded = True
+            if source is None or (not source.space and token.source is None):
+                source = token.source
+            continue
+        if token.line is not None and token.line > line:
+            parts.append('\n' * (token.line - line))
+            parts.append(' ' * (token.col - 1))
+            line = token.line
+        elif padded:
+            if (source or token).space or (previous is not None and avoid_paste(previous, token)):
+                parts.append(' ')
+        elif token.space:
+            parts.append(' ')
+        parts.append(token.text)
+        previous = token
+        padded = False
+        source = None
+    parts.append('\n' * (first_line + lines - line))
+    return ''.join(parts)
+
+
+def stringize(tokens: list):
+    parts = []
+    for token in filter(lambda t: t.kind != 'padding', tokens):
+        if len(parts) != 0 and token.space:
+            parts.append(' ')
+        if token.kind in ['string', 'char']:
+            parts.append(token.text.replace('\\', '\\\\').replace('"', '\\"'))
+        else:
+            parts.append(token.text)
+    return '"%s"' % ''.join(parts)
+
+
+def escape_path(path: str):
+    return path.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def source_lines(text: str):
+    """
+    splits source into logical lines with comments blanked out
+    :return: a list of the text of each line and the number of physical lines it was spliced from
+    """
+    physical = text.split('\n')
+    if len(physical) != 0 and physical[-1] == '':
+        physical.pop()
+
+    logical = []
+    counts = []
+    i = 0
+    while i < len(physical):
+        line = physical[i]
+        count = 1
+        while line.endswith('\\') and i + count < len(physical):
+            line = line[:-1] + physical[i + count]
+            count += 1
+        logical.append(line)
+        counts.append(count)
+        i += count
+
+    def blank(match):
+        comment = match.group()
+        if comment.startswith('/'):
+            # keep the newlines and columns, tokens after a comment stay where they were
+            return re.sub(r'[^\n]', ' ', comment)
+        return comment
+
+    stripped = COMMENT.sub(blank, '\n'.join(logical)).split('\n')
+    return list(zip(stripped, counts))
+
+
+class ConditionParser:
+    """
+    evaluates the already macro expanded tokens of an #if
+    """
+    __slots__ = ['tokens', 'position']
+
+    def __init__(self, tokens: list):
+        self.tokens = tokens
+        self.position = 0
+
+    def evaluate(self):
+        value = self.__ternary()
+        if self.position != len(self.tokens):
+            raise PreprocessorError('unexpected %s in #if' % self.tokens[self.position].text)
+        return value
+
+    def __peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position].text
+        return None
+
+    def __take(self, text: str = None):
+        if self.position >= len(self.tokens):
+            raise PreprocessorError('#if ended early')
+        token = self.tokens[self.position]
+        if text is not None and token.text != text:
+            raise PreprocessorError('expected %s in #if but got %s' % (text, token.text))
+        self.position += 1
+        return token
+
+    def __ternary(self):
+        condition = self.__binary(1)
+        if self.__peek() != '?':
+            return condition
+        self.__take('?')
+        a = self.__ternary()
+        self.__take(':')
+        b = self.__ternary()
+        return a if condition != 0 else b
+
+    def __binary(self, precedence: int):
+        left = self.__unary()
+        while True:
+            operator = self.__peek()
+            operator_precedence = BINARY_OPERATORS.get(operator)
+            if operator_precedence is None or operator_precedence < precedence:
+                return left
+            self.__take()
+            right = self.__binary(operator_precedence + 1)
+            left = ConditionParser.__apply(operator, left, right)
+
+    @staticmethod
+    def __apply(operator: str, a: int, b: int):
+        if operator in ['/', '%']:
+            if b == 0:
+                raise PreprocessorError('division by zero in #if')
+            # c truncates towards zero
+            quotient = abs(a) // abs(b) * (1 if (a < 0) == (b < 0) else -1)
+            return quotient if operator == '/' else a - b * quotient
+        return {
+            '*': lambda: a * b,
+            '+': lambda: a + b,
+            '-': lambda: a - b,
+            '<<': lambda: a << b,
+            '>>': lambda: a >> b,
+            '<': lambda: int(a < b),
+            '<=': lambda: int(a <= b),
+            '>': lambda: int(a > b),
+            '>=': lambda: int(a >= b),
+            '==': lambda: int(a == b),
+            '!=': lambda: int(a != b),
+            '&': lambda: a & b,
+            '^': lambda: a ^ b,
+            '|': lambda: a | b,
+            '&&': lambda: int(a != 0 and b != 0),
+            '||': lambda: int(a != 0 or b != 0)
+        }[operator]()
+
+    def __unary(self):
+        token = self.__take()
+        if token.text == '(':
+            value = self.__ternary()
+            self.__take(')')
+            return value
+        if token.text == '!':
+            return int(self.__unary() == 0)
+        if token.text == '~':
+            return ~self.__unary()
+        if token.text == '-':
+            return -self.__unary()
+        if token.text == '+':
+            return self.__unary()
+        if token.kind == 'number':
+            return ConditionParser.__integer(token.text)
+        if token.kind == 'char':
+            return ConditionParser.__char(token.text)
+        if token.kind == 'identifier':
+            if cpp_might_define(token.text):
+                raise PreprocessorError('%s might be predefined by cpp' % token.text)
+            # anything left after expansion isn't defined
+            return 0
+        raise PreprocessorError('unexpected %s in #if' % token.text)
+
+    @staticmethod
+    def __integer(text: str):
+        value = text.rstrip('uUlL')
+        try:
+            if value[:2] in ['0x', '0X']:
+                return int(value[2:], 16)
+            if value[:2] in ['0b', '0B']:
+                return int(value[2:], 2)
+            if len(value) > 1 and value.startswith('0'):
+                return int(value, 8)
+            return int(value)
+        except ValueError:
+            raise PreprocessorError('%s isn\'t an integer' % text)
+
+    @staticmethod
+    def __char(text: str):
+        value = text[text.index('\'') + 1:-1]
+        if len(value) == 1:
+            return ord(value)
+        if len(value) == 2 and value[0] == '\\' and value[1] in CHAR_ESCAPES:
+            return CHAR_ESCAPES[value[1]]
+        raise PreprocessorError('unsupported character constant %s' % text)
+
+
+class Preprocessor:
+    """
+    preprocesses inputs without running cpp. The lines of every file read and the
+    output of every included file are kept between inputs, an include is reused
+    when it's entered with the same macros defined as before and none of the files
+    it read have changed since, which for the usual case of every input including
+    the same wrapper header means the includes are only ever preprocessed once.
+    """
+    __slots__ = ['max_entries', '__sources', '__includes']
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self.__sources = {}
+        self.__includes = OrderedDict()
+
+    def preprocess(self, path: str, defines: list, include_dirs: list):
+        """
+        :param defines: names to define as 1, like -D
+        :param include_dirs: directories to look for includes in, like -I
+        :return: the preprocessed source with line markers
+        """
+        macros = {}
+        for name, value in PREDEFINED.items():
+            macros[name] = (None, False, Preprocessor.__body(value))
+        for name in defines:
+            macros[name] = (None, False, Preprocessor.__body('1'))
+
+        context = Context(tuple(include_dirs), macros)
+        out = []
+        self.__file(context, path, path, out, '')
+        return ''.join(out)
+
+    @staticmethod
+    def __body(text: str):
+        return tuple(map(lambda t: (t.text, t.kind, t.space), tokenize(text.strip())))
+
+    @staticmethod
+    def __stat(path: str):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def __source(self, path: str):
+        key = Preprocessor.__stat(path)
+        entry = self.__sources.get(path)
+        if entry is not None and entry[0] == key:
+            return entry
+        with open(path) as f:
+            entry = (key, source_lines(f.read()))
+        self.__sources[path] = entry
+        return entry
+
+    def __fresh(self, files: tuple):
+        return all(map(lambda f: Preprocessor.__stat(f[0]) == f[1], files))
+
+    def __include(self, context: Context, path: str, display: str, out: list):
+        if os.path.realpath(path) in context.once:
+            return
+
+        key = (display, context.include_dirs, frozenset(context.macros.items()), frozenset(context.once))
+        entry = self.__includes.get(key)
+        if entry is not None and self.__fresh(entry.files):
+            codegen.stats.count('include_cache_hits')
+            self.__includes.move_to_end(key)
+            context.macros = dict(entry.macros)
+            context.once = set(entry.once)
+            context.files.extend(entry.files)
+            out.append(entry.text)
+            return
+
+        codegen.stats.count('include_cache_misses')
+        first_file = len(context.files)
+        included = []
+        context.depth += 1
+        if context.depth > MAX_INCLUDE_DEPTH:
+            raise PreprocessorError('#include nested too deeply in %s' % display)
+        self.__file(context, path, display, included, ' 1')
+        context.depth -= 1
+
+        text = ''.join(included)
+        self.__includes[key] = IncludeEntry(text, dict(context.macros), frozenset(context.once),
+                                            tuple(context.files[first_file:]))
+        while len(self.__includes) > self.max_entries:
+            self.__includes.popitem(last=False)
+        out.append(text)
+
+    @staticmethod
+    def __resolve(context: Context, current: str, rest: str):
+        tokens = tokenize(rest)
+        if len(tokens) == 0:
+            raise PreprocessorError('#include without a file')
+        if tokens[0].kind == 'string' and tokens[0].text.startswith('"'):
+            name = tokens[0].text[1:-1]
+            candidates = [os.path.join(os.path.dirname(current), name)]
+        elif tokens[0].text == '<' and '>' in rest:
+            name = rest[rest.index('<') + 1:rest.index('>')]
+            candidates = []
+        else:
+            # #include MACRO
+            raise PreprocessorError('computed #include is not supported')
+
+        for include_dir in context.include_dirs:
+            candidates.append(os.path.join(include_dir.rstrip('/') or '/', name))
+        for candidate in candidates:
+            if os.path.isfile(candidate):
+                return candidate
+        raise PreprocessorError('%s not found' % name)
+
+    @staticmethod
+    def __define(context: Context, rest: str):
+        match = DEFINE.match(rest)
+        if match is None:
+            raise PreprocessorError('bad #define %s' % rest)
+        name = match.group(1)
+        body = rest[match.end():]
+        parameters = None
+        variadic = False
+        # only function like if the ( immediately follows the name
+        if match.group(2) is not None:
+            end = body.find(')')
+            if end < 0:
+                raise PreprocessorError('bad #define %s' % rest)
+            parameters = list(map(str.strip, body[:end].split(',')))
+            if parameters == ['']:
+                parameters = []
+            if len(parameters) != 0 and parameters[-1].endswith('...'):
+                variadic = True
+                parameters[-1] = parameters[-1][:-3].strip() or '__VA_ARGS__'
+            parameters = tuple(parameters)
+            body = body[end + 1:]
+        context.macros[name] = (parameters, variadic, Preprocessor.__body(body))
+
+    @staticmethod
+    def __defined(context: Context, name: str):
+        if name in context.macros:
+            return True
+        if cpp_might_define(name):
+            raise PreprocessorError('%s might be predefined by cpp' % name)
+        return False
+
+    def __condition(self, context: Context, rest: str):
+        tokens = tokenize(rest)
+        replaced = []
+        i = 0
+        while i < len(tokens):
+            token = tokens[i]
+            if token.kind == 'identifier' and token.text == 'defined':
+                if i + 1 < len(tokens) and tokens[i + 1].kind == 'identifier':
+                    name = tokens[i + 1].text
+                    i += 2
+                elif i + 3 < len(tokens) and tokens[i + 1].text == '(' and tokens[i + 2].kind == 'identifier' \
+                        and tokens[i + 3].text == ')':
+                    name = tokens[i + 2].text
+                    i += 4
+                else:
+                    raise PreprocessorError('bad defined in #if %s' % rest)
+                replaced.append(Token('1' if Preprocessor.__defined(context, name) else '0', 'number', token.space))
+                continue
+            replaced.append(token)
+            i += 1
+        tokens = list(filter(lambda t: t.kind != 'padding', self.__expand(context, replaced)))
+        return ConditionParser(tokens).evaluate() != 0
+
+    def __file(self, context: Context, path: str, display: str, out: list, flags: str):
+        key, lines = self.__source(path)
+        context.files.append((path, key))
+        out.append('# 1 "%s"%s\n' % (escape_path(display), flags))
+
+        # [active before the #if, a branch has been taken]
+        conditions = []
+        active = True
+        line_number = 1
+        i = 0
+        while i < len(lines):
+            text, count = lines[i]
+            directive = DIRECTIVE.match(text)
+
+            if directive is None:
+                if not active:
+                    out.append('\n' * count)
+                    line_number += count
+                    i += 1
+                    continue
+                plain = Preprocessor.__plain(context, text)
+                if plain is not None:
+                    out.append(plain + '\n' * count)
+                    line_number += count
+                    i += 1
+                    continue
+                first_col, tokens, count, i = self.__text(context, lines, i, line_number)
+                out.append(render(tokens, line_number, first_col, count))
+                line_number += count
+                continue
+
+            name, rest = directive.group(1), directive.group(2)
+            if name in ['if', 'ifdef', 'ifndef']:
+                taken = False
+                if active:
+                    if name == 'if':
+                        taken = self.__condition(context, rest)
+                    else:
+                        words = rest.split()
+                        if len(words) == 0:
+                            raise PreprocessorError('#%s without a name' % name)
+                        taken = Preprocessor.__defined(context, words[0]) == (name == 'ifdef')
+                conditions.append([active, taken])
+                active = taken
+            elif name in ['elif', 'else', 'endif']:
+                if len(conditions) == 0:
+                    raise PreprocessorError('#%s without #if in %s:%d' % (name, display, line_number))
+                parent, taken = conditions[-1]
+                if name == 'endif':
+                    conditions.pop()
+                    active = parent
+                elif name == 'else':
+                    active = parent and not taken
+                    conditions[-1][1] = True
+                else:
+                    active = parent and not taken and self.__condition(context, rest)
+                    conditions[-1][1] = taken or active
+            elif not active:
+                pass
+            elif name == 'include':
+                included = Preprocessor.__resolve(context, display, rest)
+                self.__include(context, included, included, out)
+                line_number += count
+                i += 1
+                out.append('# %d "%s" 2\n' % (line_number, escape_path(display)))
+                continue
+            elif name == 'define':
+                Preprocessor.__define(context, rest)
+            elif name == 'undef':
+                words = rest.split()
+                if len(words) != 0:
+                    context.macros.pop(words[0], None)
+            elif name == 'pragma':
+                if rest.strip() == 'once':
+                    context.once.add(os.path.realpath(path))
+                else:
+                    # passed on to the parser like cpp does
+                    out.append('#pragma %s' % ' '.join(rest.split()))
+            elif name == 'warning':
+                print('%s:%d: warning: %s' % (display, line_number, rest), file=sys.stderr)
+            elif name == 'error':
+                raise PreprocessorError('%s:%d: #error %s' % (display, line_number, rest))
+            elif name != '':
+                raise PreprocessorError('#%s is not supported' % name)
+
+            out.append('\n' * count)
+            line_number += count
+            i += 1
+
+        if len(conditions) != 0:
+            raise PreprocessorError('unterminated #if in %s' % display)
+
+    @staticmethod
+    def __plain(context: Context, text: str):
+        """
+        most lines don't use any macros, for those printing them like cpp
+        just means squeezing the whitespace between tokens
+        :return: the line as cpp would print it or None if it needs expanding
+        """
+        if '"' in text or '\'' in text:
+            return None
+        for name in IDENTIFIER.findall(text):
+            if name in context.macros:
+                return None
+        stripped = text.lstrip(' \t\f\v\r')
+        # the first token keeps its column
+        return ' ' * (len(text) - len(stripped)) + WHITESPACE.sub(' ', stripped.rstrip(' \t\f\v\r'))
+
+    def __text(self, context: Context, lines: list, i: int, line_number: int):
+        """
+        expands the tokens on a line, and the lines after it if a macro invocation carries on over them
+        :return: the column of the first token, the expanded tokens, the number of physical lines used and
+        the index of the next line
+        """
+        text, count = lines[i]
+        tokens = tokenize(text, line_number)
+        first_col = tokens[0].col if len(tokens) != 0 else 1
+        i += 1
+        while True:
+            more = i < len(lines) and DIRECTIVE.match(lines[i][0]) is None
+            try:
+                return first_col, self.__expand(context, tokens, more), count, i
+            except NeedMore:
+                if not more:
+                    raise PreprocessorError('unterminated macro invocation on line %d' % line_number)
+                text, next_count = lines[i]
+                tokens = tokens + tokenize(text, line_number + count, True)
+                count += next_count
+                i += 1
+
+    def __expand(self, context: Context, tokens: list, more: bool = False):
+        """
+        :param more: if there are more lines that a macro invocation could carry on to
+        """
+        pending = list(reversed(tokens))
+        result = []
+        while len(pending) != 0:
+            token = pending.pop()
+            macro = None
+            if token.kind == 'identifier' and token.text not in token.hide:
+                macro = context.macros.get(token.text)
+            if macro is None:
+                result.append(token)
+                continue
+
+            hide = token.hide | {token.text}
+            parameters = macro[0]
+            arguments = None
+            if parameters is not None:
+                following = len(pending) - 1
+                while following >= 0 and pending[following].kind == 'padding':
+                    following -= 1
+                if following < 0:
+                    if more:
+                        raise NeedMore()
+                    result.append(token)
+                    continue
+                if pending[following].text != '(':
+                    # just the name of a function like macro
+                    result.append(token)
+                    continue
+                del pending[following + 1:]
+                arguments, closing = Preprocessor.__arguments(token.text, macro, pending, more)
+                hide = (token.hide & closing.hide) | {token.text}
+
+            replacement = self.__substitute(context, macro, arguments, hide)
+            if len(replacement) != 0:
+                # so that it's printed where the macro was
+                replacement[0].line = token.line
+                replacement[0].col = token.col
+            pending.append(padding())
+            pending.extend(reversed(replacement))
+            pending.append(padding(token))
+        return result
+
+    @staticmethod
+    def __arguments(name: str, macro: tuple, pending: list, more: bool):
+        parameters, variadic, body = macro
+        # the comma separated arguments, the last parameter of a variadic macro takes the rest
+        splits = len(parameters) - 1 if variadic else None
+
+        pending.pop()
+        arguments = [[]]
+        depth = 0
+        while True:
+            if len(pending) == 0:
+                if more:
+                    raise NeedMore()
+                raise PreprocessorError('unterminated argument list invoking %s' % name)
+            token = pending.pop()
+            if token.text == ')' and depth == 0:
+                closing = token
+                break
+            if token.text == ',' and depth == 0 and (splits is None or len(arguments) <= splits):
+                arguments.append([])
+                continue
+            if token.text == '(':
+                depth += 1
+            elif token.text == ')':
+                depth -= 1
+            arguments[-1].append(token)
+
+        if len(parameters) == 0 and arguments == [[]]:
+            arguments = []
+        if variadic and len(arguments) == len(parameters) - 1:
+            arguments.append([])
+        if len(arguments) != len(parameters):
+            raise PreprocessorError('%s takes %d arguments but was given %d' % (name, len(parameters), len(arguments)))
+        return arguments, closing
+
+    def __substitute(self, context: Context, macro: tuple, arguments: list, hide: frozenset):
+        parameters, variadic, body = macro
+
+        def parameter(index: int):
+            if parameters is None or index >= len(body):
+                return None
+            text, kind, space = body[index]
+            if kind != 'identifier' or text not in parameters:
+                return None
+            return parameters.index(text)
+
+        def raw(argument: int, pasting: bool = False):
+            tokens = arguments[argument]
+            if pasting:
+                tokens = filter(lambda t: t.kind != 'padding', tokens)
+            return list(map(Token.copy, tokens))
+
+        result = []
+        i = 0
+        while i < len(body):
+            text, kind, space = body[i]
+            argument = parameter(i)
+            if parameters is not None and text == '#' and parameter(i + 1) is not None:
+                result.append(Token(stringize(arguments[parameter(i + 1)]), 'string', space))
+                i += 2
+                continue
+
+            if text == '##' and len(result) != 0 and i + 1 < len(body):
+                right_argument = parameter(i + 1)
+                if right_argument is not None:
+                    right = raw(right_argument, True)
+                else:
+                    right = [Token(*body[i + 1])]
+                left = result.pop()
+                if len(right) == 0:
+                    result.append(left)
+                elif left.kind == 'placemarker':
+                    right[0].space = left.space
+                    result.extend(right)
+                else:
+                    pasted = tokenize(left.text + right[0].text)
+                    if len(pasted) != 0:
+                        pasted[0].space = left.space
+                    result.extend(pasted + right[1:])
+                i += 2
+                continue
+
+            if argument is not None:
+                if i + 1 < len(body) and body[i + 1][0] == '##':
+                    tokens = raw(argument, True)
+                    if len(tokens) == 0:
+                        # pasting onto an empty argument leaves the other side as it was
+                        tokens = [Token('', 'placemarker', space)]
+                    else:
+                        tokens[0].space = space
+                    result.extend(tokens)
+                else:
+                    tokens = list(map(Token.copy, self.__expand(context, raw(argument))))
+                    if i != 0:
+                        result.append(padding(Token(text, kind, space)))
+                    result.extend(tokens)
+                    result.append(padding())
+            else:
+                result.append(Token(text, kind, space))
+            i += 1
+
+        result = list(filter(lambda t: t.kind != 'placemarker', result))
+        for token in result:
+            token.hide = token.hide | hide
+        return result
@@ -1,10 +1,20 @@
 #!/usr/bin/env python3
 
 import codegen
+import jsongen
 import json
 
 TAG = 'rpcgen'
 
+# number of endpoints at which the dispatcher stops comparing the endpoint
+# against each name in turn and switches on its length and characters instead,
+# can be overridden with dispatch_threshold in the rpc json
+DISPATCH_THRESHOLD = 8
+
+# what the topic passed to __rpcgen_<root>_dispatch_topic is split on,
+# can be overridden with topic_separator in the rpc json
+TOPIC_SEPARATOR = '/'
+
 
 class TopicPart:
     __slots__ = ['name', 'c_type', 'length', 'min', 'max', 'conversion']
@@ -27,12 +37,20 @@ class TopicPart:
                 t.__setattr__(f, json[f])
         return t
 
-    def define_var_and_check(self, index: int, codeblock: codegen.CodeBlock):
+    def define_var_and_check(self, index: int, codeblock: codegen.CodeBlock, lengths: str = None,
+                             pass_lengths: bool = False):
+        """
+        :param lengths: the array holding the lengths of the topic parts if they are already known, the
+        parts aren't terminated then
+        :param pass_lengths: if the handlers take the lengths of strings, otherwise strings are terminated
+        """
         if self.conversion is None:
-            codeblock.add_statement('%s %s = topicparts[%d]' % (self.c_type, self.name, index))
-            codeblock.start_scope()
+            if lengths is None:
+                codeblock.add_statement('%s %s = topicparts[%d]' % (self.c_type, self.name, index))
+                codeblock.add_statement('gsize %s_len = strlen(%s)' % (self.name, self.name))
+            else:
+                codeblock.add_statement('gsize %s_len = %s[%d]' % (self.name, lengths, index))
             checked = False
-            codeblock.add_statement('gsize %s_len = strlen(%s)' % (self.name, self.name))
             if self.length is not None:
                 codeblock.start_condition('%s_len != %d' % (self.name, self.length))
                 checked = True
@@ -47,92 +65,780 @@ class TopicPart:
                 codeblock.add_statement('ret = RPCGEN_ERR_BADTOPICPART')
                 codeblock.add_statement('goto out')
                 codeblock.end_condition()
-            codeblock.end_scope()
+            if lengths is not None:
+                if pass_lengths:
+                    codeblock.add_statement('%s %s = topicparts[%d]' % (self.c_type, self.name, index))
+                else:
+                    # on the stack so nothing is allocated, it's never longer than the topic
+                    codeblock.add_statement('gchar* %s_copy = g_alloca(%s_len + 1)' % (self.name, self.name))
+                    codeblock.add_statement('memcpy(%s_copy, topicparts[%d], %s_len)' % (self.name, index, self.name))
+                    codeblock.add_statement("%s_copy[%s_len] = '\\0'" % (self.name, self.name))
+                    codeblock.add_statement('%s %s = %s_copy' % (self.c_type, self.name, self.name))
         elif self.conversion == 'unsigned':
             codeblock.add_statement('%s %s' % (self.c_type, self.name))
             codeblock.start_scope()
+            part = 'topicparts[%d]' % index
+            if lengths is not None:
+                # big enough for any guint64, anything longer can't be in range
+                codeblock.add_statement('gchar %s_str[21]' % self.name)
+                codeblock.start_condition('%s[%d] >= sizeof(%s_str)' % (lengths, index, self.name))
+                codeblock.add_statement('ret = RPCGEN_ERR_BADTOPICPART')
+                codeblock.add_statement('goto out')
+                codeblock.end_condition()
+                codeblock.add_statement('memcpy(%s_str, %s, %s[%d])' % (self.name, part, lengths, index))
+                codeblock.add_statement("%s_str[%s[%d]] = '\\0'" % (self.name, lengths, index))
+                part = '%s_str' % self.name
             codeblock.add_statement('guint64 %s_tmp' % self.name)
-            codeblock.start_condition('!g_ascii_string_to_unsigned(topicparts[%d], 10, %d, %d, &%s_tmp,NULL)' %
-                                      (index, self.min, self.max, self.name))
+            codeblock.start_condition('!g_ascii_string_to_unsigned(%s, 10, %d, %d, &%s_tmp,NULL)' %
+                                      (part, self.min, self.max, self.name))
             codeblock.add_statement('ret = RPCGEN_ERR_BADTOPICPART')
             codeblock.add_statement('goto out')
             codeblock.end_condition()
             codeblock.add_statement('%s = %s_tmp' % (self.name, self.name))
             codeblock.end_scope()
 
+    def arguments(self, pass_lengths: bool = False):
+        """
+        the arguments for the part in the handler
+        :param pass_lengths: if strings are followed by their length
+        """
+        args = [codegen.Argument(self.name, self.c_type)]
+        if pass_lengths and self.conversion is None:
+            args.append(codegen.Argument('%s_len' % self.name, 'gsize'))
+        return args
+
+    def values(self, prefix: str = '', pass_lengths: bool = False):
+        """
+        what's passed to the handler for the part
+        :param prefix: where the variables for the part are, i.e. call->
+        """
+        return list(map(lambda a: prefix + a.name, self.arguments(pass_lengths)))
+
+
+def pool_name(root: str):
+    return '__%s_pool_%s' % (TAG, root)
+
+
+def cache_name(root: str, endpoint: str):
+    return '__%s_cache_%s_%s' % (TAG, root, endpoint)
+
+
+def route_unknown_roots_name():
+    return '__%s_route_unknown_roots' % TAG
+
+
+def stats_table_name(root: str):
+    # not __rpcgen_<root>_stats so that it can't collide with the handler of an endpoint called stats
+    return '__%s_stats_%s' % (TAG, root)
+
 
 class Endpoint:
-    __slots__ = ['root', 'name', 'topic_parts', 'shared_args']
+    __slots__ = ['root', 'name', 'topic_parts', 'shared_args', 'index', 'stats', 'pass_lengths', 'thread', 'cache',
+                 'request_struct']
 
-    def __init__(self, root: str, name: str, json_object: dict, shared_args):
+    def __init__(self, root: str, name: str, json_object: dict, shared_args, index: int = 0, stats: bool = False,
+                 pass_lengths: bool = False):
+        """
+        :param index: the position of the endpoint in its interface
+        :param stats: if calls to the endpoint should be counted in the stats table of its root
+        :param pass_lengths: if the handler takes the length of each string topic part after it
+        """
         self.root = root
         self.name = name
         self.topic_parts = list(map(lambda tp: TopicPart.from_json(tp, json_object['topic_parts'][tp]),
                                     json_object['topic_parts']))
         self.shared_args = shared_args
+        self.index = index
+        self.stats = stats
+        self.pass_lengths = pass_lengths
+        self.thread = json_object.get('thread', False)
+        self.cache = json_object.get('cache')
+        # a struct with a jsongen parser that the request is parsed into before calling the handler
+        self.request_struct = json_object.get('request_struct')
+        if self.request_struct is not None:
+            assert self.shared_args[1].c_type == 'JsonNode*', \
+                'endpoint %s can only have a request struct if the request is a JsonNode' % name
+        if self.cache is not None:
+            assert not self.thread, 'endpoint %s can\'t be cached and called from a thread' % name
+            assert self.shared_args[2].c_type == 'JsonBuilder*', \
+                'endpoint %s can only be cached if the response is a JsonBuilder' % name
 
     def write(self, output_file):
         handler = codegen.CodeBlock(output_file)
         args = self.shared_args.copy()
-        args[1:1] = map(lambda tp: codegen.Argument(tp.name, tp.c_type), self.topic_parts)
+        if self.request_struct is not None:
+            args[1] = codegen.Argument('request', 'const struct %s*' % self.request_struct)
+        args[1:1] = self.topic_part_arguments(self.pass_lengths)
         handler.function_prototype(self.function_name(), static=True, rtype='int', args=args)
+        handler.flush()
 
     def function_name(self):
         return '__%s_%s_%s' % (TAG, self.root, self.name)
 
+    def topic_part_arguments(self, pass_lengths: bool):
+        return [a for tp in self.topic_parts for a in tp.arguments(pass_lengths)]
 
-if __name__ == '__main__':
-    args = codegen.create_args(TAG).parse_args()
-    print("%s processing %s -> %s" % (TAG, args.input, args.output))
+    def topic_part_values(self, pass_lengths: bool, prefix: str = ''):
+        return [v for tp in self.topic_parts for v in tp.values(prefix, pass_lengths)]
 
-    output_file = open(args.output, 'w+')
+    def call_name(self):
+        return '%s_%s_call' % (pool_name(self.root), self.name)
 
-    codegen.HeaderBlock(TAG, args.input, output_file).write()
+    def write_call(self, output_file):
+        """
+        writes the struct that holds what's needed to call the endpoint from the thread pool
+        and the function that calls it from there
+        """
+        call = codegen.CodeBlock(output_file)
+        call.start_scope(prefix='struct %s ' % self.call_name())
+        call.add_statement('struct %s_call call' % pool_name(self.root))
+        for tp in self.topic_parts:
+            # the topic might be gone by the time the endpoint is called so strings are copied
+            call.add_statement('%s %s' % ('gchar*' if tp.conversion is None else tp.c_type, tp.name))
+            if tp.conversion is None and self.pass_lengths:
+                call.add_statement('gsize %s_len' % tp.name)
+        if self.request_struct is not None:
+            call.add_statement('struct %s typed_request' % self.request_struct)
+        call.end_scope(terminate=True)
 
-    includes = codegen.CodeBlock(output_file=output_file)
-    includes.add_include('codegen/rpcgen.h')
+        call.start_function('%s_run' % self.call_name(), static=True, rtype='int',
+                            args=[codegen.Argument('base', 'struct %s_call*' % pool_name(self.root))])
+        call.add_statement('struct %s* call = (struct %s*) base' % (self.call_name(), self.call_name()))
+        request = 'base->request' if self.request_struct is None else '&call->typed_request'
+        call_args = ['base->context'] + self.topic_part_values(self.pass_lengths, 'call->') + [request, 'base->response']
+        call.add_statement('int ret = %s(%s)' % (self.function_name(), ', '.join(call_args)))
+        for tp in self.topic_parts:
+            if tp.conversion is None:
+                call.add_statement('g_free(call->%s)' % tp.name)
+        if self.request_struct is not None:
+            call.add_statement('%s(&call->typed_request)' % jsongen.object_clear_name(self.request_struct))
+        call.add_statement('return ret')
+        call.end_function()
+        call.flush()
 
-    input = open(args.input)
-    rpc_json = json.load(input)
+    def write_cache(self, output_file):
+        """
+        writes the cache for the endpoint, the function that creates the key for the values of
+        the topic parts and the functions to invalidate entries
+        """
+        cache = cache_name(self.root, self.name)
+        args = list(map(lambda tp: codegen.Argument(tp.name, tp.c_type), self.topic_parts)) or None
 
-    root = rpc_json['root']
+        block = codegen.CodeBlock(output_file)
+        block.start_scope(prefix='static struct rpcgen_cache %s = ' % cache)
+        block.add_items(['.max_entries = %d' % self.cache['max_entries'],
+                         '.ttl_us = %d' % int(self.cache.get('ttl', 0) * 1000000)])
+        block.end_scope(terminate=True)
 
-    shared_args = []
-    for k in ['context', 'request', 'response']:
-        shared_args.append(codegen.Argument(k, rpc_json[k]['c_type']))
-    dispatch_args = shared_args.copy()
-    dispatch_args[1:1] = [codegen.Argument('topicparts', 'const gchar**'), codegen.Argument('numtopicparts', 'int')]
+        # the length of strings is included so that the values can't run into each other
+        block.start_function('%s_key' % cache, static=True, rtype='gchar*',
+                             args=self.topic_part_arguments(True) or None)
+        block.add_statement('GString* key = g_string_new(NULL)')
+        for tp in self.topic_parts:
+            if tp.conversion is None:
+                block.add_statement('g_string_append_printf(key, "%%" G_GSIZE_FORMAT ":", %s_len)' % tp.name)
+                block.add_statement('g_string_append_len(key, %s, %s_len)' % (tp.name, tp.name))
+            else:
+                block.add_statement('g_string_append_printf(key, "%%" G_GUINT64_FORMAT ";", (guint64) %s)' % tp.name)
+        block.add_statement('return g_string_free(key, FALSE)')
+        block.end_function()
 
-    endpoints = []
-    for endpoint in rpc_json['endpoints']:
-        endpoint = Endpoint(root, endpoint, rpc_json['endpoints'][endpoint], shared_args)
-        endpoint.write(output_file)
-        endpoints.append(endpoint)
+        block.start_function('%s_invalidate' % cache, static=True, rtype='gboolean', args=args)
+        # the dispatcher already knows the lengths of the strings but whatever invalidates might not
+        key_args = []
+        for tp in self.topic_parts:
+            key_args.append(tp.name)
+            if tp.conversion is None:
+                key_args.append('strlen(%s)' % tp.name)
+        block.add_statement('gchar* key = %s_key(%s)' % (cache, ', '.join(key_args)))
+        block.add_statement('gboolean invalidated = rpcgen_cache_invalidate(&%s, key)' % cache)
+        block.add_statement('g_free(key)')
+        block.add_statement('return invalidated')
+        block.end_function()
 
-    dispatch = codegen.CodeBlock(output_file=output_file)
-    dispatch.start_function('__rpcgen_%s_dispatch' % root, static=True, rtype='int', args=dispatch_args)
-    dispatch.add_statement('int ret = RPCGEN_ERR_NONE')
-    dispatch.add_statement('const gchar* endpoint = topicparts[0]')
-    for endpoint in endpoints:
-        dispatch.start_or_alternative('g_strcmp0(endpoint, "%s") == 0' % endpoint.name)
-        dispatch.add_comment(endpoint.name)
-        dispatch.start_condition('(numtopicparts - 1) != %d' % len(endpoint.topic_parts))
+        block.start_function('%s_clear' % cache, static=True)
+        block.add_statement('rpcgen_cache_clear(&%s)' % cache)
+        block.end_function()
+        block.flush()
+
+    def write_cached_call(self, dispatch: codegen.CodeBlock, call_args: list):
+        """
+        writes a call to the endpoint that replays the response from the cache if it's there, otherwise
+        the handler builds its response separately so that it can be cached if it succeeds
+        """
+        cache = cache_name(self.root, self.name)
+        # the dispatcher always knows the lengths of the strings
+        key_args = ', '.join(self.topic_part_values(True))
+        dispatch.add_statement('gchar* key = %s_key(%s)' % (cache, key_args))
+        dispatch.add_statement('const struct rpcgen_cache_entry* cached = rpcgen_cache_lookup(&%s, key)' % cache)
+        dispatch.start_condition('cached != NULL')
+        dispatch.add_statement('g_free(key)')
+        dispatch.add_statement('rpcgen_cache_replay(cached->response, response)')
+        dispatch.add_statement('ret = RPCGEN_ERR_NONE')
+        dispatch.add_else()
+        dispatch.add_statement('JsonBuilder* builder = json_builder_new()')
+        dispatch.add_statement('json_builder_begin_object(builder)')
+        dispatch.add_statement('ret = %s(%s)' % (self.function_name(), ', '.join(call_args[:-1] + ['builder'])))
+        dispatch.add_statement('json_builder_end_object(builder)')
+        dispatch.add_statement('JsonNode* built = json_builder_get_root(builder)')
+        dispatch.add_statement('g_object_unref(builder)')
+        dispatch.add_statement('rpcgen_cache_replay(built, response)')
+        dispatch.start_condition('ret == RPCGEN_ERR_NONE')
+        dispatch.add_statement('rpcgen_cache_insert(&%s, key, built)' % cache)
+        dispatch.add_else()
+        dispatch.add_statement('g_free(key)')
+        dispatch.add_statement('json_node_unref(built)')
+        dispatch.end_condition()
+        dispatch.end_condition()
+
+    def write_queue(self, dispatch: codegen.CodeBlock):
+        pool = pool_name(self.root)
+        dispatch.start_condition('%s == NULL || (%s_max_queued != 0 && g_thread_pool_unprocessed(%s) >= %s_max_queued)'
+                                 % (pool, pool, pool, pool))
+        if self.request_struct is not None:
+            dispatch.add_statement('%s(&typed_request)' % jsongen.object_clear_name(self.request_struct))
+        dispatch.add_statement('g_message("too many calls queued for %s")' % self.name)
+        dispatch.add_statement('ret = RPCGEN_ERR_BUSY')
+        dispatch.add_statement('goto out')
+        dispatch.end_condition()
+        dispatch.add_statement('struct %s* call = g_new0(struct %s, 1)' % (self.call_name(), self.call_name()))
+        dispatch.add_statement('call->call.run = %s_run' % self.call_name())
+        for k in ['context', 'request', 'response']:
+            dispatch.add_statement('call->call.%s = %s' % (k, k))
+        if self.stats:
+            dispatch.add_statement('call->call.stats = stats')
+            dispatch.add_statement('call->call.started = started')
+        for tp in self.topic_parts:
+            if tp.conversion is None:
+                dispatch.add_statement('call->%s = g_strndup(%s, %s_len)' % (tp.name, tp.name, tp.name))
+                if self.pass_lengths:
+                    dispatch.add_statement('call->%s_len = %s_len' % (tp.name, tp.name))
+            else:
+                dispatch.add_statement('call->%s = %s' % (tp.name, tp.name))
+        if self.request_struct is not None:
+            dispatch.add_statement('call->typed_request = typed_request')
+        dispatch.add_statement('g_thread_pool_push(%s, call, NULL)' % pool)
+        dispatch.add_statement('return RPCGEN_PENDING')
+
+    def write_dispatch(self, dispatch: codegen.CodeBlock, lengths: str = None, first: int = 1, threads: bool = True):
+        """
+        writes the checks of the topic parts and the call to the endpoint for the dispatcher
+        :param first: the index of the first topic part that belongs to the endpoint
+        :param threads: if the call can be queued for the thread pool when the endpoint has thread set
+        """
+        dispatch.add_comment(self.name)
+        if self.stats:
+            dispatch.add_statement('stats = &%s[%d]' % (stats_table_name(self.root), self.index))
+        dispatch.start_condition('(numtopicparts - %d) != %d' % (first, len(self.topic_parts)))
         dispatch.add_statement(
             'g_message("incorrect number of topic parts for %s, expected %d and got %%d", numtopicparts)'
-            % (endpoint.name, len(endpoint.topic_parts)))
+            % (self.name, len(self.topic_parts)))
         dispatch.add_statement('ret = RPCGEN_ERR_INVALIDTOPIC')
         dispatch.add_statement('goto out')
         dispatch.end_condition()
-        for tp in endpoint.topic_parts:
-            tp.define_var_and_check(1 + endpoint.topic_parts.index(tp), dispatch)
-        call_args = ['context'] + list(map(lambda tp: tp.name, endpoint.topic_parts)) + ['request', 'response']
-        dispatch.add_statement('ret = %s(%s)' % (endpoint.function_name(), ', '.join(call_args)))
-    dispatch.add_else()
-    dispatch.add_statement('g_message("unknown endpoint %s", endpoint)')
-    dispatch.add_statement('ret = RPCGEN_ERR_INVALIDENDPOINT')
-    dispatch.end_condition()
+        for tp in self.topic_parts:
+            tp.define_var_and_check(first + self.topic_parts.index(tp), dispatch, lengths, self.pass_lengths)
+        request = 'request'
+        if self.request_struct is not None:
+            dispatch.add_statement('struct %s typed_request = { 0 }' % self.request_struct)
+            dispatch.start_condition('request == NULL || !JSON_NODE_HOLDS_OBJECT(request) || '
+                                     '!%s(&typed_request, json_node_get_object(request))'
+                                     % jsongen.object_parser_name(self.request_struct))
+            # the parse might have failed after allocating some of the fields
+            dispatch.add_statement('%s(&typed_request)' % jsongen.object_clear_name(self.request_struct))
+            dispatch.add_statement('g_message("bad request for %s")' % self.name)
+            dispatch.add_statement('ret = RPCGEN_ERR_BADREQUEST')
+            dispatch.add_statement('goto out')
+            dispatch.end_condition()
+            request = '&typed_request'
+        if self.thread and threads:
+            self.write_queue(dispatch)
+            return
+        call_args = ['context'] + self.topic_part_values(self.pass_lengths) + [request, 'response']
+        if self.cache is not None:
+            self.write_cached_call(dispatch, call_args)
+        else:
+            dispatch.add_statement('ret = %s(%s)' % (self.function_name(), ', '.join(call_args)))
+        if self.request_struct is not None:
+            dispatch.add_statement('%s(&typed_request)' % jsongen.object_clear_name(self.request_struct))
+
+
+class Interface:
+    """
+    a root and its endpoints as described by an rpc json
+    """
+    __slots__ = ['root', 'shared_args', 'endpoints', 'use_lookup', 'topic_separator', 'stats', 'pass_lengths']
+
+    def __init__(self, rpc_json: dict):
+        self.root = rpc_json['root']
+        self.shared_args = []
+        for k in ['context', 'request', 'response']:
+            self.shared_args.append(codegen.Argument(k, rpc_json[k]['c_type']))
+        self.stats = rpc_json.get('stats', False)
+        self.pass_lengths = rpc_json.get('pass_lengths', False)
+        self.endpoints = []
+        for index, endpoint in enumerate(rpc_json['endpoints']):
+            self.endpoints.append(Endpoint(self.root, endpoint, rpc_json['endpoints'][endpoint], self.shared_args,
+                                           index, self.stats, self.pass_lengths))
+        self.use_lookup = len(self.endpoints) >= rpc_json.get('dispatch_threshold', DISPATCH_THRESHOLD)
+        self.topic_separator = rpc_json.get('topic_separator', TOPIC_SEPARATOR)
+        assert len(self.topic_separator.encode()) == 1, 'topic separator needs to be a single character'
+        for name in [self.root] + list(map(lambda e: e.name, self.endpoints)):
+            assert self.topic_separator not in name, '%s can\'t have the topic separator in it' % name
+
+    @staticmethod
+    def load(input):
+        with codegen.stats.phase('load'), open(input) as f:
+            return Interface(json.load(f))
+
+    def lookup_function_name(self):
+        return '__%s_%s_endpoint_index' % (TAG, self.root)
+
+    def max_topic_parts(self):
+        return 1 + max(map(lambda e: len(e.topic_parts), self.endpoints), default=0)
+
+
+def write_stats_start(dispatch: codegen.CodeBlock):
+    dispatch.add_statement('gint64 started = g_get_monotonic_time()')
+    dispatch.add_statement('struct rpcgen_endpoint_stats* stats = NULL')
+
+
+def write_dispatch_result(dispatch: codegen.CodeBlock, stats: bool = False, returns: bool = True):
     dispatch.add_label('out')
+    if stats:
+        dispatch.start_condition('stats != NULL')
+        dispatch.add_statement('rpcgen_stats_record(stats, ret, g_get_monotonic_time() - started)')
+        dispatch.end_condition()
     dispatch.add_statement('json_builder_set_member_name(response, "code")')
     dispatch.add_statement('json_builder_add_int_value(response, ret)')
-    dispatch.add_statement('return ret')
+    if returns:
+        dispatch.add_statement('return ret')
+
+
+def write_unknown_endpoint_message(dispatch: codegen.CodeBlock, lengths: str = None):
+    if lengths is None:
+        dispatch.add_statement('g_message("unknown endpoint %s", endpoint)')
+    else:
+        # the parts of a topic that was split here aren't terminated
+        dispatch.add_statement('g_message("unknown endpoint %%.*s", (int) %s[0], endpoint)' % lengths)
+
+
+def write_dispatch_body(interface: Interface, dispatch: codegen.CodeBlock, lengths: str = None,
+                        threads: bool = True):
+    """
+    writes the part of a dispatcher that finds the endpoint for topicparts and calls it
+    :param lengths: the array holding the lengths of the topic parts if they are already known
+    :param threads: if calls can be queued for the thread pool, otherwise the body doesn't return
+    and ret holds the result once it's done
+    """
+    dispatch.add_statement('int ret = RPCGEN_ERR_NONE')
+    dispatch.add_statement('const gchar* endpoint = topicparts[0]')
+    if interface.stats:
+        write_stats_start(dispatch)
+    if interface.use_lookup:
+        if lengths is None:
+            index = 'endpoint != NULL ? %s(endpoint, strlen(endpoint)) : -1' % interface.lookup_function_name()
+        else:
+            index = '%s(endpoint, %s[0])' % (interface.lookup_function_name(), lengths)
+        dispatch.start_switch(index)
+        for index, endpoint in enumerate(interface.endpoints):
+            dispatch.start_case(index)
+            endpoint.write_dispatch(dispatch, lengths, threads=threads)
+            dispatch.end_case()
+        dispatch.start_default()
+        write_unknown_endpoint_message(dispatch, lengths)
+        if interface.stats:
+            dispatch.add_statement('%s_unknown++' % stats_table_name(interface.root))
+        dispatch.add_statement('ret = RPCGEN_ERR_INVALIDENDPOINT')
+        dispatch.end_case()
+        dispatch.end_switch()
+    else:
+        for endpoint in interface.endpoints:
+            if lengths is None:
+                dispatch.start_or_alternative('g_strcmp0(endpoint, "%s") == 0' % endpoint.name)
+            else:
+                name = endpoint.name.encode()
+                dispatch.start_or_alternative('%s[0] == %d && memcmp(endpoint, %s, %d) == 0'
+                                              % (lengths, len(name), codegen.c_string(name), len(name)))
+            endpoint.write_dispatch(dispatch, lengths, threads=threads)
+        dispatch.add_else()
+        write_unknown_endpoint_message(dispatch, lengths)
+        if interface.stats:
+            dispatch.add_statement('%s_unknown++' % stats_table_name(interface.root))
+        dispatch.add_statement('ret = RPCGEN_ERR_INVALIDENDPOINT')
+        dispatch.end_condition()
+    write_dispatch_result(dispatch, interface.stats, returns=threads)
+
+
+def write_topic_split(dispatch: codegen.CodeBlock, separator: str, max_parts: int):
+    """
+    writes the splitting of topic into topicparts and topicpartlens. The topic isn't touched so
+    the parts aren't terminated and need to be used with their lengths, there's never a reason
+    to keep more than max_parts but the rest are still counted so that the errors are the same
+    as for a topic that was split beforehand.
+    """
+    dispatch.add_statement('const gchar* topicparts[%d]' % max_parts)
+    dispatch.add_statement('gsize topicpartlens[%d]' % max_parts)
+    dispatch.add_statement('int numtopicparts = 0')
+    dispatch.add_statement('gsize start = 0')
+    dispatch.start_scope(prefix='for(gsize i = 0; i <= topic_len; i++)')
+    dispatch.start_condition('i == topic_len || topic[i] == %s' % codegen.c_char(separator.encode()[0]))
+    dispatch.start_condition('numtopicparts < %d' % max_parts)
+    dispatch.add_statement('topicparts[numtopicparts] = topic + start')
+    dispatch.add_statement('topicpartlens[numtopicparts] = i - start')
+    dispatch.end_condition()
+    dispatch.add_statement('numtopicparts++')
+    dispatch.add_statement('start = i + 1')
+    dispatch.end_condition()
+    dispatch.end_scope()
+
+
+def topic_dispatch_args(shared_args: list):
+    args = shared_args.copy()
+    args[1:1] = [codegen.Argument('topic', 'const gchar*'), codegen.Argument('topic_len', 'gsize')]
+    return args
+
+
+def write_stats(interface: Interface, output_file):
+    """
+    writes the table the dispatchers count calls to each endpoint in and a function to dump it
+    """
+    table = stats_table_name(interface.root)
+    stats = codegen.CodeBlock(output_file=output_file)
+    stats.start_scope(prefix='static struct rpcgen_endpoint_stats %s[] = ' % table)
+    stats.add_items(list(map(lambda e: '{ .name = "%s" }' % e.name, interface.endpoints)))
+    stats.end_scope(terminate=True)
+    stats.add_statement('static guint64 %s_unknown = 0' % table)
+
+    stats.start_function('%s_to_json' % table, static=True, args=[codegen.Argument('builder', 'JsonBuilder*')])
+    stats.add_statement('json_builder_begin_object(builder)')
+    stats.add_statement('json_builder_set_member_name(builder, "unknown")')
+    stats.add_statement('json_builder_add_int_value(builder, %s_unknown)' % table)
+    stats.add_statement('json_builder_set_member_name(builder, "endpoints")')
+    stats.add_statement('json_builder_begin_object(builder)')
+    stats.start_scope(prefix='for(gsize i = 0; i < G_N_ELEMENTS(%s); i++)' % table)
+    stats.add_statement('const struct rpcgen_endpoint_stats* endpoint = &%s[i]' % table)
+    stats.add_statement('json_builder_set_member_name(builder, endpoint->name)')
+    stats.add_statement('json_builder_begin_object(builder)')
+    for counter in ['calls', 'other_codes', 'total_us']:
+        stats.add_statement('json_builder_set_member_name(builder, "%s")' % counter)
+        stats.add_statement('json_builder_add_int_value(builder, endpoint->%s)' % counter)
+    for counters in ['codes', 'buckets']:
+        stats.add_statement('json_builder_set_member_name(builder, "%s")' % counters)
+        stats.add_statement('json_builder_begin_array(builder)')
+        stats.start_scope(prefix='for(gsize j = 0; j < G_N_ELEMENTS(endpoint->%s); j++)' % counters)
+        stats.add_statement('json_builder_add_int_value(builder, endpoint->%s[j])' % counters)
+        stats.end_scope()
+        stats.add_statement('json_builder_end_array(builder)')
+    stats.add_statement('json_builder_end_object(builder)')
+    stats.end_scope()
+    stats.add_statement('json_builder_end_object(builder)')
+    stats.add_statement('json_builder_end_object(builder)')
+    stats.end_function()
+    stats.flush()
+
+
+def write_pool(interface: Interface, output_file):
+    """
+    writes the thread pool that endpoints with thread set are called from, the functions to
+    create and free it and the calls for each of those endpoints
+    """
+    pool = pool_name(interface.root)
+    shared_types = list(map(lambda a: a.c_type, interface.shared_args))
+
+    state = codegen.CodeBlock(output_file=output_file)
+    state.add_statement('typedef void (*%s_complete_func)(%s, int code)' % (pool, ', '.join(shared_types)))
+    state.add_statement('static GThreadPool* %s = NULL' % pool)
+    state.add_statement('static guint %s_max_queued = 0' % pool)
+    state.add_statement('static GMainContext* %s_main_context = NULL' % pool)
+    state.add_statement('static %s_complete_func %s_complete = NULL' % (pool, pool))
+    state.start_scope(prefix='struct %s_call ' % pool)
+    state.add_statement('int (*run)(struct %s_call* call)' % pool)
+    for arg in interface.shared_args:
+        state.add_statement('%s %s' % (arg.c_type, arg.name))
+    state.add_statement('int code')
+    if interface.stats:
+        state.add_statement('struct rpcgen_endpoint_stats* stats')
+        state.add_statement('gint64 started')
+    state.end_scope(terminate=True)
+    state.flush()
+
+    for endpoint in interface.endpoints:
+        if endpoint.thread:
+            endpoint.write_call(output_file)
+
+    # called from the main context once a call has run in the pool
+    complete = codegen.CodeBlock(output_file=output_file)
+    complete.start_function('%s_completed' % pool, static=True, rtype='gboolean',
+                            args=[codegen.Argument('data', 'gpointer')])
+    complete.add_statement('struct %s_call* call = data' % pool)
+    if interface.stats:
+        complete.add_statement('rpcgen_stats_record(call->stats, call->code, g_get_monotonic_time() - call->started)')
+    complete.add_statement('%s_complete(call->context, call->request, call->response, call->code)' % pool)
+    complete.add_statement('g_free(call)')
+    complete.add_statement('return G_SOURCE_REMOVE')
+    complete.end_function()
+    complete.flush()
+
+    run = codegen.CodeBlock(output_file=output_file)
+    run.start_function('%s_run' % pool, static=True,
+                       args=[codegen.Argument('data', 'gpointer'), codegen.Argument('user_data', 'gpointer')])
+    run.add_statement('struct %s_call* call = data' % pool)
+    run.add_statement('call->code = call->run(call)')
+    run.add_statement('json_builder_set_member_name(call->response, "code")')
+    run.add_statement('json_builder_add_int_value(call->response, call->code)')
+    run.add_statement('g_main_context_invoke(%s_main_context, %s_completed, call)' % (pool, pool))
+    run.end_function()
+    run.flush()
+
+    init = codegen.CodeBlock(output_file=output_file)
+    init.add_comment('max_queued is how many calls can be waiting for a thread, 0 doesn\'t limit them')
+    init.start_function('%s_init' % pool, static=True, rtype='gboolean',
+                        args=[codegen.Argument('max_threads', 'gint'), codegen.Argument('max_queued', 'guint'),
+                              codegen.Argument('complete', '%s_complete_func' % pool),
+                              codegen.Argument('error', 'GError**')])
+    init.add_statement('g_assert(%s == NULL)' % pool)
+    init.add_statement('%s = g_thread_pool_new(%s_run, NULL, max_threads, FALSE, error)' % (pool, pool))
+    init.start_condition('%s == NULL' % pool)
+    init.add_statement('return FALSE')
+    init.end_condition()
+    init.add_statement('%s_max_queued = max_queued' % pool)
+    init.add_statement('%s_main_context = g_main_context_ref_thread_default()' % pool)
+    init.add_statement('%s_complete = complete' % pool)
+    init.add_statement('return TRUE')
+    init.end_function()
+    init.flush()
+
+    free = codegen.CodeBlock(output_file=output_file)
+    free.start_function('%s_free' % pool, static=True)
+    free.start_condition('%s == NULL' % pool)
+    free.add_statement('return')
+    free.end_condition()
+    free.add_comment('waits for everything that has been queued to run')
+    free.add_statement('g_thread_pool_free(%s, FALSE, TRUE)' % pool)
+    free.add_statement('%s = NULL' % pool)
+    free.add_statement('g_main_context_unref(%s_main_context)' % pool)
+    free.add_statement('%s_main_context = NULL' % pool)
+    free.end_function()
+    free.flush()
+
+
+def write_request_struct_check(struct_name: str, output_file):
+    """
+    only the header jsongen generated for a request struct knows which parsers it has, so this
+    stops the build if it doesn't have one the dispatchers can use
+    """
+    check = codegen.CodeBlock(output_file=output_file)
+    check.add_raw('#ifndef %s\n' % jsongen.object_parser_name(struct_name))
+    check.add_raw('#error "struct %s needs a jsongen parser with object, the header jsongen generated for it '
+                  'needs to be included first"\n' % struct_name)
+    check.add_raw('#endif\n')
+    check.flush()
+
+
+def write_interface(interface: Interface, output_file):
+    request_structs = []
+    for endpoint in interface.endpoints:
+        if endpoint.request_struct is not None and endpoint.request_struct not in request_structs:
+            request_structs.append(endpoint.request_struct)
+    for struct_name in request_structs:
+        write_request_struct_check(struct_name, output_file)
+
+    for endpoint in interface.endpoints:
+        endpoint.write(output_file)
+    codegen.stats.count('endpoints', len(interface.endpoints))
+
+    if any(map(lambda e: e.thread, interface.endpoints)):
+        write_pool(interface, output_file)
+
+    cached = list(filter(lambda e: e.cache is not None, interface.endpoints))
+    if len(cached) > 0:
+        includes = codegen.CodeBlock(output_file=output_file)
+        includes.add_include('codegen/rpcgencache.h')
+        includes.flush()
+        for endpoint in cached:
+            endpoint.write_cache(output_file)
+
+    if interface.use_lookup:
+        codegen.write_lookup(interface.lookup_function_name(),
+                             list(map(lambda e: e.name.encode(), interface.endpoints)), output_file)
+
+    if interface.stats:
+        write_stats(interface, output_file)
+
+    dispatch_args = interface.shared_args.copy()
+    dispatch_args[1:1] = [codegen.Argument('topicparts', 'const gchar**'), codegen.Argument('numtopicparts', 'int')]
+    dispatch = codegen.CodeBlock(output_file=output_file)
+    dispatch.start_function('__%s_%s_dispatch' % (TAG, interface.root), static=True, rtype='int',
+                            args=dispatch_args)
+    write_dispatch_body(interface, dispatch)
     dispatch.end_function()
+    dispatch.flush()
+
+    # the same again but taking the whole topic instead of needing it split up beforehand,
+    # which usually means a g_strsplit() that allocates and copies each part, and
+    # with the lengths of the parts already known so they aren't counted again
+    dispatch = codegen.CodeBlock(output_file=output_file)
+    dispatch.start_function('__%s_%s_dispatch_topic' % (TAG, interface.root), static=True, rtype='int',
+                            args=topic_dispatch_args(interface.shared_args))
+    write_topic_split(dispatch, interface.topic_separator, interface.max_topic_parts())
+    write_dispatch_body(interface, dispatch, 'topicpartlens')
+    dispatch.end_function()
+    dispatch.flush()
+
+    write_batch_dispatch(interface, output_file)
+
+
+def write_batch_dispatch(interface: Interface, output_file):
+    """
+    writes a dispatcher for a batch of requests that adds the response for each one to an array
+    in the same builder
+    """
+    item = '__%s_%s_batch_item' % (TAG, interface.root)
+    request = interface.shared_args[1]
+    types = codegen.CodeBlock(output_file=output_file)
+    types.start_scope(prefix='struct %s ' % item)
+    types.add_statement('const gchar** topicparts')
+    types.add_statement('int numtopicparts')
+    types.add_statement('%s %s' % (request.c_type, request.name))
+    types.add_comment('set to the result once dispatched')
+    types.add_statement('int code')
+    types.end_scope(terminate=True)
+    types.flush()
+
+    args = [interface.shared_args[0], codegen.Argument('items', 'struct %s*' % item),
+            codegen.Argument('numitems', 'gsize'), interface.shared_args[2]]
+    dispatch = codegen.CodeBlock(output_file=output_file)
+    dispatch.start_function('__%s_%s_dispatch_batch' % (TAG, interface.root), static=True, rtype='int', args=args)
+    dispatch.add_statement('int failed = 0')
+    dispatch.add_statement('json_builder_begin_array(response)')
+    dispatch.start_scope(prefix='for(gsize i = 0; i < numitems; i++)')
+    dispatch.add_statement('const gchar** topicparts = items[i].topicparts')
+    dispatch.add_statement('int numtopicparts = items[i].numtopicparts')
+    dispatch.add_statement('%s %s = items[i].%s' % (request.c_type, request.name, request.name))
+    dispatch.add_statement('json_builder_begin_object(response)')
+    # the builder is shared by every item so nothing can be left for the thread pool
+    write_dispatch_body(interface, dispatch, threads=False)
+    dispatch.add_statement('json_builder_end_object(response)')
+    dispatch.add_statement('items[i].code = ret')
+    dispatch.start_condition('ret != RPCGEN_ERR_NONE')
+    dispatch.add_statement('failed++')
+    dispatch.end_condition()
+    dispatch.end_scope()
+    dispatch.add_statement('json_builder_end_array(response)')
+    dispatch.add_statement('return failed')
+    dispatch.end_function()
+    dispatch.flush()
+
+
+def write_router(interfaces: list, output_file):
+    """
+    writes a dispatcher for topics that start with the root of one of the interfaces. The root
+    and endpoint are found with a single lookup on both of them, they are next to each other in
+    the topic with the separator between them.
+    """
+    first = interfaces[0]
+    roots = set()
+    for interface in interfaces:
+        assert interface.root not in roots, 'root %s is used more than once' % interface.root
+        roots.add(interface.root)
+        assert interface.topic_separator == first.topic_separator, \
+            'roots %s and %s use different topic separators' % (first.root, interface.root)
+        for ia, fa in zip(interface.shared_args, first.shared_args):
+            assert ia.c_type == fa.c_type, \
+                'roots %s and %s have different types for %s' % (first.root, interface.root, ia.name)
+
+    routes = []
+    for interface in interfaces:
+        for endpoint in interface.endpoints:
+            routes.append(endpoint)
+    lookup_name = '__%s_route_index' % TAG
+    separator = first.topic_separator.encode()
+    keys = list(map(lambda e: e.root.encode() + separator + e.name.encode(), routes))
+    codegen.write_lookup(lookup_name, keys, output_file)
+
+    stats = any(map(lambda i: i.stats, interfaces))
+    if stats:
+        # topics for roots that don't exist don't belong in the table of any of the roots
+        unknown_roots = codegen.CodeBlock(output_file=output_file)
+        unknown_roots.add_statement('static guint64 %s = 0' % route_unknown_roots_name())
+        unknown_roots.flush()
+
+    dispatch = codegen.CodeBlock(output_file=output_file)
+    dispatch.start_function('__%s_dispatch_topic' % TAG, static=True, rtype='int',
+                            args=topic_dispatch_args(first.shared_args))
+    write_topic_split(dispatch, first.topic_separator, 1 + max(map(lambda i: i.max_topic_parts(), interfaces)))
+    dispatch.add_statement('int ret = RPCGEN_ERR_NONE')
+    dispatch.add_statement('const gchar* root = topicparts[0]')
+    dispatch.add_statement('const gchar* endpoint = numtopicparts > 1 ? topicparts[1] : ""')
+    dispatch.add_statement('gsize endpoint_len = numtopicparts > 1 ? topicpartlens[1] : 0')
+    if stats:
+        write_stats_start(dispatch)
+    dispatch.start_switch('numtopicparts > 1 ? %s(root, topicpartlens[0] + 1 + topicpartlens[1]) : -1' % lookup_name)
+    for index, endpoint in enumerate(routes):
+        dispatch.start_case(index)
+        endpoint.write_dispatch(dispatch, 'topicpartlens', first=2)
+        dispatch.end_case()
+    dispatch.start_default()
+    dispatch.add_statement('g_message("unknown endpoint %.*s in %.*s", (int) endpoint_len, endpoint, '
+                           '(int) topicpartlens[0], root)')
+    if stats:
+        # counted against the root if it exists, like the dispatcher for the root would
+        for interface in interfaces:
+            root = interface.root.encode()
+            dispatch.start_or_alternative('topicpartlens[0] == %d && memcmp(root, %s, %d) == 0'
+                                          % (len(root), codegen.c_string(root), len(root)))
+            if interface.stats:
+                dispatch.add_statement('%s_unknown++' % stats_table_name(interface.root))
+            else:
+                dispatch.add_comment('%s doesn\'t have stats' % interface.root)
+        dispatch.add_else()
+        dispatch.add_statement('%s++' % route_unknown_roots_name())
+        dispatch.end_condition()
+    dispatch.add_statement('ret = RPCGEN_ERR_INVALIDENDPOINT')
+    dispatch.end_case()
+    dispatch.end_switch()
+    write_dispatch_result(dispatch, stats)
+    dispatch.end_function()
+    dispatch.flush()
+
+
+def generate(input, output_file):
+    codegen.HeaderBlock(TAG, input, output_file).write()
+
+    includes = codegen.CodeBlock(output_file=output_file)
+    includes.add_include('codegen/rpcgen.h')
+    includes.flush()
+
+    write_interface(Interface.load(input), output_file)
+
+
+def generate_router(inputs: list, output_file):
+    """
+    generates everything for each of the inputs and a dispatcher that routes
+    topics to all of them.
+    """
+    codegen.HeaderBlock(TAG, ', '.join(inputs), output_file).write()
+
+    includes = codegen.CodeBlock(output_file=output_file)
+    includes.add_include('codegen/rpcgen.h')
+    includes.flush()
+
+    interfaces = list(map(Interface.load, inputs))
+    for interface in interfaces:
+        write_interface(interface, output_file)
+    write_router(interfaces, output_file)
+
+
+def process(job: codegen.Job, args):
+    codegen.info("%s processing %s -> %s" % (TAG, job.input, job.output))
+
+    with codegen.OutputFile(job.output) as output_file:
+        generate(job.input, output_file)
+
+    if job.depfile is not None:
+        codegen.write_depfile(job.depfile, job.output, [job.input])
+
+
+if __name__ == '__main__':
+    codegen.main(TAG, process)
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+
+import codegen
+import rpcgen
+import argparse
+import sys
+
+TAG = 'rpcroutergen'
+
+
+def process(job: codegen.Job, args):
+    codegen.info("%s processing %s -> %s" % (TAG, ', '.join(args.input), job.output))
+
+    with codegen.OutputFile(job.output) as output_file:
+        rpcgen.generate_router(args.input, output_file)
+
+    if job.depfile is not None:
+        codegen.write_depfile(job.depfile, job.output, args.input)
+
+
+def create_args():
+    parser = argparse.ArgumentParser(description='generates the code for several rpc interfaces and '
+                                                 'a dispatcher that routes topics to all of them')
+    parser.add_argument('--input', type=str, required=True, nargs='+', action='extend',
+                        help='rpc json files to generate the code for, can be repeated')
+    parser.add_argument('--output', type=str, required=True)
+    parser.add_argument('--depfile', type=str,
+                        help='write a make style depfile listing the files the output depends on')
+    codegen.add_output_args(parser)
+    return parser
+
+
+def run(argv: list = None):
+    parser = create_args()
+    args = parser.parse_args(argv)
+    # everything goes into a single output so there's only ever one job
+    args.jobs = 1
+    job = codegen.Job(' '.join(args.input), args.output, args.depfile)
+    return 1 if codegen.run_jobs(process, [job], args) != 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(run())
@@ -1,9 +1,15 @@
 #!/usr/bin/env python3
 
+from __future__ import annotations
 import codegen
-from pycparser.c_ast import Typedef, TypeDecl, Struct, Decl, IdentifierType, PtrDecl
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from pycparser.c_ast import Struct
 
 TAG = 'sqlite'
+BARRIER_TAG = 'sqlitegen'
+OUTPUT_SUFFIX = '.sqlite.h'
 
 annotation_types = [
     'flags',
@@ -131,11 +137,7 @@ class ParsedTable:
                 searchablecols.append(col)
         return searchablecols
 
-    def __write_sql_create(self, outputfile):
-        outputfile.write(
-            '#define __SQLITEGEN_%s_TABLE_CREATE "CREATE TABLE IF NOT EXISTS %s ("\\\n' % (
-                self.name.upper(), self.name))
-
+    def __write_sql_create(self, cb: codegen.CodeBlock):
         createbody = []
         for col in self.cols:
             row_sql = '\t\t\t"%s %s %s' % (col['name'], col['sql_type'], col['sql_constraints'])
@@ -143,12 +145,14 @@ class ParsedTable:
                 row_sql += ' DEFAULT %s' % col['sql_default']
             createbody.append(row_sql)
 
-        outputfile.write(',"\\\n'.join(createbody))
-        outputfile.write('"\\\n')
-
-        outputfile.write('\t\t");"\n\n')
+        cb.add_raw(
+            '#define __SQLITEGEN_%s_TABLE_CREATE "CREATE TABLE IF NOT EXISTS %s ("\\\n' % (
+                self.name.upper(), self.name))
+        cb.add_raw(',"\\\n'.join(createbody))
+        cb.add_raw('"\\\n')
+        cb.add_raw('\t\t");"\n\n')
 
-    def __write_sql_insert(self, outputfile):
+    def __write_sql_insert(self, cb: codegen.CodeBlock):
         colnames = []
         something = []
         for col in self.cols:
@@ -156,44 +160,45 @@ class ParsedTable:
                 continue
             colnames.append(col['name'])
             something.append("?")
-        outputfile.write(
+        cb.add_raw(
             '#define __SQLITEGEN_%s_INSERT "INSERT INTO %s (%s) VALUES (%s);"\n\n' % (
                 self.name.upper(), self.name, ",".join(colnames), ",".join(something)))
 
-    def __write_sql_getby(self, outputfile):
+    def __write_sql_getby(self, cb: codegen.CodeBlock):
         cols = self.__find_searchable_cols()
         for col in cols:
-            outputfile.write(
+            cb.add_raw(
                 '#define __SQLITEGEN_%s_GETBY_%s "SELECT * FROM %s WHERE %s = ?;"\n\n' % (
                     self.name.upper(), col['name'].upper(), self.name, col['name']))
 
-    def __write_sql_list(self, outputfile):
+    def __write_sql_list(self, cb: codegen.CodeBlock):
         cols = self.__find_searchable_cols()
         for col in cols:
-            outputfile.write(
+            cb.add_raw(
                 '#define __SQLITEGEN_%s_LIST_%s "SELECT %s FROM %s;"\n\n' % (
                     self.name.upper(), col['name'].upper(), col['name'], self.name))
 
-    def __write_sql_deleteby(self, outputfile):
+    def __write_sql_deleteby(self, cb: codegen.CodeBlock):
         cols = self.__find_searchable_cols()
         for col in cols:
-            outputfile.write(
+            cb.add_raw(
                 '#define __SQLITEGEN_%s_DELETEBY_%s "DELETE FROM %s WHERE %s = ?;"\n\n' % (
                     self.name.upper(), col['name'].upper(), self.name, col['name']))
 
-    def __write_c_rowcallback(self, outputfile):
+    def __write_c_rowcallback(self, cb: codegen.CodeBlock):
 
         callbackbackstructname = '__sqlitegen_%s_rowcallback_callback' % self.name
 
-        outputfile.write('struct %s {\n' % callbackbackstructname)
-        outputfile.write('\t void (*callback)(const struct %s*, void*);\n' % self.struct_type)
-        outputfile.write('\t void* data;\n')
-        outputfile.write('};\n\n')
+        cb.start_scope(prefix='struct %s ' % callbackbackstructname)
+        cb.add_statement('void (*callback)(const struct %s*, void*)' % self.struct_type)
+        cb.add_statement('void* data')
+        cb.end_scope(terminate=True)
+        cb.add_raw('\n')
 
-        outputfile.write(
-            'static void __attribute__((unused)) __sqlitegen_%s_rowcallback(sqlite3_stmt* stmt, struct %s* callback){\n' % (
-                self.name, callbackbackstructname))
-        outputfile.write('\tstruct %s %s = {0};\n' % (self.struct_type, self.struct_type))
+        cb.start_function('__sqlitegen_%s_rowcallback' % self.name, static=True,
+                          args=[codegen.Argument('stmt', 'sqlite3_stmt*'),
+                                codegen.Argument('callback', 'struct %s*' % callbackbackstructname)])
+        cb.add_statement('struct %s %s = {0}' % (self.struct_type, self.struct_type))
         pos = 0
         for col in self.cols:
             if 'hidden' in col['flags']:
@@ -202,16 +207,17 @@ class ParsedTable:
             if len(col['path']) != 0:
                 path = ".".join(col['path']) + "."
             bind = col['fetch_method'](pos, "%s.%s%s" % (self.struct_type, path, col['field_name']))
-            outputfile.write('\t%s;\n' % bind)
+            cb.add_statement(bind)
             pos += 1
 
-        outputfile.write('\tcallback->callback(&%s, callback->data);\n' % self.struct_type)
-        outputfile.write('}\n\n')
+        cb.add_statement('callback->callback(&%s, callback->data)' % self.struct_type)
+        cb.end_function()
+        cb.add_raw('\n')
 
-    def __write_c_add(self, outputfile):
-        outputfile.write(
-            'static void __attribute__((unused)) __sqlitegen_%s_add(sqlite3_stmt* stmt, const struct %s* %s){\n' % (
-                self.name, self.struct_type, self.struct_type))
+    def __write_c_add(self, cb: codegen.CodeBlock):
+        cb.start_function('__sqlitegen_%s_add' % self.name, static=True,
+                          args=[codegen.Argument('stmt', 'sqlite3_stmt*'),
+                                codegen.Argument(self.struct_type, 'const struct %s*' % self.struct_type)])
         bindpos = 1
         for col in self.cols:
             if 'hidden' in col['flags']:
@@ -221,19 +227,20 @@ class ParsedTable:
             if len(col['path']) != 0:
                 path = ".".join(col['path']) + "."
             bind = col['bind_type'](bindpos, "%s->%s%s" % (self.struct_type, path, col['field_name']))
-            outputfile.write(
-                '\t%s;\n' % bind)
+            cb.add_statement(bind)
             bindpos += 1
-        outputfile.write('}\n')
+        cb.end_function()
 
     def write(self, outputfile):
-        self.__write_sql_create(outputfile)
-        self.__write_sql_insert(outputfile)
-        self.__write_sql_getby(outputfile)
-        self.__write_sql_list(outputfile)
-        self.__write_sql_deleteby(outputfile)
-        self.__write_c_rowcallback(outputfile)
-        self.__write_c_add(outputfile)
+        cb = codegen.CodeBlock(outputfile)
+        self.__write_sql_create(cb)
+        self.__write_sql_insert(cb)
+        self.__write_sql_getby(cb)
+        self.__write_sql_list(cb)
+        self.__write_sql_deleteby(cb)
+        self.__write_c_rowcallback(cb)
+        self.__write_c_add(cb)
+        cb.flush()
 
 
 def __flags_from_field(flags_annotation: codegen.FieldAnnotation):
@@ -245,7 +252,7 @@ def __flags_from_field(flags_annotation: codegen.FieldAnnotation):
         assert flag in flag_types
         flags.append(flag)
 
-    print("flags for %s %s" % (flags_annotation.field_name, str(flags)))
+    codegen.debug("flags for %s %s" % (flags_annotation.field_name, str(flags)))
     return flags
 
 
@@ -259,7 +266,7 @@ def __constraints_from_field(constraints_annotation: codegen.FieldAnnotation):
         assert sql_constraint is not None
         sql_constraints.append(sql_constraint)
 
-    print("constraints for %s %s" % (constraints_annotation.field_name, str(sql_constraints)))
+    codegen.debug("constraints for %s %s" % (constraints_annotation.field_name, str(sql_constraints)))
     return sql_constraints
 
 
@@ -267,7 +274,7 @@ def __default_from_field(default_annotation: codegen.FieldAnnotation):
     if default_annotation is None:
         return None
     default = default_annotation.parameters[0]
-    print('default for %s is %s' % (default_annotation.field_name, default))
+    codegen.debug('default for %s is %s' % (default_annotation.field_name, default))
     return default
 
 
@@ -275,7 +282,7 @@ def __add_col(field: codegen.Field, parsedtable: ParsedTable, flags_annotation=N
               default_annotation=None, prefix=None, pointer=False, path=None):
     parsed_flags = __flags_from_field(flags_annotation)
     constraints = __constraints_from_field(constraints_annotation)
-    print("add col %s with constraints %s" % (field.field_name, str(constraints)))
+    codegen.debug("add col %s with constraints %s" % (field.field_name, str(constraints)))
     default = __default_from_field(default_annotation)
 
     sql_mapped_type = None
@@ -313,62 +320,37 @@ def __add_col(field: codegen.Field, parsedtable: ParsedTable, flags_annotation=N
          'fetch_method': fetch_method, 'sql_default': default})
 
 
-def __flattenfield(ast, field: codegen.Field, parsedtable: ParsedTable, path: list, flags_annotation,
+def __flattenfield(index: codegen.SymbolIndex, field: codegen.Field, parsedtable: ParsedTable, path: list, flags_annotation,
                    constraints_annotation, default_annotation=None, prefix=None, pointer=False):
-    print(field.type)
+    codegen.debug(str(field.type))
     if field.type == codegen.FieldType.NORMAL or field.type == codegen.FieldType.POINTER:
         __add_col(field, parsedtable, flags_annotation, constraints_annotation, default_annotation, prefix,
                   field.type == codegen.FieldType.POINTER, path)
     elif field.type == codegen.FieldType.STRUCT:
         # field.type.type.show()
         path.append(field.field_name)
-        __flatten_struct(ast, parsedtable, codegen.struct_by_name(ast, field.field.type.type.name),
+        __flatten_struct(index, parsedtable, field.struct,
                          prefix=field.field_name,
                          path=path)
     else:
         assert False, ('unhandled type %s' % field.type)
 
 
-def __flatten_struct(ast, parsedtable: ParsedTable, struct: Struct, prefix=None, path=[]):
-    fieldsandannotations = codegen.walk_struct(ast, TAG, struct, annotation_types=annotation_types)
-
-    # bucket the annotations
-    annotations = {}
-    for t in annotation_types:
-        annotations[t] = {}
-    for annotation in fieldsandannotations[1]:
-        annotations[annotation.annotation_type][annotation.field_name] = annotation
-
-    for f in fieldsandannotations[0]:
-        if f.field_name in annotations['flags']:
-            flags = annotations['flags'].pop(f.field_name)
-        else:
-            flags = None
-        if f.field_name in annotations['constraints']:
-            constraints = annotations['constraints'].pop(f.field_name)
-        else:
-            constraints = None
-        if f.field_name in annotations['default']:
-            default = annotations['default'].pop(f.field_name)
-        else:
-            default = None
-
-        __flattenfield(ast, f, parsedtable, path.copy(), flags, constraints, default, prefix)
-
-    # check that we don't have any left overs
-    orphans = 0
-    for annotation_type in annotations:
-        orphans += len(annotations[annotation_type])
-    assert orphans == 0, 'have %d orphan annotations' % orphans
-
-
-def __walktable(ast, struct: Struct, tables, outputs: list):
+def __flatten_struct(index: codegen.SymbolIndex, parsedtable: ParsedTable, struct: Struct, prefix=None, path=[]):
+    fields, annotations = codegen.walk_struct(index, TAG, struct, annotation_types=annotation_types)
+
+    for f in fields:
+        __flattenfield(index, f, parsedtable, path.copy(), annotations.get(f.field_name, 'flags'),
+                       annotations.get(f.field_name, 'constraints'), annotations.get(f.field_name, 'default'), prefix)
+
+
+def __walktable(index: codegen.SymbolIndex, struct: Struct, tables, outputs: list):
     table_names = tables.get(struct.name)
     if table_names is not None:
-        print('found struct for %s' % tables[struct.name])
+        codegen.debug('found struct for %s' % tables[struct.name])
         for table_name in table_names:
             parsedtable = ParsedTable(table_name, struct.name)
-            __flatten_struct(ast, parsedtable, struct)
+            __flatten_struct(index, parsedtable, struct)
             outputs.append(parsedtable)
 
 
@@ -376,28 +358,45 @@ def __table_name_from_struct_annotation(tables: dict, annotated_struct: codegen.
     if annotated_struct.annotation_type == 'table':
         assert len(annotated_struct.parameters) == 1
         table_name = annotated_struct.parameters[0]
-        print('will generate table %s from %s' % (table_name, annotated_struct.struct_name))
+        codegen.debug('will generate table %s from %s' % (table_name, annotated_struct.struct_name))
         if tables.get(annotated_struct.struct_name) is None:
             tables[annotated_struct.struct_name] = []
         tables[annotated_struct.struct_name].append(table_name)
 
 
-if __name__ == '__main__':
-    args = codegen.create_args(TAG).parse_args()
-    print("sqlitegen processing %s -> %s" % (args.input, args.output))
-
-    ast = codegen.parsefile('sqlitegen', args.input, args.headers)
-    structs = codegen.find_annotated_structs(TAG, ['table'], ast)
+def generate(index: codegen.SymbolIndex, input, outputfile):
+    structs = codegen.find_annotated_structs(TAG, ['table'], index.ast)
 
     tables = {}
     for struct in structs:
         __table_name_from_struct_annotation(tables, struct)
 
-    outputs = codegen.find_structs(ast, __walktable, tables)
+    with codegen.stats.phase('walk'):
+        outputs = codegen.find_structs(index, __walktable, tables)
+    codegen.stats.count('tables', len(outputs))
+
+    codegen.HeaderBlock(BARRIER_TAG, input, outputfile).write()
+    with codegen.stats.phase('generate'):
+        for t in outputs:
+            t.write(outputfile)
+
+
+def process(job: codegen.Job, args):
+    codegen.info("sqlitegen processing %s -> %s" % (job.input, job.output))
 
-    outputfile = open(args.output, 'w+')
-    outputfile.write("//generated by sqlitegen from %s\n" % args.input)
-    for t in outputs:
-        t.write(outputfile)
+    dependencies = []
+    ast = codegen.parsefile(BARRIER_TAG, job.input, args.headers, codegen.create_cache(args),
+                            dependencies=dependencies, preprocessor=args.preprocessor)
+    index = codegen.symbol_index(ast)
+
+    with codegen.OutputFile(job.output) as outputfile:
+        generate(index, job.input, outputfile)
+
+    if job.depfile is not None:
+        codegen.write_depfile(job.depfile, job.output, dependencies)
+
+
+if __name__ == '__main__':
+    codegen.main(TAG, process)
 
 # if type(child.type.type) is Struct:
@@ -0,0 +1,12 @@
+#include "codegen/glibwrapper.h"
+#include "colour.h"
+
+struct a {
+	guint64 id;
+	enum colour colour;
+};
+
+#ifdef __JSONGEN
+typedef struct a __jsongen_parser;
+typedef struct a __jsongen_builder;
+#endif
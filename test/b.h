@@ -0,0 +1,12 @@
+#include "codegen/glibwrapper.h"
+#include "colour.h"
+
+struct b {
+	guint32 width;
+	enum colour background;
+};
+
+#ifdef __JSONGEN
+typedef struct b __jsongen_parser;
+typedef struct b __jsongen_builder;
+#endif
@@ -0,0 +1,7 @@
+#pragma once
+
+enum colour {
+	COLOUR_RED,
+	COLOUR_GREEN,
+	COLOUR_BLUE,
+};
@@ -0,0 +1,29 @@
+#include <glib.h>
+#include <json-glib/json-glib.h>
+#include <string.h>
+
+#include "a.h"
+#include "b.h"
+#include "a.json.h"
+#include "b.json.h"
+
+/* a.json.h and b.json.h both use enum colour, the tables for it need to only be there once */
+
+int main(void) {
+	JsonNode* node = json_from_string("{\"id\": 1, \"colour\": \"green\", \"width\": 3, \"background\": \"BLUE\"}",
+	                                  NULL);
+	g_assert_nonnull(node);
+
+	struct a a = { 0 };
+	g_assert_true(__jsongen_a_from_json(&a, json_node_get_object(node)));
+	g_assert_cmpint(a.colour, ==, COLOUR_GREEN);
+
+	struct b b = { 0 };
+	g_assert_true(__jsongen_b_from_json(&b, json_node_get_object(node)));
+	g_assert_cmpint(b.background, ==, COLOUR_BLUE);
+
+	g_assert_cmpstr(__jsongen_enum_colour_to_string(COLOUR_RED), ==, "red");
+
+	json_node_unref(node);
+	return 0;
+}
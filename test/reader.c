@@ -0,0 +1,47 @@
+#include <glib.h>
+#include <string.h>
+
+#include "codegen/jsongenreader.h"
+
+/* reads the json string in json, the buffer is copied so it can be unescaped in place */
+static gboolean read_string(const gchar* json, gchar* buffer, gsize size, gchar** string, gsize* length) {
+	gsize json_len = strlen(json);
+	g_assert_cmpuint(json_len, <, size);
+	memcpy(buffer, json, json_len);
+
+	struct jsongen_reader reader;
+	jsongen_reader_init(&reader, buffer, json_len);
+	return jsongen_reader_string(&reader, string, length);
+}
+
+int main(void) {
+	gchar buffer[64];
+	gchar* string;
+	gsize length;
+
+	g_assert_true(read_string("\"a\\tb\"", buffer, sizeof(buffer), &string, &length));
+	g_assert_cmpstr(string, ==, "a\tb");
+	g_assert_cmpuint(length, ==, 3);
+
+	g_assert_true(read_string("\"caf\\u00e9\"", buffer, sizeof(buffer), &string, &length));
+	g_assert_cmpstr(string, ==, "caf\xc3\xa9");
+	g_assert_cmpuint(length, ==, 5);
+
+	/* a surrogate pair is a single code point outside of the basic multilingual plane */
+	g_assert_true(read_string("\"\\ud83d\\ude00!\"", buffer, sizeof(buffer), &string, &length));
+	g_assert_cmpstr(string, ==, "\xf0\x9f\x98\x80!");
+	g_assert_cmpuint(length, ==, 5);
+
+	/* halves of a pair on their own */
+	g_assert_false(read_string("\"\\ud83d\"", buffer, sizeof(buffer), &string, &length));
+	g_assert_false(read_string("\"\\ud83dx\"", buffer, sizeof(buffer), &string, &length));
+	g_assert_false(read_string("\"\\ude00\"", buffer, sizeof(buffer), &string, &length));
+
+	/* would cut the string short when it's used as a C string */
+	g_assert_false(read_string("\"a\\u0000b\"", buffer, sizeof(buffer), &string, &length));
+
+	g_assert_false(read_string("\"\\u00g0\"", buffer, sizeof(buffer), &string, &length));
+	g_assert_false(read_string("\"unterminated", buffer, sizeof(buffer), &string, &length));
+
+	return 0;
+}
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import codegen
+
+HEADERS = os.path.join(ROOT, 'include')
+
+
+def dump(ast):
+    out = io.StringIO()
+    ast.show(out, attrnames=True, nodenames=True, showcoord=True)
+    return out.getvalue()
+
+
+@unittest.skipUnless(shutil.which('cpp') and os.path.isdir(codegen.FAKE_LIBC_INCLUDE),
+                     'needs cpp and pycparser\'s fake libc headers')
+class TestAstCache(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.cache = codegen.AstCache(os.path.join(self.dir, 'cache'))
+        self.input = self.write('input.h', '#include "codegen/glibwrapper.h"\n#include "included.h"\n'
+                                           'struct a { guint32 a; };\n')
+        self.write('included.h', 'struct b { gchar* b; };\n')
+        codegen.stats.reset()
+
+    def write(self, name: str, text: str):
+        path = os.path.join(self.dir, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def parse(self):
+        return codegen.parsefile('jsongen', self.input, HEADERS, self.cache)
+
+    def entries(self):
+        return sorted(e for e in os.listdir(self.cache.cache_dir) if e.endswith(codegen.AstCache.SUFFIX))
+
+    def test_miss_then_hit(self):
+        parsed = self.parse()
+        self.assertEqual(codegen.stats.counters.get('cache_misses'), 1)
+        self.assertEqual(len(self.entries()), 1)
+
+        cached = self.parse()
+        self.assertEqual(codegen.stats.counters.get('cache_hits'), 1)
+        self.assertEqual(codegen.stats.counters.get('cache_misses'), 1)
+        self.assertEqual(dump(cached), dump(parsed))
+
+    def test_key_changes_with_preprocessed_input(self):
+        before = self.parse()
+        # only the included header changes, the input itself is the same
+        self.write('included.h', 'struct b { gchar* b; guint32 c; };\n')
+        after = self.parse()
+        self.assertEqual(codegen.stats.counters.get('cache_misses'), 2)
+        self.assertEqual(len(self.entries()), 2)
+        self.assertNotEqual(dump(after), dump(before))
+
+    def test_key_changes_with_barrier(self):
+        key = codegen.AstCache.key('-D__JSONGEN', 'int a;')
+        self.assertEqual(codegen.AstCache.key('-D__JSONGEN', 'int a;'), key)
+        self.assertNotEqual(codegen.AstCache.key('-D__SQLITEGEN', 'int a;'), key)
+        self.assertNotEqual(codegen.AstCache.key('-D__JSONGEN', 'int b;'), key)
+
+    def test_corrupt_entry(self):
+        parsed = self.parse()
+        path = os.path.join(self.cache.cache_dir, self.entries()[0])
+        for contents in [b'not a pickle', None]:
+            with self.subTest(truncated=contents is None):
+                if contents is None:
+                    # what a write cut short would leave behind
+                    with open(path, 'rb') as f:
+                        contents = f.read()[:100]
+                with open(path, 'wb') as f:
+                    f.write(contents)
+                key = self.entries()[0][:-len(codegen.AstCache.SUFFIX)]
+                self.assertIsNone(self.cache.get(key))
+                self.assertFalse(os.path.exists(path))
+
+                # parsed again and put back
+                self.assertEqual(dump(self.parse()), dump(parsed))
+                self.assertEqual(len(self.entries()), 1)
+                self.assertIsNotNone(self.cache.get(key))
+
+    def test_evicts_least_recently_used(self):
+        for i, key in enumerate(['a', 'b', 'c']):
+            self.cache.put(key, [key] * 1000)
+            path = os.path.join(self.cache.cache_dir, key + codegen.AstCache.SUFFIX)
+            os.utime(path, (1000000 + i, 1000000 + i))
+        size = os.path.getsize(os.path.join(self.cache.cache_dir, 'a' + codegen.AstCache.SUFFIX))
+
+        # a was added first but reading it makes b the least recently used
+        self.assertEqual(self.cache.get('a'), ['a'] * 1000)
+        self.cache.max_size = size * 3
+        self.cache.put('d', ['d'] * 1000)
+        self.assertEqual(self.entries(), ['a.ast', 'c.ast', 'd.ast'])
+        self.assertIsNone(self.cache.get('b'))
+
+        self.cache.max_size = size
+        self.cache.evict()
+        self.assertEqual(len(self.entries()), 1)
+
+    def test_leaves_other_files(self):
+        other = os.path.join(self.cache.cache_dir, 'parsetab.py')
+        with open(other, 'w') as f:
+            f.write('x' * 10000)
+        self.cache.max_size = 0
+        self.cache.put('a', 'a')
+        self.assertTrue(os.path.exists(other))
+        self.assertEqual(self.entries(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import codegen
+
+TAGS = ['jsongen', 'sqlitegen']
+
+
+class TestBarriersAreAdditive(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def write(self, name: str, text: str):
+        path = os.path.join(self.dir, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def test_additive(self):
+        path = self.write('a.h', '#ifdef __JSONGEN\nint a;\n#endif\n#if defined(__SQLITEGEN)\nint b;\n#endif\n')
+        self.assertTrue(codegen.barriers_are_additive([path], TAGS))
+
+    def test_exclusive(self):
+        for text in ['#ifndef __JSONGEN\nint a;\n#endif\n', '#ifdef __JSONGEN\nint a;\n#else\nint b;\n#endif\n',
+                     '#if !defined(__SQLITEGEN)\nint a;\n#endif\n',
+                     '#if FOO\n#elif defined(__JSONGEN)\nint a;\n#endif\n']:
+            with self.subTest(text=text):
+                self.assertFalse(codegen.barriers_are_additive([self.write('a.h', text)], TAGS))
+
+    def test_same_for_every_generator(self):
+        # glibwrapper.h picks fakeglib.h the same way whichever generator reads it
+        path = os.path.join(ROOT, 'include', 'codegen', 'glibwrapper.h')
+        self.assertTrue(codegen.barriers_are_additive([path], TAGS))
+        self.assertFalse(codegen.barriers_are_additive([path], ['jsongen', 'rpcgen']))
+
+    def test_included_files(self):
+        self.write('b.h', '#ifndef __JSONGEN\nint b;\n#endif\n')
+        path = self.write('a.h', '#include "b.h"\nint a;\n')
+        text = codegen.preprocessfile(TAGS[0], path, os.path.join(ROOT, 'include'), TAGS[1:])
+        self.assertFalse(codegen.barriers_are_additive(codegen.included_files(text), TAGS))
+
+    def test_unreadable(self):
+        path = self.write('a.h', 'int a;\n')
+        self.assertFalse(codegen.barriers_are_additive([path, os.path.join(self.dir, 'missing.h')], TAGS))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import codegen
+import jsongen
+
+HEADERS = os.path.join(ROOT, 'include')
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class TestManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def write(self, name: str, text: str):
+        path = os.path.join(self.dir, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def test_read(self):
+        path = self.write('manifest', '# comment\n\na.h a.json.h\n  b.h\tb.json.h  b.d\n')
+        jobs = codegen.read_manifest(path)
+        self.assertEqual(list(map(lambda j: (j.input, j.output, j.depfile), jobs)),
+                         [('a.h', 'a.json.h', None), ('b.h', 'b.json.h', 'b.d')])
+
+    def test_bad_line(self):
+        for line in ['a.h\n', 'a.h a.json.h a.d extra\n']:
+            with self.subTest(line=line):
+                path = self.write('manifest', 'b.h b.json.h\n' + line)
+                with self.assertRaisesRegex(ValueError, 'manifest:2:'):
+                    codegen.read_manifest(path)
+
+    def test_jobs_from_args(self):
+        manifest = self.write('manifest', 'c.h c.json.h\n')
+        parser = codegen.create_args('jsongen')
+        args = parser.parse_args(['--headers=x', '--input=a.h', '--output=a.json.h', '--depfile=a.d',
+                                  '--pair', 'b.h', 'b.json.h', '--manifest', manifest])
+        jobs = codegen.jobs_from_args(parser, args)
+        self.assertEqual(list(map(lambda j: (j.input, j.output, j.depfile), jobs)),
+                         [('a.h', 'a.json.h', 'a.d'), ('b.h', 'b.json.h', None), ('c.h', 'c.json.h', None)])
+
+    def test_bad_args(self):
+        for argv in [[], ['--input=a.h'], ['--depfile=a.d', '--pair', 'a.h', 'a.json.h']]:
+            with self.subTest(argv=argv):
+                parser = codegen.create_args('jsongen')
+                args = parser.parse_args(['--headers=x'] + argv)
+                with contextlib.redirect_stderr(io.StringIO()), self.assertRaises(SystemExit):
+                    codegen.jobs_from_args(parser, args)
+
+
+@unittest.skipUnless(shutil.which('cpp') and os.path.isdir(codegen.FAKE_LIBC_INCLUDE),
+                     'needs cpp and pycparser\'s fake libc headers')
+class TestRunJobs(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.bad = os.path.join(self.dir, 'bad.h')
+        with open(self.bad, 'w') as f:
+            f.write('struct bad {\n')
+        self.inputs = [os.path.join(TEST_DIR, 'a.h'), self.bad, os.path.join(TEST_DIR, 'b.h')]
+
+        self.manifest = os.path.join(self.dir, 'manifest')
+        with open(self.manifest, 'w') as f:
+            for input in self.inputs:
+                f.write('%s %s %s\n' % (input, self.output(input), self.output(input) + '.d'))
+
+    def output(self, input: str):
+        return os.path.join(self.dir, os.path.basename(input) + '.json')
+
+    def run_manifest(self, jobs: int):
+        stats = os.path.join(self.dir, 'stats.json')
+        stderr = io.StringIO()
+        with contextlib.redirect_stderr(stderr):
+            status = codegen.run(jsongen.TAG, jsongen.process,
+                                 ['--headers=%s' % HEADERS, '--manifest=%s' % self.manifest, '--jobs=%d' % jobs,
+                                  '--stats=%s' % stats])
+        return status, stderr.getvalue(), stats
+
+    def test_one_bad_input(self):
+        for jobs in [1, 3]:
+            with self.subTest(jobs=jobs):
+                for input in self.inputs:
+                    for path in [self.output(input), self.output(input) + '.d']:
+                        if os.path.exists(path):
+                            os.remove(path)
+
+                status, stderr, stats = self.run_manifest(jobs)
+                self.assertEqual(status, 1)
+
+                # only the bad input is reported, with the output it was for
+                self.assertIn('error processing %s -> %s' % (self.bad, self.output(self.bad)), stderr)
+                self.assertEqual(stderr.count('error processing'), 1)
+
+                # the others are still generated
+                self.assertFalse(os.path.exists(self.output(self.bad)))
+                for input in [self.inputs[0], self.inputs[2]]:
+                    self.assertTrue(os.path.getsize(self.output(input)) > 0)
+                    with open(self.output(input) + '.d') as f:
+                        self.assertIn(input, f.read())
+
+                with open(stats) as f:
+                    inputs = json.load(f)['inputs']
+                self.assertEqual(list(map(lambda i: (i['input'], i['ok']), inputs)),
+                                 [(self.inputs[0], True), (self.bad, False), (self.inputs[2], True)])
+
+    def test_all_good(self):
+        with open(self.manifest, 'w') as f:
+            for input in [self.inputs[0], self.inputs[2]]:
+                f.write('%s %s\n' % (input, self.output(input)))
+        status, stderr, stats = self.run_manifest(2)
+        self.assertEqual(status, 0)
+        self.assertNotIn('error processing', stderr)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import re
+import shutil
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import codegen
+import jsongen
+
+HEADERS = os.path.join(ROOT, 'include')
+
+OLD = 1000000
+
+
+class TestOutputFile(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, 'out.h')
+        with open(self.path, 'w') as f:
+            f.write('int a;\n')
+        os.utime(self.path, (OLD, OLD))
+        codegen.stats.reset()
+
+    def test_unchanged_keeps_mtime(self):
+        with codegen.OutputFile(self.path) as f:
+            f.write('int a;\n')
+        self.assertEqual(os.stat(self.path).st_mtime, OLD)
+        self.assertIsNone(codegen.stats.counters.get('outputs_written'))
+
+    def test_changed(self):
+        with codegen.OutputFile(self.path) as f:
+            f.write('int b;\n')
+        self.assertNotEqual(os.stat(self.path).st_mtime, OLD)
+        with open(self.path) as f:
+            self.assertEqual(f.read(), 'int b;\n')
+        self.assertEqual(codegen.stats.counters.get('outputs_written'), 1)
+        self.assertEqual(os.listdir(self.dir), ['out.h'])
+
+    def test_new(self):
+        path = os.path.join(self.dir, 'new.h')
+        self.assertTrue(codegen.write_if_changed(path, 'int a;\n'))
+        self.assertFalse(codegen.write_if_changed(path, 'int a;\n'))
+
+    def test_error_leaves_output(self):
+        with self.assertRaises(RuntimeError):
+            with codegen.OutputFile(self.path) as f:
+                f.write('int b;\n')
+                raise RuntimeError('generating failed')
+        with open(self.path) as f:
+            self.assertEqual(f.read(), 'int a;\n')
+        self.assertEqual(os.stat(self.path).st_mtime, OLD)
+        self.assertEqual(os.listdir(self.dir), ['out.h'])
+
+
+def read_depfile(path: str):
+    """
+    splits a depfile into the target and the dependencies like make does
+    """
+    with open(path) as f:
+        text = f.read().replace('\\\n', ' ')
+    words = list(map(lambda w: re.sub(r'\\(.)', r'\1', w).replace('$$', '$'),
+                     re.findall(r'(?:\\.|[^\s\\])+', text)))
+    assert words[0].endswith(':')
+    return words[0][:-1], words[1:]
+
+
+@unittest.skipUnless(shutil.which('cpp') and os.path.isdir(codegen.FAKE_LIBC_INCLUDE),
+                     'needs cpp and pycparser\'s fake libc headers')
+class TestDepfile(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = os.path.join(tempfile.mkdtemp(), 'with spaces')
+        os.makedirs(self.dir)
+        self.addCleanup(shutil.rmtree, os.path.dirname(self.dir))
+        self.input = self.write('input.h', '#include "codegen/glibwrapper.h"\n#include "an include.h"\n'
+                                           'struct a { guint32 a; };\n'
+                                           '#ifdef __JSONGEN\ntypedef struct a __jsongen_parser;\n#endif\n')
+        self.included = self.write('an include.h', 'struct b { gchar* b; };\n')
+
+    def write(self, name: str, text: str):
+        path = os.path.join(self.dir, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def generate(self):
+        output = os.path.join(self.dir, 'out $1.json.h')
+        depfile = os.path.join(self.dir, 'out.d')
+        args = argparse.Namespace(headers=HEADERS, cache_dir=None, preprocessor='cpp')
+        jsongen.process(codegen.Job(self.input, output, depfile), args)
+        return output, depfile
+
+    def test_lists_included_headers(self):
+        output, depfile = self.generate()
+        target, dependencies = read_depfile(depfile)
+        self.assertEqual(target, output)
+        for path in [self.input, self.included, os.path.join(HEADERS, 'codegen', 'glibwrapper.h'),
+                     os.path.join(HEADERS, 'codegen', 'fakeglib.h')]:
+            self.assertIn(path, dependencies)
+
+        with open(depfile) as f:
+            text = f.read()
+        self.assertIn('with\\ spaces/an\\ include.h', text)
+        self.assertIn('out\\ $$1.json.h:', text)
+
+    def test_unchanged_keeps_mtime(self):
+        output, depfile = self.generate()
+        os.utime(output, (OLD, OLD))
+        os.utime(depfile, (OLD, OLD))
+        self.generate()
+        self.assertEqual(os.stat(output).st_mtime, OLD)
+        self.assertEqual(os.stat(depfile).st_mtime, OLD)
+
+        # a change that the generated code doesn't depend on rewrites neither
+        self.write('an include.h', 'struct b { gchar* b; };\nstruct c { gchar* c; };\n')
+        self.generate()
+        self.assertEqual(os.stat(output).st_mtime, OLD)
+        self.assertEqual(os.stat(depfile).st_mtime, OLD)
+
+        # dropping the include only changes the depfile
+        self.write('input.h', '#include "codegen/glibwrapper.h"\nstruct a { guint32 a; };\n'
+                              '#ifdef __JSONGEN\ntypedef struct a __jsongen_parser;\n#endif\n')
+        self.generate()
+        self.assertEqual(os.stat(output).st_mtime, OLD)
+        self.assertNotEqual(os.stat(depfile).st_mtime, OLD)
+        self.assertNotIn(self.included, read_depfile(depfile)[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
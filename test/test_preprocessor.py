@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import codegen
+from preprocessor import Preprocessor, PreprocessorError
+
+HEADERS = os.path.join(ROOT, 'include')
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# the inputs the generators see, the other headers in include/ are for the generated code and need glib
+INPUTS = [os.path.join(TEST_DIR, 'a.h'), os.path.join(TEST_DIR, 'b.h'), os.path.join(TEST_DIR, 'colour.h'),
+          os.path.join(HEADERS, 'codegen', 'fakeglib.h'), os.path.join(HEADERS, 'codegen', 'glibwrapper.h')]
+
+# without one of these glibwrapper.h includes the real glib.h, which the generators never see
+BARRIERS = [['__JSONGEN'], ['__SQLITEGEN'], ['__JSONGEN', '__SQLITEGEN']]
+
+
+def cpp(path: str, defines: list, include_dirs: list):
+    return codegen.preprocess(path, list(map(lambda d: '-D%s' % d, defines)) +
+                              list(map(lambda d: '-I%s' % d, include_dirs)))
+
+
+def dump(text: str, path: str):
+    """
+    the ast for some preprocessed source with the coordinates of every node
+    """
+    out = io.StringIO()
+    codegen.get_parser().parse(text, path).show(out, attrnames=True, nodenames=True, showcoord=True)
+    return out.getvalue()
+
+
+@unittest.skipUnless(shutil.which('cpp') and os.path.isdir(codegen.FAKE_LIBC_INCLUDE),
+                     'needs cpp and pycparser\'s fake libc headers')
+class TestPreprocessor(unittest.TestCase):
+
+    def setUp(self):
+        self.include_dirs = [codegen.FAKE_LIBC_INCLUDE, HEADERS]
+
+    def assertSameAst(self, path: str, defines: list, preprocessor: Preprocessor):
+        builtin = preprocessor.preprocess(path, defines, self.include_dirs)
+        self.assertEqual(dump(builtin, path), dump(cpp(path, defines, self.include_dirs), path))
+
+    def test_same_ast_as_cpp(self):
+        preprocessor = Preprocessor()
+        for path in INPUTS:
+            for defines in BARRIERS:
+                with self.subTest(input=os.path.basename(path), defines=defines):
+                    self.assertSameAst(path, defines, preprocessor)
+
+    def test_same_ast_with_cached_includes(self):
+        # the included files are kept between inputs, they have to come out the same the second time
+        preprocessor = Preprocessor()
+        for path in INPUTS + INPUTS:
+            self.assertSameAst(path, ['__JSONGEN'], preprocessor)
+
+    def test_same_dependencies_as_cpp(self):
+        for path in INPUTS:
+            builtin = Preprocessor().preprocess(path, ['__JSONGEN'], self.include_dirs)
+            # cpp also includes the system's stdc-predef.h, which nothing the generators read depends on
+            dirs = tuple(map(lambda d: d + os.sep, self.include_dirs + [os.path.dirname(path)]))
+            self.assertEqual(codegen.included_files(builtin),
+                             [f for f in codegen.included_files(cpp(path, ['__JSONGEN'], self.include_dirs))
+                              if f.startswith(dirs)])
+
+
+@unittest.skipUnless(shutil.which('cpp') and os.path.isdir(codegen.FAKE_LIBC_INCLUDE),
+                     'needs cpp and pycparser\'s fake libc headers')
+class TestFallback(unittest.TestCase):
+    """
+    inputs that the builtin preprocessor leaves to cpp
+    """
+
+    # each needs something only cpp knows how to do
+    INPUTS = {
+        'computed_include.h': '#define HEADER "codegen/glibwrapper.h"\n#include HEADER\nstruct s { guint32 a; };\n',
+        'predefined.h': '#include "codegen/glibwrapper.h"\n#if __GNUC__\nstruct s { guint32 a; };\n'
+                        '#else\nstruct s { guint64 a; };\n#endif\n',
+        'unsupported.h': '#include "codegen/glibwrapper.h"\n#line 100\nstruct s { guint32 a; };\n',
+    }
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        for name, text in TestFallback.INPUTS.items():
+            with open(os.path.join(self.dir, name), 'w') as f:
+                f.write(text)
+
+    def test_raises(self):
+        for name in TestFallback.INPUTS:
+            with self.subTest(input=name):
+                with self.assertRaises(PreprocessorError):
+                    Preprocessor().preprocess(os.path.join(self.dir, name), ['__JSONGEN'],
+                                              [codegen.FAKE_LIBC_INCLUDE, HEADERS])
+
+    def test_parsefile_falls_back(self):
+        for name in TestFallback.INPUTS:
+            with self.subTest(input=name):
+                path = os.path.join(self.dir, name)
+                codegen.stats.reset()
+                builtin = codegen.parsefile('jsongen', path, HEADERS, preprocessor='builtin')
+                self.assertEqual(codegen.stats.counters.get('preprocessor_fallbacks'), 1)
+                out = io.StringIO()
+                builtin.show(out, attrnames=True, nodenames=True, showcoord=True)
+                self.assertEqual(out.getvalue(), dump(cpp(path, ['__JSONGEN'],
+                                                          [codegen.FAKE_LIBC_INCLUDE, HEADERS]), path))
+
+
+if __name__ == '__main__':
+    unittest.main()
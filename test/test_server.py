@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import socket
+import stat
+import sys
+import tempfile
+import threading
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import codegenclient
+import codegenserver
+
+
+class TestServer(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, 'socket')
+        self.umask = os.umask(0o022)
+        self.addCleanup(os.umask, self.umask)
+        self.server = codegenserver.Server(self.path, 0)
+        self.addCleanup(self.server.server_close)
+
+    def ask(self, message):
+        thread = threading.Thread(target=self.server.handle_request)
+        thread.start()
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock, sock.makefile('rb') as sock_file:
+            sock.connect(self.path)
+            codegenclient.send_message(sock, message)
+            response = codegenclient.receive_message(sock_file)
+        thread.join()
+        return response
+
+    def test_only_owner_can_connect(self):
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o600)
+        # and the process' umask is put back
+        self.assertEqual(os.umask(0o022), 0o022)
+
+    def test_bad_requests_get_a_response(self):
+        for message in [[], {'argv': [], 'cwd': '/'}, {'generator': 'jsongen'},
+                        {'generator': 'jsongen', 'argv': 'x', 'cwd': '/'}]:
+            with self.subTest(message=message):
+                self.assertEqual(self.ask(message)['status'], 2)
+
+    def test_unknown_generator(self):
+        response = self.ask({'generator': 'nogen', 'argv': [], 'cwd': '/'})
+        self.assertEqual(response['status'], 2)
+        self.assertIn('unknown generator nogen', response['stderr'])
+
+    def test_bad_arguments(self):
+        response = self.ask({'generator': 'jsongen', 'argv': ['--bogus'], 'cwd': self.dir})
+        self.assertEqual(response['status'], 2)
+        self.assertIn('jsongen', response['stderr'])
+
+
+if __name__ == '__main__':
+    unittest.main()